@@ -1,4 +1,22 @@
 import pandas as pd
+import numpy as np
+import sys
+from array import array
+
+
+def wall_clock_ns(dt):
+    """
+    The integer nanosecond epoch of :param dt:'s wall clock time (i.e. ignoring its timezone), which is how
+    daily data is keyed internally.
+
+    >>> wall_clock_ns('2004-08-16') == wall_clock_ns(pd.Timestamp('2004-08-16 00:00:00-0400', tz='America/New_York'))
+    True
+    """
+    if not isinstance(dt, pd.Timestamp):
+        dt = pd.Timestamp(dt)
+    if dt.tz is not None:
+        dt = dt.tz_localize(None)
+    return dt.value
 
 
 def chunks(iterator, chunk_size):
@@ -14,7 +32,77 @@ def chunks(iterator, chunk_size):
     if len(chunk) > 0:
         yield chunk
 
+def categorize(df, columns=None):
+    """
+    Converts the object (e.g. string) columns of :param df: (or just :param columns:) to pandas categoricals,
+    so that repeated values are stored once with integer codes. Modifies and returns :param df:.
+
+    >>> df = categorize(pd.DataFrame({'symbol': ['acc', 'acc', 'xyz'], 'size': [1, 2, 3]}))
+    >>> str(df.dtypes['symbol']), list(df['symbol'].cat.categories)
+    ('category', ['acc', 'xyz'])
+    """
+    if columns is None:
+        columns = [c for c in df.columns if df[c].dtype == object]
+    for c in columns:
+        if c in df.columns:
+            df[c] = df[c].astype('category')
+    return df
+
+
+def frame_bytes(df):
+    """Bytes used by a dataframe, including the strings in object columns."""
+    if df is None or len(df.columns) == 0:
+        return 0
+    return int(df.memory_usage(deep=True, index=True).sum())
+
+
+class FenwickTree:
+    """
+    A growable binary indexed tree, supporting O(log n) point updates and prefix sums.
+
+    >>> ft = FenwickTree()
+    >>> for x in [5, 3, 2]:
+    ...     ft.append(x)
+    >>> ft.prefix_sum(2), ft.total()
+    (8, 10)
+    >>> ft.add(0, -5)
+    >>> ft.prefix_sum(2), ft.total()
+    (3, 5)
+    """
+    def __init__(self):
+        self.__tree = [0]
+        self.__total = 0
+
+    def __len__(self):
+        return len(self.__tree) - 1
+
+    def append(self, value):
+        i = len(self.__tree)
+        lowbit = i & (-i)
+        self.__tree.append(value + self.prefix_sum(i - 1) - self.prefix_sum(i - lowbit))
+        self.__total += value
+
+    def add(self, index, delta):
+        i = index + 1
+        while i < len(self.__tree):
+            self.__tree[i] += delta
+            i += i & (-i)
+        self.__total += delta
+
+    def prefix_sum(self, n):
+        """Sum of the first n elements."""
+        result = 0
+        while n > 0:
+            result += self.__tree[n]
+            n -= n & (-n)
+        return result
+
+    def total(self):
+        return self.__total
+
+
 class HasDfDict:
+    __slots__ = ()
     META_FIELDS = []
 
     def df_dict(self):
@@ -54,6 +142,297 @@ class DictableToDataframe:
             self.df_result = pd.concat([self.df_result, pd.DataFrame(result)])
         return self.df_result
 
+    def nbytes(self):
+        """Approximate bytes used by the dataframe built so far and the dicts buffered since, without building anything."""
+        buffered = sum(sys.getsizeof(d) + sum(sys.getsizeof(v) for v in d.values()) for d in self.buffer)
+        return frame_bytes(self.df_result) + buffered
+
+class ReadOnlyDict(dict):
+    """
+    A dict which can't be modified, used for interned metadata which is shared between many records.
+    copy() returns an ordinary (modifiable) dict.
+
+    >>> meta = ReadOnlyDict({'trade_id': 'foo'})
+    >>> meta['trade_id'] = 'bar'
+    Traceback (most recent call last):
+    ...
+    TypeError: Trade metadata is shared between records and is read-only; modify a copy() of it instead
+    >>> dict(meta, reason='stop')
+    {'trade_id': 'foo', 'reason': 'stop'}
+    """
+    __slots__ = ()
+
+    def __read_only(self, *args, **kwargs):
+        raise TypeError("Trade metadata is shared between records and is read-only; modify a copy() of it instead")
+
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = setdefault = update = __read_only
+
+    def __reduce__(self):
+        return (ReadOnlyDict, (dict(self),))
+
+
+class MetaTable:
+    """
+    Dictionary-encodes trade metadata, so that identical meta dicts are stored once and referenced by an integer id.
+
+    >>> mt = MetaTable()
+    >>> a = mt.intern({'trade_id': 'foo'})
+    >>> b = mt.intern({'trade_id': 'foo'})
+    >>> a is b
+    True
+    >>> mt.id_of(a), mt.id_of({'trade_id': 'bar'}), mt.id_of({'trade_id': 'foo'})
+    (0, 1, 0)
+    >>> len(mt)
+    2
+
+    Interned dicts are shared between every record that uses them, so they are ReadOnlyDicts. Values which
+    compare equal but have different types (e.g. 1, 1.0 and True) are kept apart. Metadata containing unhashable
+    values can't be deduplicated, so each such dict gets its own id.
+
+    >>> mt.id_of({'x': 1}), mt.id_of({'x': 1.0}), mt.id_of({'x': True}), mt.get(mt.id_of({'x': 1.0}))
+    (2, 3, 4, {'x': 1.0})
+    """
+    def __init__(self):
+        self.__ids = {}
+        self.__metas = []
+        self.__id_by_object = {}
+
+    def __len__(self):
+        return len(self.__metas)
+
+    def __add(self, meta):
+        i = len(self.__metas)
+        self.__metas.append(meta)
+        self.__id_by_object[id(meta)] = i
+        return i
+
+    def id_of(self, meta):
+        i = self.__id_by_object.get(id(meta))
+        if (i is not None) and (self.__metas[i] is meta):
+            return i
+        try:
+            key = tuple((k, type(v), v) for (k, v) in meta.items())
+            i = self.__ids.get(key)
+        except TypeError:  # Unhashable metadata values
+            return self.__add(ReadOnlyDict(meta))
+        if i is None:
+            i = self.__add(ReadOnlyDict(meta))
+            self.__ids[key] = i
+        return i
+
+    def intern(self, meta):
+        return self.__metas[self.id_of(meta)]
+
+    def get(self, i):
+        return self.__metas[i]
+
+
+class RecordBuffer:
+    """
+    A columnar alternative to DictableToDataframe for HasDfDict records (trades, cost bases, capital gains).
+
+    Records are stored as one array per column rather than one dict per record, and meta fields are
+    stored as integer ids into a MetaTable. The resulting dataframe is the same as that of DictableToDataframe.
+
+    >>> from collections import namedtuple
+    >>> class Fill(namedtuple('Fill', ['price', 'size', 'meta']), HasDfDict):
+    ...     DICT_COLUMNS = ['price', 'size']
+    ...     META_FIELDS = [('meta', '')]
+    >>> rb = RecordBuffer()
+    >>> rb.append(Fill(17.5, 10, {'trade_id': 'foo'}))
+    >>> rb.append(Fill(17.25, -3, {'trade_id': 'foo', 'reason': 'stop'}))
+    >>> rb.append(Fill(17.0, 2, {}))
+    >>> rb.get()
+       price  size trade_id reason
+    0  17.50    10      foo    NaN
+    1  17.25    -3      foo   stop
+    2  17.00     2      NaN    NaN
+    >>> len(rb.meta_table)
+    3
+
+    With :param categorical:, string columns and meta columns come back as categoricals, and meta columns are
+    built straight from the meta ids (i.e. dictionary-encoded) rather than by materializing a value per row.
+    """
+    def __init__(self, meta_table=None, categorical=False):
+        self.meta_table = meta_table if (meta_table is not None) else MetaTable()
+        self.categorical = categorical
+        self.df_result = pd.DataFrame()
+        self.__reset()
+
+    def __reset(self):
+        self.__size = 0
+        self.__columns = None
+        self.__meta_ids = None
+        self.__meta_fields = None
+
+    def __len__(self):
+        return len(self.df_result) + self.__size
+
+    def append(self, o):
+        if self.__columns is None:
+            self.__columns = {}
+            for c in o.DICT_COLUMNS:
+                v = getattr(o, c)
+                self.__columns[c] = array('d') if isinstance(v, float) else []
+            self.__meta_fields = o.META_FIELDS
+            self.__meta_ids = [array('l') for _ in o.META_FIELDS]
+        for (c, col) in self.__columns.items():
+            v = getattr(o, c)
+            if isinstance(col, array) and not isinstance(v, float):
+                col = list(col)
+                self.__columns[c] = col
+            col.append(v)
+        for ((field, _), ids) in zip(self.__meta_fields, self.__meta_ids):
+            ids.append(self.meta_table.id_of(getattr(o, field)))
+        self.__size += 1
+
+    def __decode_meta(self, ids, prefix, result):
+        unique_ids, inverse = np.unique(np.array(ids, dtype=np.int64), return_inverse=True)
+        first_seen = np.full(len(unique_ids), len(inverse))
+        np.minimum.at(first_seen, inverse, np.arange(len(inverse)))
+        keys = {}
+        for u in unique_ids[np.argsort(first_seen, kind='stable')]:  # Order columns as they first appear, like pd.DataFrame(list_of_dicts)
+            for k in self.meta_table.get(u):
+                keys[k] = True
+        for k in keys:
+            values = np.array([self.meta_table.get(u).get(k, np.nan) for u in unique_ids] + [None], dtype=object)[:-1]
+            if self.categorical:
+                (codes, categories) = pd.factorize(values)
+                result[prefix + k] = pd.Categorical.from_codes(codes[inverse], categories=categories)
+            else:
+                result[prefix + k] = values[inverse]
+
+    def get(self):
+        if self.__size == 0:  # Easy case
+            return self.df_result
+
+        result = {}
+        for (c, col) in self.__columns.items():
+            result[c] = np.array(col, dtype=np.float64) if isinstance(col, array) else col
+        for ((_, prefix), ids) in zip(self.__meta_fields, self.__meta_ids):
+            self.__decode_meta(ids, prefix, result)
+        df = pd.DataFrame(result).infer_objects()
+        self.__reset()
+        if len(self.df_result) == 0:
+            self.df_result = df
+        else:
+            self.df_result = pd.concat([self.df_result, df])
+        if self.categorical:  # Concatenating categoricals with different categories gives object columns
+            categorize(self.df_result)
+        return self.df_result
+
+    def nbytes(self):
+        """Approximate bytes used by the buffered records and the cached dataframe (not counting the meta table)."""
+        total = frame_bytes(self.df_result)
+        if self.__columns is not None:
+            for col in self.__columns.values():
+                total += (col.itemsize * len(col)) if isinstance(col, array) else 8 * len(col)
+            total += sum(ids.itemsize * len(ids) for ids in self.__meta_ids)
+        return total
+
+
+class LazyFrame:
+    """
+    A dataframe which is only built when it is used. len() doesn't build it; anything else (indexing, attributes
+    like .empty or .columns, iteration, comparisons, arithmetic, truth testing, printing, item assignment) builds
+    it once and is passed on to it. EMPTY is a new empty LazyFrame each time. It isn't a pd.DataFrame subclass, so
+    code which checks isinstance(x, pd.DataFrame) should use frame() to get the dataframe itself.
+
+    >>> lf = LazyFrame(lambda: pd.DataFrame({'size': [10, -5]}), length=2)
+    >>> len(lf), lf.is_built()
+    (2, False)
+    >>> lf['size'].sum(), lf.is_built()
+    (5, True)
+    >>> len(LazyFrame.EMPTY), LazyFrame.EMPTY.empty
+    (0, True)
+    >>> (lf == 10)['size'].tolist(), (lf * 2)['size'].tolist(), (-lf)['size'].tolist()
+    ([True, False], [20, -10], [-10, 5])
+    >>> lf['price'] = 17.5
+    >>> list(lf.columns)
+    ['size', 'price']
+    >>> bool(lf)
+    Traceback (most recent call last):
+    ...
+    ValueError: The truth value of a DataFrame is ambiguous. Use a.empty, a.bool(), a.item(), a.any() or a.all().
+    """
+    def __init__(self, build, length=None):
+        self.__build = build
+        self.__length = length
+        self.__frame = None
+
+    def is_built(self):
+        return self.__frame is not None
+
+    def frame(self):
+        if self.__frame is None:
+            self.__frame = self.__build()
+        return self.__frame
+
+    @classmethod
+    def of_records(cls, records):
+        """A LazyFrame of HasDfDict :param records:, or EMPTY if there are none."""
+        if len(records) == 0:
+            return cls(pd.DataFrame, length=0)
+        return cls(lambda: pd.DataFrame([r.df_dict() for r in records]), length=len(records))
+
+    def __len__(self):
+        return self.__length if (self.__length is not None) else len(self.frame())
+
+    def __getattr__(self, name):
+        if name.startswith('_LazyFrame__'):  # Not set yet, e.g. while unpickling
+            raise AttributeError(name)
+        return getattr(self.frame(), name)
+
+    def __getitem__(self, key):
+        return self.frame()[key]
+
+    def __setitem__(self, key, value):
+        self.frame()[key] = value
+
+    def __delitem__(self, key):
+        del self.frame()[key]
+
+    def __iter__(self):
+        return iter(self.frame())
+
+    def __contains__(self, key):
+        return key in self.frame()
+
+    def __repr__(self):
+        return repr(self.frame())
+
+    def _repr_html_(self):
+        return self.frame()._repr_html_()
+
+    def __array__(self, dtype=None):
+        return np.asarray(self.frame(), dtype=dtype)
+
+
+def _forward_operator(name):
+    def operator(self, *args):
+        args = [a.frame() if isinstance(a, LazyFrame) else a for a in args]
+        return getattr(self.frame(), name)(*args)
+    operator.__name__ = name
+    return operator
+
+
+# Special methods are looked up on the class rather than through __getattr__, so they are forwarded explicitly
+for _name in ['eq', 'ne', 'lt', 'le', 'gt', 'ge', 'add', 'radd', 'sub', 'rsub', 'mul', 'rmul', 'truediv', 'rtruediv',
+              'floordiv', 'rfloordiv', 'mod', 'rmod', 'pow', 'rpow', 'and', 'rand', 'or', 'ror', 'xor', 'rxor',
+              'neg', 'pos', 'abs', 'invert', 'bool']:
+    setattr(LazyFrame, '__' + _name + '__', _forward_operator('__' + _name + '__'))
+del _name
+LazyFrame.__hash__ = None  # Like a dataframe
+
+class _NewEmptyLazyFrame:
+    """LazyFrame.EMPTY: a new empty LazyFrame on each access, so changes to one don't carry over to the next."""
+    def __get__(self, instance, owner):
+        return owner(pd.DataFrame, length=0)
+
+
+LazyFrame.EMPTY = _NewEmptyLazyFrame()
+
+
 class DataframeBuffer:
     def __init__(self):
         self.buffer = []
@@ -72,3 +451,6 @@ class DataframeBuffer:
             self.df = pd.concat([self.df] + self.buffer)
             self.buffer = []
         return self.df
+
+    def nbytes(self):
+        return frame_bytes(self.df) + sum(frame_bytes(df) for df in self.buffer)
@@ -4,16 +4,40 @@ import numpy as np
 import datetime
 import numbers
 import pytz
+import heapq
+import sys
+import bisect
 if __package__ is None or __package__ == '':
-    from _utils import DictableToDataframe, HasDfDict
+    from _utils import RecordBuffer, HasDfDict, FenwickTree, wall_clock_ns
 else:
-    from ._utils import DictableToDataframe, HasDfDict
+    from ._utils import RecordBuffer, HasDfDict, FenwickTree, wall_clock_ns
 
 
-__all__ = ['CostBasis', 'CapitalGainOrLoss', 'AssetAccounting', 'TradeableAsset', 'Trade']
+__all__ = ['CostBasis', 'CapitalGainOrLoss', 'AssetAccounting', 'PositionHistory', 'TradeableAsset', 'Trade', 'LOT_RELIEF_METHODS', 'LONG_TERM_HOLDING_PERIOD']
+
+# How cost basis is relieved when a position is (partially) closed:
+#   fifo - first in, first out (the IRS default)
+#   lifo - last in, first out
+#   hifo - highest cost first for long positions (lowest proceeds first when covering a short),
+#          i.e. the lot that realizes the smallest gain.
+LOT_RELIEF_METHODS = ['fifo', 'lifo', 'hifo']
+
+# Gains on lots held for more than this are long term.
+LONG_TERM_HOLDING_PERIOD = pd.DateOffset(years=1)
+
+
+def _calendar_date(dt):
+    """The local calendar date of :param dt:, as a naive midnight timestamp. Holding periods count whole days."""
+    if dt is None:  # Undated (e.g. hand-made) trades
+        return dt
+    dt = pd.Timestamp(dt)
+    if dt.tz is not None:
+        dt = dt.tz_localize(None)
+    return dt.normalize()
 
 
 class CostBasis(namedtuple('CostBasis', ['price', 'size', 'symbol', 'date', 'commission_per_share', 'meta']), HasDfDict):
+    __slots__ = ()
     DICT_COLUMNS = ['price', 'size', 'symbol', 'date', 'commission_per_share']
     META_FIELDS = [('meta', '')]
 
@@ -28,24 +52,120 @@ class CostBasis(namedtuple('CostBasis', ['price', 'size', 'symbol', 'date', 'com
 
 
 class CapitalGainOrLoss(namedtuple('CapitalGainOrLoss', ['open_price', 'close_price', 'size', 'symbol', 'open_date', 'close_date', 'open_commission_per_share', 'close_commission_per_share', 'open_meta', 'close_meta']), HasDfDict):
+    __slots__ = ()
     DICT_COLUMNS = ['open_price', 'close_price', 'size', 'symbol', 'open_date', 'close_date', 'open_commission_per_share', 'close_commission_per_share']
     META_FIELDS = [('open_meta', 'open_'), ('close_meta', 'close_')]
 
     def cap_gain(self):
-        return (self.close_price - self.open_price - self.open_commission - self.close_commission) * self.size
+        return (self.close_price - self.open_price - self.open_commission_per_share - self.close_commission_per_share) * self.size
 
 
 class Trade(namedtuple('Trade', ['price', 'size', 'symbol', 'date', 'commission', 'meta']), HasDfDict):
+    __slots__ = ()
     DICT_COLUMNS = ['price', 'size', 'symbol', 'date', 'commission']
     META_FIELDS = [('meta', '')]
 
-    def with_commission(self, commission):  # The commission gets added later, by the broker
-        return Trade(self.price, self.size, self.symbol, self.date, commission, self.meta)
+    def with_commission(self, commission, meta=None):  # The commission gets added later, by the broker
+        return Trade(self.price, self.size, self.symbol, self.date, commission, self.meta if (meta is None) else meta)
 
     def cash_cost(self):
         return (self.price * self.size) + self.commission
 
 
+class PositionHistory:
+    """
+    A time-indexed history of the lots held, so that holdings can be looked up for any past time without
+    replaying the trades. AssetAccounting records a new version of a lot whenever it is opened, partially
+    closed, closed or split; each version is held from its start time until the next version's.
+
+    >>> history = PositionHistory()
+    >>> aa = AssetAccounting('acc', history=history)
+    >>> aa.record_trade(Trade(symbol='acc', price=10.0, size=5, commission=0, date=pd.Timestamp('2020-01-02 09:30'), meta={}))
+    >>> aa.record_trade(Trade(symbol='acc', price=11.0, size=-2, commission=0, date=pd.Timestamp('2020-01-03 16:00'), meta={}))
+    >>> aa.execute_split(2.0, pd.Timestamp('2020-01-06'))
+    >>> history.positions_at('2020-01-03')[['price', 'size', 'symbol']]
+       price  size symbol
+    0   10.0     5    acc
+    >>> history.positions_at('2020-01-06')[['price', 'size', 'symbol']]
+       price  size symbol
+    0    5.0   6.0    acc
+    >>> history.quantities(pd.to_datetime(['2020-01-01 00:00', '2020-01-03 00:00', '2020-01-03 16:00', '2020-01-06 00:00']))
+                         acc
+    2020-01-01 00:00:00  0.0
+    2020-01-03 00:00:00  5.0
+    2020-01-03 16:00:00  3.0
+    2020-01-06 00:00:00  6.0
+
+    Events are keyed by wall clock time. Lookups find the versions started by then in O(log n), and start
+    from a snapshot of the versions held at most CHECKPOINT_INTERVAL versions earlier, so a lookup costs
+    O(log n + holdings + CHECKPOINT_INTERVAL) however long the history is.
+    """
+    CHECKPOINT_INTERVAL = 256
+
+    def __init__(self):
+        self.__starts = []  # Wall clock epoch of each version, non-decreasing
+        self.__ends = []  # When each version stopped being held (None while it is)
+        self.__lots = []  # CostBasis of each version
+        self.__held = {}  # (symbol, lot id) -> index of its current version
+        self.__checkpoints = [[]]  # Checkpoint i lists the versions held when version i*CHECKPOINT_INTERVAL was recorded
+
+    def __len__(self):
+        return len(self.__lots)
+
+    def record(self, dt, symbol, lot_id, lot):
+        """Records that lot :param lot_id: of :param symbol: became :param lot: (a CostBasis, or None if closed) at :param dt:."""
+        time = wall_clock_ns(dt) if dt is not None else None
+        if len(self.__starts) > 0:  # Events recorded out of order are treated as happening at the latest time seen
+            time = self.__starts[-1] if (time is None) else max(time, self.__starts[-1])
+        elif time is None:
+            time = np.iinfo(np.int64).min
+        previous = self.__held.pop((symbol, lot_id), None)
+        if previous is not None:
+            self.__ends[previous] = time
+        if lot is not None:
+            if (len(self.__lots) % self.CHECKPOINT_INTERVAL == 0) and (len(self.__lots) > 0):
+                self.__checkpoints.append(list(self.__held.values()))
+            self.__held[(symbol, lot_id)] = len(self.__lots)
+            self.__starts.append(time)
+            self.__ends.append(None)
+            self.__lots.append(lot)
+
+    def __held_at(self, time):
+        n = bisect.bisect_right(self.__starts, time)
+        first = (n // self.CHECKPOINT_INTERVAL) * self.CHECKPOINT_INTERVAL
+        if (first == n) and (first > 0):  # Version n - 1 is the last one started, from the previous checkpoint
+            first -= self.CHECKPOINT_INTERVAL
+        candidates = self.__checkpoints[first // self.CHECKPOINT_INTERVAL] + list(range(first, n))
+        return [v for v in candidates if (self.__ends[v] is None) or (self.__ends[v] > time)]
+
+    def positions_at(self, dt):
+        """The lots held at :param dt: (after everything recorded at or before it), in the format of `Broker.positions()`."""
+        held = sorted(self.__held_at(wall_clock_ns(dt)))
+        return pd.DataFrame([self.__lots[v].df_dict() for v in held])
+
+    def quantities(self, dates):
+        """
+        A dates x symbols dataframe of the quantity held of each symbol at each of the (sorted) :param dates:,
+        built in one pass over the history.
+        """
+        dates = pd.DatetimeIndex(dates)
+        times = np.array([wall_clock_ns(dt) for dt in dates], dtype=np.int64)
+        if len(self.__lots) == 0:
+            return pd.DataFrame(index=dates)
+        (codes, symbols) = pd.factorize(np.array([lot.symbol for lot in self.__lots], dtype=object), sort=True)
+        sizes = np.array([lot.size for lot in self.__lots], dtype=float)
+        never = np.iinfo(np.int64).max
+        ends = np.array([never if (end is None) else end for end in self.__ends], dtype=np.int64)
+        # Each version adds its size from the first date at or after its start until the first date at or after its end
+        changes = np.zeros((len(dates) + 1, len(symbols)))
+        np.add.at(changes, (np.searchsorted(times, np.array(self.__starts, dtype=np.int64), side='left'), codes), sizes)
+        np.add.at(changes, (np.searchsorted(times, ends, side='left'), codes), -sizes)
+        return pd.DataFrame(np.cumsum(changes, axis=0)[:-1], index=dates, columns=symbols)
+
+    def nbytes(self):
+        return 8*(len(self.__starts) + len(self.__ends)) + sum(sys.getsizeof(lot) for lot in self.__lots) + 8*sum(len(c) for c in self.__checkpoints)
+
+
 class AssetAccounting:
     """
     This class handles the accounting for a single asset. You can buy the asset:
@@ -72,7 +192,7 @@ class AssetAccounting:
     0   10.0     5    foo  bar                   0.0
     1   11.1     5    foo  NaN                   0.2
 
-    Cap gains are handled in a FIFO manner.
+    Cap gains are handled in a FIFO manner by default.
 
     Since we have no capital gains at this point, none will be returned:
     >>> aa.capital_gains()
@@ -100,14 +220,54 @@ class AssetAccounting:
     >>> aa.capital_gains()
        close_commission_per_share close_date  close_price  open_commission_per_share open_date open_foo  open_price  size symbol
     0                         0.1       None         12.0                        0.0      None      bar        10.0     3    foo
-    0                         0.0       None         13.0                        0.1      None      bar        10.0     2    foo
+    0                         0.0       None         13.0                        0.0      None      bar        10.0     2    foo
     1                         0.0       None         13.0                        0.2      None      NaN        11.1     2    foo
+
+    Other lot relief methods (see LOT_RELIEF_METHODS) can be chosen. Each lot has an id, and lots are
+    indexed by a heap so closing a trade costs O(log lots) whichever method is used. With 'hifo', the
+    most expensive lot is sold first:
+
+    >>> aa = AssetAccounting("foo", lot_relief='hifo')
+    >>> for (price, day) in [(10.0, '2019-01-02'), (12.0, '2019-06-03'), (11.0, '2020-03-02')]:
+    ...     aa.record_trade(Trade(symbol='foo', price=price, size=5, commission=0, date=pd.Timestamp(day), meta={}))
+    >>> aa.record_trade(Trade(symbol='foo', price=13.0, size=-6, commission=0, date=pd.Timestamp('2020-04-01'), meta={}))
+    >>> aa.lots()[['lot_id', 'price', 'size', 'date']]
+       lot_id  price  size       date
+    0       0   10.0     5 2019-01-02
+    1       2   11.0     4 2020-03-02
+
+    Specific lots can also be relieved by id, falling back to the default method for any remainder:
+
+    >>> aa.record_trade(Trade(symbol='foo', price=13.0, size=-2, commission=0, date=pd.Timestamp('2020-04-02'), meta={}), lots=[0])
+    >>> aa.lots()[['lot_id', 'price', 'size']]
+       lot_id  price  size
+    0       0   10.0     3
+    1       2   11.0     4
+
+    The same index tracks how much of the position would be long term (held longer than
+    LONG_TERM_HOLDING_PERIOD) if sold on a given date:
+
+    >>> aa.quantity_by_term(pd.Timestamp('2020-04-03'))
+    (3, 4)
+
+    Selling on the anniversary of the purchase is still short term, even if it is later in the day:
+
+    >>> aa.quantity_by_term(pd.Timestamp('2021-03-02 16:00')), aa.quantity_by_term(pd.Timestamp('2021-03-03'))
+    ((3, 4), (7, 0))
     """
-    def __init__(self, symbol):
-        self.__owned = []
+    def __init__(self, symbol, meta_table=None, lot_relief='fifo', gain_callback=None, history=None):
+        assert lot_relief in LOT_RELIEF_METHODS, "Unknown lot relief method " + str(lot_relief)
+        self.__lots = {}  # Lot id -> CostBasis. Lot ids increase with acquisition time.
+        self.__heap = []  # (relief priority, lot id). Entries for closed lots are deleted lazily.
+        self.__next_lot_id = 0
+        self.__lot_sizes = FenwickTree()  # Indexed by lot id
+        self.__acquisition_dates = []  # Indexed by lot id
         self.__quantity = 0
         self.symbol = symbol
-        self.__capital_gains_or_losses = DictableToDataframe()
+        self.lot_relief = lot_relief
+        self.__capital_gains_or_losses = RecordBuffer(meta_table)
+        self.__gain_callback = gain_callback
+        self.__history = history  # A PositionHistory which is told about every change to a lot, if given
 
     def __str__(self):
         return "AssetAccounting(" + self.symbol + ", quantity="+str(self.quantity()) + ")"
@@ -117,18 +277,106 @@ class AssetAccounting:
 
     def owned(self):
         result = []
-        for o in self.__owned:
+        for o in self.__lots.values():
             result.append(o.df_dict())
-        return pd.DataFrame(result)#self.__owned.copy()
+        return pd.DataFrame(result)
+
+    def lots(self):
+        """Same as owned(), with a lot_id column identifying each lot for specific lot relief."""
+        result = self.owned()
+        if len(result) > 0:
+            result.insert(0, 'lot_id', list(self.__lots.keys()))
+        return result
 
     def capital_gains(self):
         return self.__capital_gains_or_losses.get()
 
-    def execute_split(self, splitFactor):
-        for i in range(len(self.__owned)):
-            self.__owned[i] = self.__owned[i].split(splitFactor)
-
-    def record_trade(self, trade):
+    def lot_count(self):
+        return len(self.__lots)
+
+    def nbytes(self):
+        """Approximate bytes used by the open lots, their indexes and the realized capital gains."""
+        lot_bytes = sum(sys.getsizeof(lot) for lot in self.__lots.values()) + sys.getsizeof(self.__lots)
+        index_bytes = sys.getsizeof(self.__heap) + 8*(len(self.__lot_sizes) + len(self.__acquisition_dates))
+        return lot_bytes + index_bytes + self.__capital_gains_or_losses.nbytes()
+
+    def check_lots(self, lots):
+        """Raises ValueError unless all of :param lots: (lot ids) are owned."""
+        for lot_id in lots:
+            if lot_id not in self.__lots:
+                raise ValueError("Lot " + str(lot_id) + " of " + self.symbol + " is not owned.")
+
+    def quantity_by_term(self, dt):
+        """
+        Returns (long term quantity, short term quantity) for the position if it were closed on :param dt:. A lot is
+        long term if it is sold after the anniversary of its acquisition date, whatever the times of day.
+        """
+        n = bisect.bisect_left(self.__acquisition_dates, _calendar_date(dt) - LONG_TERM_HOLDING_PERIOD)
+        long_term = self.__lot_sizes.prefix_sum(n)
+        return (long_term, self.__quantity - long_term)
+
+    def execute_split(self, splitFactor, dt=None):
+        for (lot_id, lot) in self.__lots.items():
+            split_lot = lot.split(splitFactor)
+            self.__lot_sizes.add(lot_id, split_lot.size - lot.size)
+            self.__lots[lot_id] = split_lot
+            self.__record_history(dt, lot_id, split_lot)
+        self.__quantity *= splitFactor
+        self.__rebuild_heap()  # Commissions are not split, so cost basis order can change
+
+    def __priority(self, lot_id, lot):
+        if self.lot_relief == 'fifo':
+            return lot_id
+        elif self.lot_relief == 'lifo':
+            return -lot_id
+        else:
+            cost = lot.cost_basis_per_share()
+            return (-cost if (lot.size > 0) else cost, lot_id)
+
+    def __rebuild_heap(self):
+        self.__heap = [(self.__priority(i, lot), i) for (i, lot) in self.__lots.items()]
+        heapq.heapify(self.__heap)
+
+    def __add_lot(self, lot):
+        lot_id = self.__next_lot_id
+        self.__next_lot_id += 1
+        self.__lots[lot_id] = lot
+        self.__lot_sizes.append(lot.size)
+        self.__acquisition_dates.append(_calendar_date(lot.date))
+        heapq.heappush(self.__heap, (self.__priority(lot_id, lot), lot_id))
+        self.__record_history(lot.date, lot_id, lot)
+
+    def __remove_lot(self, lot_id, dt=None):
+        lot = self.__lots.pop(lot_id)
+        self.__record_history(dt, lot_id, None)
+        self.__lot_sizes.add(lot_id, -lot.size)
+        if len(self.__heap) > 2*len(self.__lots) + 16:  # Too many lazily deleted entries
+            self.__rebuild_heap()
+
+    def __record_history(self, dt, lot_id, lot):
+        if self.__history is not None:
+            self.__history.record(dt, self.symbol, lot_id, lot)
+
+    def __next_lot(self, specific_lots):
+        while len(specific_lots) > 0:
+            lot_id = specific_lots[-1]
+            if lot_id in self.__lots:
+                return lot_id
+            specific_lots.pop()
+        while self.__heap[0][1] not in self.__lots:
+            heapq.heappop(self.__heap)
+        return self.__heap[0][1]
+
+    def __record_gain(self, gain):
+        self.__capital_gains_or_losses.append(gain)
+        if self.__gain_callback is not None:
+            self.__gain_callback(gain)
+
+    def record_trade(self, trade, lots=None):
+        """
+        Records a trade. If :param lots: is a list of lot ids, those lots are relieved first (in order),
+        before falling back to the lot relief method.
+        """
         assert (trade.symbol == self.symbol), trade.symbol + ' != ' + self.symbol
         price = float(trade.price)
         size = trade.size
@@ -136,34 +384,39 @@ class AssetAccounting:
         commission_per_share = abs(float(trade.commission / trade.size))
         assert (size != 0)
         assert isinstance(meta, dict)
+        specific_lots = []
+        if lots is not None:
+            self.check_lots(lots)
+            specific_lots = list(reversed(lots))
         self.__quantity += size
-        while (np.sign(size) != 0) and (len(self.__owned) > 0):
-            first = self.__owned[0]
-            if np.sign(first.size) == np.sign(size):
-                self.__owned.append(CostBasis(price, size, self.symbol, commission_per_share=commission_per_share, date=trade.date, meta=meta))
-                size = 0
+        while (np.sign(size) != 0) and (len(self.__lots) > 0):
+            lot_id = self.__next_lot(specific_lots)
+            first = self.__lots[lot_id]
+            if np.sign(first.size) == np.sign(size):  # All lots have the same sign, so this adds to the position
+                break
             elif abs(first.size) > abs(size):
-                self.__capital_gains_or_losses.append(CapitalGainOrLoss(first.price, price, -1*size, self.symbol,
-                                                                        open_date=first.date,
-                                                                        close_date=trade.date,
-                                                                        open_commission_per_share=first.commission_per_share,
-                                                                        close_commission_per_share=commission_per_share,
-                                                                        open_meta=first.meta, close_meta=meta))
-                self.__owned[0] = CostBasis(first.price, first.size + size, self.symbol, commission_per_share=commission_per_share, date=trade.date, meta=first.meta)
+                self.__record_gain(CapitalGainOrLoss(first.price, price, -1*size, self.symbol,
+                                                     open_date=first.date,
+                                                     close_date=trade.date,
+                                                     open_commission_per_share=first.commission_per_share,
+                                                     close_commission_per_share=commission_per_share,
+                                                     open_meta=first.meta, close_meta=meta))
+                self.__lots[lot_id] = first._replace(size=first.size + size)
+                self.__lot_sizes.add(lot_id, size)
+                self.__record_history(trade.date, lot_id, self.__lots[lot_id])
                 size = 0
             else:
-                self.__capital_gains_or_losses.append(CapitalGainOrLoss(first.price, price, first.size, self.symbol,
-                                                                        open_date=first.date,
-                                                                        close_date=trade.date,
-                                                                        open_commission_per_share=first.commission_per_share,
-                                                                        close_commission_per_share=commission_per_share,
-                                                                        open_meta=first.meta, close_meta=meta))
-                self.__owned.pop(0)
+                self.__record_gain(CapitalGainOrLoss(first.price, price, first.size, self.symbol,
+                                                     open_date=first.date,
+                                                     close_date=trade.date,
+                                                     open_commission_per_share=first.commission_per_share,
+                                                     close_commission_per_share=commission_per_share,
+                                                     open_meta=first.meta, close_meta=meta))
+                self.__remove_lot(lot_id, trade.date)
                 size += first.size
 
         if np.sign(size) != 0:
-            self.__owned.append(CostBasis(price, size, self.symbol, commission_per_share=commission_per_share, date=trade.date, meta=meta))
-
+            self.__add_lot(CostBasis(price, size, self.symbol, commission_per_share=commission_per_share, date=trade.date, meta=meta))
 
 if __name__=='__main__':
     import sys
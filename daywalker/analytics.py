@@ -0,0 +1,176 @@
+import math
+import pandas as pd
+import numpy as np
+if __package__ is None or __package__ == '':
+    from accounting import CapitalGainOrLoss
+else:
+    from .accounting import CapitalGainOrLoss
+
+
+__all__ = ['RunningStatistics', 'PerformanceTracker']
+
+
+class RunningStatistics:
+    """
+    Mean and variance accumulated one observation at a time (Welford's algorithm), in O(1) memory.
+
+    >>> rs = RunningStatistics()
+    >>> for x in [1.0, 2.0, 4.0]:
+    ...     rs.add(x)
+    >>> rs.count, rs.total, rs.mean
+    (3, 7.0, 2.3333333333333335)
+    >>> round(rs.std(), 6)
+    1.527525
+    """
+    __slots__ = ('count', 'total', 'mean', '_m2')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.mean = 0.0
+        self._m2 = 0.0
+
+    def add(self, x):
+        self.count += 1
+        self.total += x
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (x - self.mean)
+
+    def variance(self):
+        if self.count < 2:
+            return np.nan
+        return self._m2 / (self.count - 1)
+
+    def std(self):
+        return math.sqrt(self.variance()) if self.count >= 2 else np.nan
+
+    def sharpe(self, periods=1):
+        std = self.std()
+        if not (std > 0):
+            return np.nan
+        return self.mean / std * math.sqrt(periods)
+
+
+class PerformanceTracker:
+    """
+    Performance statistics which the broker updates as each fill, realized gain and daily valuation is recorded,
+    so that they are available without building the full history.
+
+    :param group_by: capital gains columns to accumulate P&L by: either a column of the gain itself (e.g. 'symbol'),
+    or a meta key of the opening or closing trade, e.g. 'open_trade_story_id' groups gains by the 'trade_story_id'
+    meta key of the opening trade (the same column `Broker.capital_gains()` would have). Other names raise ValueError.
+
+    >>> from daywalker.accounting import Trade
+    >>> pt = PerformanceTracker(group_by=['open_trade_story_id'])
+    >>> for (dt, equity) in [('2004-08-12', 10000.0), ('2004-08-13', 10100.0), ('2004-08-16', 9999.0), ('2004-08-17', 10200.0)]:
+    ...     pt.record_valuation(pd.Timestamp(dt), equity)
+    >>> pt.record_trade(Trade(price=17.5, size=10, symbol='acc', date=None, commission=1.0, meta={}))
+    >>> pt.record_gain(CapitalGainOrLoss(17.5, 18.5, 10, 'acc', None, None, 0.1, 0.1, {'trade_story_id': 'a'}, {}))
+    >>> pt.record_gain(CapitalGainOrLoss(20.0, 19.0, 5, 'xyz', None, None, 0.0, 0.0, {'trade_story_id': 'a'}, {}))
+    >>> pt.record_gain(CapitalGainOrLoss(10.0, 11.0, 3, 'acc', None, None, 0.0, 0.0, {'trade_story_id': 'b'}, {}))
+    >>> s = pt.summary()
+    >>> round(s['max_drawdown'], 4), s['turnover'], s['commissions'], round(s['realized_gain'], 2)
+    (-0.01, 175.0, 1.0, 6.0)
+    >>> pt.grouped_gains('open_trade_story_id').reset_index()
+      open_trade_story_id  count  total  mean       std
+    0                   a      2    3.0   1.5  9.192388
+    1                   b      1    3.0   3.0       NaN
+    >>> pt = PerformanceTracker(group_by=['symbol'])
+    >>> pt.record_gain(CapitalGainOrLoss(17.5, 18.5, 10, 'acc', None, None, 0.0, 0.0, {}, {}))
+    >>> pt.record_gain(CapitalGainOrLoss(20.0, 19.0, 5, 'xyz', None, None, 0.0, 0.0, {}, {}))
+    >>> list(pt.grouped_gains('symbol')['total'].items())
+    [('acc', 10.0), ('xyz', -5.0)]
+    >>> PerformanceTracker(group_by=['story'])
+    Traceback (most recent call last):
+    ...
+    ValueError: Can't group gains by 'story': expected a capital gains column or an open_/close_ meta key
+    """
+    def __init__(self, group_by=(), periods_per_year=252):
+        self.group_by = list(group_by)
+        self.periods_per_year = periods_per_year
+        self.returns = RunningStatistics()
+        self.gains = RunningStatistics()
+        self.equity = RunningStatistics()
+        self.__groups = {k: {} for k in self.group_by}
+        self.__group_keys = [(column, self.__group_key(column)) for column in self.group_by]
+        self.__last_equity = None
+        self.__peak = None
+        self.__max_drawdown = 0.0
+        self.__first_date = None
+        self.__last_date = None
+        self.turnover = 0.0
+        self.commissions = 0.0
+        self.fills = 0
+
+    def record_trade(self, trade):
+        self.fills += 1
+        self.turnover += abs(trade.price * trade.size)
+        self.commissions += trade.commission
+
+    @staticmethod
+    def __group_key(column):
+        """A function of a CapitalGainOrLoss giving its value of the capital gains :param column:."""
+        if column in CapitalGainOrLoss.DICT_COLUMNS:  # The gain's own columns take precedence over meta keys
+            return lambda gain: getattr(gain, column)
+        for (field, prefix) in CapitalGainOrLoss.META_FIELDS:
+            if column.startswith(prefix):
+                return lambda gain, field=field, key=column[len(prefix):]: getattr(gain, field).get(key)
+        raise ValueError("Can't group gains by " + repr(column) + ": expected a capital gains column or an open_/close_ meta key")
+
+    def record_gain(self, gain):
+        amount = gain.cap_gain()
+        self.gains.add(amount)
+        for (column, group_key) in self.__group_keys:
+            key = group_key(gain)
+            groups = self.__groups[column]
+            if key not in groups:
+                groups[key] = RunningStatistics()
+            groups[key].add(amount)
+
+    def record_valuation(self, dt, equity):
+        if self.__first_date is None:
+            self.__first_date = dt
+        self.__last_date = dt
+        self.equity.add(equity)
+        if (self.__last_equity is not None) and (self.__last_equity != 0):
+            self.returns.add(equity / self.__last_equity - 1)
+        self.__last_equity = equity
+        if (self.__peak is None) or (equity > self.__peak):
+            self.__peak = equity
+        if self.__peak > 0:
+            self.__max_drawdown = min(self.__max_drawdown, equity / self.__peak - 1)
+
+    def drawdown(self):
+        if (self.__peak is None) or (self.__peak <= 0):
+            return 0.0
+        return self.__last_equity / self.__peak - 1
+
+    def grouped_gains(self, column):
+        groups = self.__groups[column]
+        result = pd.DataFrame({
+            'count': [g.count for g in groups.values()],
+            'total': [g.total for g in groups.values()],
+            'mean': [g.mean for g in groups.values()],
+            'std': [g.std() for g in groups.values()],
+        }, index=pd.Index(list(groups.keys()), name=column))
+        return result
+
+    def summary(self):
+        return {
+            'start_date': self.__first_date,
+            'end_date': self.__last_date,
+            'final_equity': self.__last_equity,
+            'mean_return': self.returns.mean,
+            'return_std': self.returns.std(),
+            'sharpe': self.returns.sharpe(self.periods_per_year),
+            'max_drawdown': self.__max_drawdown,
+            'drawdown': self.drawdown(),
+            'fills': self.fills,
+            'turnover': self.turnover,
+            'turnover_ratio': (self.turnover / self.equity.mean) if (self.equity.mean != 0) else np.nan,
+            'commissions': self.commissions,
+            'realized_gain': self.gains.total,
+            'realized_gains_count': self.gains.count,
+            'trade_sharpe': self.gains.sharpe(),
+        }
@@ -1,15 +1,28 @@
 import pandas as pd
+import numpy as np
 from collections import namedtuple
 import pytz
 from functools import lru_cache
 if __package__ is None or __package__ == '':
-    from market_data import TradeableAsset
-    from accounting import AssetAccounting
-    from _utils import DictableToDataframe, DataframeBuffer
+    from market_data import TradeableAsset, SymbolIndex
+    from accounting import AssetAccounting, PositionHistory
+    from _utils import DictableToDataframe, DataframeBuffer, RecordBuffer, MetaTable, LazyFrame, wall_clock_ns, categorize, frame_bytes
+    from analytics import PerformanceTracker
+    from risk import ExposureTracker
+    from fills import pro_rata_fills
+    from orders import OrderBook
+    from universe import UniverseMetrics
+    from memoize import function_key
 else:
-    from .market_data import TradeableAsset
-    from .accounting import AssetAccounting
-    from ._utils import DictableToDataframe, DataframeBuffer
+    from .market_data import TradeableAsset, SymbolIndex
+    from .accounting import AssetAccounting, PositionHistory
+    from ._utils import DictableToDataframe, DataframeBuffer, RecordBuffer, MetaTable, LazyFrame, wall_clock_ns, categorize, frame_bytes
+    from .analytics import PerformanceTracker
+    from .risk import ExposureTracker
+    from .fills import pro_rata_fills
+    from .orders import OrderBook
+    from .universe import UniverseMetrics
+    from .memoize import function_key
 
 
 __all__ = ['Broker', 'BrokerInterface', 'Commission']
@@ -85,50 +98,127 @@ class Broker:
     >>> b.cash() == (old_cash + div['amount'][0])
     True
 
+    Performance statistics are accumulated as the broker records trades, gains and valuations (see
+    PerformanceTracker). Gains can be grouped by capital gains columns (e.g. 'symbol') or meta keys of the
+    opening/closing trade (e.g. 'open_trade_id') with :param group_gains_by:.
+
+    >>> b.performance().summary()['fills']
+    1
+
+    Exposure is tracked incrementally as trades fill and positions are marked, so orders can be checked
+    against RiskLimits (see daywalker.risk) in O(1). Orders which would breach the limits are rejected:
+
+    >>> from daywalker.risk import RiskLimits
+    >>> b3 = Broker(1000, {'acc': TradeableAsset('acc', prices)}, risk_limits=RiskLimits(max_concentration=0.25))
+    >>> b3.limit_on_open('acc', '2004-08-16', price=20, size=20, is_buy=True)  # Up to 40% of equity
+    >>> b3.limit_on_open('acc', '2004-08-16', price=20, size=10, is_buy=True)
+    Trade(price=17.54, size=10, symbol='acc', date=Timestamp('2004-08-16 09:30:00-0400', tz='America/New_York'), commission=0, meta={})
+
+    A batch of orders can be checked up front, as if each order filled after the ones before it:
+
+    >>> b3.check_orders(['acc', 'acc'], [2, 2], [20, 20], [True, True])
+    array([ True, False])
+
+    With a :param participation_rate:, fills are capped at that fraction of the auction's volume (684,700 shares
+    on 2004-08-16). A batch of orders shares the capped volume pro rata, and the remainders are recorded:
+
+    >>> b4 = Broker(10**6, {'acc': TradeableAsset('acc', prices)}, participation_rate=0.001)
+    >>> trades = b4.auction_orders('2004-08-16', 'open', ['acc', 'acc'], [20, 20], [1000, 500], [True, True])
+    >>> [t.size for t in trades]
+    [456, 228]
+    >>> b4.unfilled_orders()[['symbol', 'requested_size', 'filled_size', 'unfilled_size']]
+      symbol  requested_size  filled_size  unfilled_size
+    0    acc          1000.0        456.0          544.0
+    1    acc           500.0        228.0          272.0
     """
-    def __init__(self, initial_cash, assets={}, margin=0, allow_short=False, default_timezone=pytz.timezone('America/New_York')):
+    def __init__(self, initial_cash, assets={}, margin=0, allow_short=False, default_timezone=pytz.timezone('America/New_York'), lot_relief='fifo',
+                 group_gains_by=(), risk_limits=None, participation_rate=None, compact=False, deferred_valuation=False):
         self.__cash = initial_cash
         self.__cash_vs_time = []
+        self.__compact = compact
+        if compact:  # Cash and accounting stay float64; only the stored market data and results are compacted
+            assets = {k: v.compacted() for (k, v) in assets.items()}
         self.__assets = assets
         self.__margin = margin
 
         self.__allow_short = allow_short
         self.__trade_callback = lambda x: None
         self.__dividends = DataframeBuffer()
-        self.__trades = DictableToDataframe()
+        self.__meta_table = MetaTable()  # Identical meta dicts are stored once and shared by trades, lots and capital gains
+        self.__trades = RecordBuffer(self.__meta_table, categorical=compact)
 
-        self.__days_with_data = set()
+        # Symbols get integer ids and listing intervals, so daily work only touches the relevant symbols
+        self.__symbols = SymbolIndex()
         for k in self.__assets:
-            self.__days_with_data |= self.__assets[k].trading_days()
+            self.__symbols.add(k, self.__assets[k])
 
         self.__asset_accounting = {}
+        self.__position_history = PositionHistory()
         self.__capital_gains = DataframeBuffer()
+        self.__lot_relief = lot_relief
+        self.__performance = PerformanceTracker(group_by=group_gains_by)
+        self.__exposure = ExposureTracker(risk_limits)
+        self.__participation_rate = participation_rate
+        self.__unfilled_orders = DataframeBuffer()
+        self.__auction_volume_used = (None, {})  # ((day, kind), symbol -> shares filled) for the latest auction
+        self.__order_book = OrderBook()
+        self.__universe_metrics = {}  # Window -> UniverseMetrics, built on first use
 
         self.__default_timezone = default_timezone
 
         self.__asset_values = DictableToDataframe()
 
+        # With deferred valuation, each day only records which (cash, positions) state it ends in. The states are
+        # valued in bulk when strategy_values() or performance() is next asked for.
+        if deferred_valuation and (risk_limits is not None):
+            raise ValueError("deferred_valuation can't be combined with risk_limits, which need positions marked every day")
+        self.__deferred_valuation = deferred_valuation
+        self.__state_version = 0  # Bumped whenever cash or positions change
+        self.__states = []  # (version, cash, positions)
+        self.__unvalued_dates = []  # (date, index into self.__states)
+
     def strategy_values(self):
+        self.__value_deferred()
         return self.__asset_values.get()
 
+    def performance(self):
+        self.__value_deferred()
+        return self.__performance
+
+    def fill_count(self):
+        """The number of fills so far. Unlike performance(), this doesn't value deferred dates."""
+        return self.__performance.fills
+
+    def participation_rate(self):
+        return self.__participation_rate
+
+    def unfilled_orders(self):
+        """Orders (or the remainders of partially filled orders) which did not fill because of the participation cap, the limit price or the broker's checks."""
+        return self.__unfilled_orders.get()
+
+    def exposure(self):
+        return self.__exposure
+
     @lru_cache(maxsize=1024)
     def last_price(self, symbol, dt, is_open):
-        prices, open_price = self.historical_prices(symbol, dt, is_open)
-        if (open_price is None):
-            return prices['close'].values[-1]
-        else:
-            return open_price
+        return self.__assets[symbol].last_price(dt, is_open)
 
     def positions_marked_to_market(self, dt, is_open):
         pos = self.positions().copy()
         if (len(pos) > 0):
-            pos['current_value'] = pos['symbol'].apply(self.last_price, dt=dt, is_open=is_open)
+            symbols = pos['symbol'].unique()  # Look up prices and auction times once per symbol, not once per lot
+            pos['current_value'] = pos['symbol'].map({s: self.last_price(s, dt, is_open) for s in symbols})
             pos['market_value'] = pos['size'] * pos['current_value']
-            pos['mark_to_market_time'] = pos['symbol'].apply(lambda s: self.__assets[s].date_with_time_of_day(dt, is_open))
+            pos['mark_to_market_time'] = pos['symbol'].map({s: self.__assets[s].date_with_time_of_day(dt, is_open) for s in symbols})
 
         return pos
 
     def record_strategy_values(self, dt):
+        if self.__deferred_valuation:
+            if (len(self.__states) == 0) or (self.__states[-1][0] != self.__state_version):
+                self.__states.append((self.__state_version, self.cash(), self.positions()))
+            self.__unvalued_dates.append((dt, len(self.__states) - 1))
+            return
         result = {
             'date': dt,
             'cash': self.cash(),
@@ -138,36 +228,143 @@ class Broker:
 
         pos = self.positions().copy()
         if len(pos) > 0:
-            @lru_cache(maxsize=1024)
-            def __mark_to_market(symbol):
-                prices, _ = self.historical_prices(symbol, dt, False)
-                return prices['close'].values[-1]
-
-            pos['current_value'] = pos['symbol'].apply(__mark_to_market)
+            marks = self.__closing_marks(pos['symbol'].unique(), dt)
+            pos['current_value'] = pos['symbol'].map(marks)
             pos['market_value'] = pos['size'] * pos['current_value']
+            for (symbol, price) in marks.items():
+                self.__exposure.mark(symbol, price)
             result['long_equities'] = pos[pos['size'] > 0]['market_value'].sum()
             result['short_equities'] = pos[pos['size'] < 0]['market_value'].sum()
 
         self.__asset_values.append(result)
+        self.__performance.record_valuation(dt, result['cash'] + result['long_equities'] + result['short_equities'])
+
+    def __closing_marks(self, symbols, dt):
+        """
+        The closing price each of :param symbols: is marked at on :param dt:. Delisted symbols are worth their
+        final close, which is looked up for all of them at once.
+        """
+        symbols = np.asarray(symbols, dtype=object)
+        ids = np.array([self.__symbols.id_of(s) for s in symbols], dtype=np.int64)
+        delisted = self.__symbols.last_day(ids) < wall_clock_ns(dt)
+        marks = dict(zip(symbols[delisted].tolist(), self.__symbols.final_close(ids[delisted]).tolist()))
+        for symbol in symbols[~delisted]:
+            marks[symbol] = self.__assets[symbol].last_price(dt)
+        return marks
+
+    def fast_forward(self, days, record_dates):
+        """
+        Does what execute_dividends and execute_splits on each of :param days:, each followed by
+        record_strategy_values on the matching :param record_dates:, would do, for days on which the strategy
+        doesn't trade. Positions only change on corporate action days, so each stretch between them is valued
+        in one vectorized pass.
+        """
+        start = 0
+        for (i, dt) in enumerate(days):
+            if len(self.__owned_with_corporate_actions(dt)) > 0:
+                self.__record_stretch(record_dates[start:i])
+                self.execute_dividends(dt)
+                self.execute_splits(dt)
+                start = i
+        self.__record_stretch(record_dates[start:])
+
+    def __value_deferred(self):
+        """Values the dates recorded with deferred valuation, one vectorized pass per run of dates in the same state."""
+        if len(self.__unvalued_dates) == 0:
+            return
+        (dates, states) = zip(*self.__unvalued_dates)
+        self.__unvalued_dates = []
+        states = np.array(states)
+        starts = np.flatnonzero(np.concatenate([[True], states[1:] != states[:-1]]))
+        for (start, stop) in zip(starts, np.append(starts[1:], len(states))):
+            (_, cash, pos) = self.__states[states[start]]
+            self.__record_stretch(dates[start:stop], cash, pos, mark=(stop == len(states)))
+        self.__states = self.__states[-1:]
+
+    def __record_stretch(self, record_dates, cash=None, pos=None, mark=True):
+        """
+        record_strategy_values for each of :param record_dates:, while cash and positions stay the same (by
+        default, the current ones). The exposure is only marked with the closes of the last date if :param mark:.
+        """
+        if len(record_dates) == 0:
+            return
+        if self.__deferred_valuation and (cash is None):  # Keep the dates in order with the ones already deferred
+            for dt in record_dates:
+                self.record_strategy_values(dt)
+            return
+        if cash is None:
+            (cash, pos) = (self.cash(), self.positions())
+        long_equities = short_equities = [0] * len(record_dates)
+        if len(pos) > 0:
+            days = np.array([wall_clock_ns(dt) for dt in record_dates], dtype=np.int64)
+            symbols = pos['symbol'].unique()
+            ids = np.array([self.__symbols.id_of(s) for s in symbols], dtype=np.int64)
+            # One row of closing marks per symbol (see __closing_marks), then one row of market values per lot
+            marks = np.array([self.__assets[s].closes_before(days) for s in symbols], dtype=float)
+            delisted = self.__symbols.last_day(ids)[:, None] < days[None, :]
+            marks = np.where(delisted, self.__symbols.final_close(ids)[:, None], marks)
+            sizes = pos['size'].values
+            values = sizes[:, None] * marks[pd.Index(symbols).get_indexer(pos['symbol'])]
+            # Summed per date over contiguous rows, in the same order as record_strategy_values
+            long_equities = np.ascontiguousarray(values[sizes > 0].T).sum(axis=1)
+            short_equities = np.ascontiguousarray(values[sizes < 0].T).sum(axis=1)
+            if mark:
+                for (symbol, price) in zip(symbols, marks[:, -1]):
+                    self.__exposure.mark(symbol, price)
+        for (dt, long_value, short_value) in zip(record_dates, long_equities, short_equities):
+            self.__asset_values.append({'date': dt, 'cash': cash, 'long_equities': long_value, 'short_equities': short_value})
+            self.__performance.record_valuation(dt, cash + long_value + short_value)
+
+    def delisted_positions(self, dt):
+        """
+        The open lots in symbols whose price data ends before :param dt:, with the `delisting_date` (their last
+        day of data) and the `final_close` they are valued at.
+        """
+        pos = self.positions()
+        if len(pos) == 0:
+            return pos
+        symbols = pos['symbol'].unique()
+        ids = np.array([self.__symbols.id_of(s) for s in symbols], dtype=np.int64)
+        delisted = self.__symbols.delisted_before(ids, dt)
+        if len(delisted) == 0:
+            return pos.iloc[0:0]
+        names = self.__symbols.names(delisted)
+        result = pos[pos['symbol'].isin(names)].copy()
+        delisting_date = pd.Series(self.__symbols.last_day(delisted).astype('datetime64[ns]'), index=names)
+        result['delisting_date'] = result['symbol'].map(delisting_date)
+        result['final_close'] = result['symbol'].map(pd.Series(self.__symbols.final_close(delisted), index=names))
+        return result
 
     def __assets_owned(self):
         return self.__asset_accounting.keys()
 
+    def symbol_index(self):
+        return self.__symbols
+
     def __get_asset_accounting(self, symbol):
-        symbol = symbol.lower()
+        symbol = self.__symbols.normalize(symbol)
         if not (symbol in self.__asset_accounting):
-            self.__asset_accounting[symbol] = AssetAccounting(symbol)
+            self.__asset_accounting[symbol] = AssetAccounting(symbol, meta_table=self.__meta_table, lot_relief=self.__lot_relief, history=self.__position_history,
+                                                             gain_callback=self.__performance.record_gain)
         return self.__asset_accounting[symbol]
 
     def add_asset(self, symbol, asset):
-        if isinstance(asset, TradeableAsset):
-            self.__assets[symbol.lower()] = asset
-        else:  # Assume asset is a dataframe of prices
-            self.__assets[symbol.lower()] = TradeableAsset(symbol.lower(), asset)
-        self.__days_with_data |= self.__assets[symbol.lower()].trading_days()
+        symbol = self.__symbols.normalize(symbol)
+        if not isinstance(asset, TradeableAsset):  # Assume asset is a dataframe of prices
+            asset = TradeableAsset(symbol, asset, compact=self.__compact)
+        elif self.__compact:
+            asset = asset.compacted()
+        self.__assets[symbol] = asset
+        self.__symbols.add(symbol, asset)
+        self.__universe_metrics = {}
+
+    def add_assets(self, assets):
+        """Adds a dict of symbol -> TradeableAsset (or price dataframe) in bulk."""
+        for (symbol, asset) in assets.items():
+            self.add_asset(symbol, asset)
 
     def trading_day(self, dt):
-        return (dt in self.__days_with_data)
+        return self.__symbols.is_trading_day(dt)
 
     def _set_trade_callback(self, cb):
         self.__trade_callback = cb
@@ -183,13 +380,41 @@ class Broker:
         assert (symbol in self.__assets)
         return (size >= 0) or self.__allow_short
 
+    def equity(self):
+        """Cash plus the value of positions, as of the latest marks."""
+        return self.cash() + self.__exposure.net()
+
+    def allow_exposure(self, symbol, signed_size, price):
+        """Whether an order keeps the portfolio within the risk limits."""
+        return self.__exposure.allow_order(self.__symbols.normalize(symbol), signed_size, price, self.equity())
+
+    def check_orders(self, symbols, sizes, prices, is_buy):
+        """
+        Checks a batch of orders against the risk limits in one pass, returning a boolean array. Each order is
+        checked as if the allowed orders before it had filled at their limit prices.
+        """
+        signed_sizes = np.where(np.asarray(is_buy, dtype=bool), 1, -1) * np.asarray(sizes, dtype=float)
+        symbols = [self.__symbols.normalize(s) for s in symbols]
+        return self.__exposure.allow_orders(symbols, signed_sizes, prices, self.equity())
+
+    def has_corporate_actions(self, dt):
+        """Whether any owned symbol has a dividend or split on :param dt:."""
+        return len(self.__owned_with_corporate_actions(dt)) > 0
+
+    def __owned_with_corporate_actions(self, dt):
+        """
+        Owned symbols with a dividend or split on :param dt:, with their row of price data. Symbols which
+        aren't live on that day (or have no corporate action) are never looked at.
+        """
+        result = []
+        for symbol in self.__symbols.names(self.__symbols.corporate_actions(dt)):
+            if symbol in self.__asset_accounting:
+                result.append((symbol, self.__assets[symbol].row_of_day(dt)))
+        return result
+
     def execute_dividends(self, dt):
-        for symbol in self.__assets_owned():
-            try:
-                div = self.__assets[symbol].df['divCash'][dt]
-            except KeyError:
-                print("Skipping " + symbol + " -> " + str(dt))
-                continue  # This typically happens when the symbol either wasn't live at that time, or when it wasn't a trading day
+        for (symbol, row) in self.__owned_with_corporate_actions(dt):
+            div = self.__assets[symbol].df['divCash'].values[row]
             if (div == 0):
                 continue
             owned = self.__get_asset_accounting(symbol).owned()
@@ -203,22 +428,40 @@ class Broker:
             owned['ex_date'] = dt
             del owned['commission_per_share']
             self.__cash += owned['amount'].sum()
+            self.__state_version += 1
             self.__dividends.append(owned)
 
     def execute_splits(self, dt):
-        for symbol in self.__assets_owned():
-            try:
-                splitFactor = self.__assets[symbol].df['splitFactor'][dt]
-            except KeyError:
-                print("Skipping " + symbol + " -> " + str(dt))
-                continue  # This typically happens when the symbol either wasn't live at that time, or when it wasn't a trading day
+        for (symbol, row) in self.__owned_with_corporate_actions(dt):
+            splitFactor = self.__assets[symbol].df['splitFactor'].values[row]
             if splitFactor == 1.0:
                 continue
-            self.__get_asset_accounting(symbol).execute_split(splitFactor)
+            self.__get_asset_accounting(symbol).execute_split(splitFactor, dt)
+            self.__state_version += 1
+            self.__exposure.split(symbol, splitFactor)
 
     def historical_prices(self, symbol, dt, after_open):
         return self.__assets[symbol].get_censored(dt, after_open)
 
+    def adjusted_prices(self, symbol, dt, after_open, window=None, dividends=True):
+        return self.__assets[self.__symbols.normalize(symbol)].get_adjusted(dt, after_open, window=window, dividends=dividends)
+
+    def indicator(self, symbol, dt, name, **params):
+        return self.__assets[self.__symbols.normalize(symbol)].indicator(dt, name, **params)
+
+    def universe_metrics(self, window=20):
+        """The UniverseMetrics of all the broker's assets, with dollar volume averaged over :param window: days."""
+        if window not in self.__universe_metrics:
+            self.__universe_metrics[window] = UniverseMetrics(self.__assets, window=window, compact=self.__compact)
+        return self.__universe_metrics[window]
+
+    def universe(self, dt, top=None, min_price=None, min_history=None, window=20):
+        """The symbols eligible to trade on :param dt:, most liquid first. See UniverseMetrics.select."""
+        return self.universe_metrics(window).select(dt, top=top, min_price=min_price, min_history=min_history)
+
+    def history_fingerprint(self, symbol, dt):
+        return self.__assets[self.__symbols.normalize(symbol)].history_fingerprint(dt)
+
     def dividends(self):
         return self.__dividends.get()
 
@@ -226,7 +469,7 @@ class Broker:
         return 0
 
     def __update_asset_owned(self, symbol):
-        symbol = symbol.lower()
+        symbol = self.__symbols.normalize(symbol)
         aa = self.__get_asset_accounting(symbol)
         if aa.quantity() == 0:
             self.__capital_gains.append(aa.capital_gains())
@@ -242,20 +485,166 @@ class Broker:
         else:
             return pd.DataFrame()
 
-    def limit_on_open(self, symbol, dt, price, size, is_buy, meta={}):
-        t = self.__limit_on_auction(symbol, dt, price, size, is_buy, meta=meta, kind='open')
+    def lot_counts(self):
+        """The number of open lots of each symbol which has had a position."""
+        return pd.Series({symbol: a.lot_count() for (symbol, a) in self.__asset_accounting.items()}, dtype='int64')
+
+    def positions_at(self, dt):
+        """The lots held at :param dt: (after the fills and splits at or before it), like positions() was then."""
+        return self.__position_history.positions_at(dt)
+
+    def position_history(self):
+        """The PositionHistory of every lot held, e.g. `position_history().quantities(dates)` for a dates x symbols matrix."""
+        return self.__position_history
+
+    def lots(self, symbol):
+        """The open lots of :param symbol:, with the lot ids that can be passed as `lots` to specify which lots an order closes."""
+        symbol = self.__symbols.normalize(symbol)
+        if symbol not in self.__asset_accounting:
+            return pd.DataFrame()
+        return self.__asset_accounting[symbol].lots()
+
+    def limit_on_open(self, symbol, dt, price, size, is_buy, meta={}, lots=None):
+        if self.__participation_rate is not None:
+            return self.auction_orders(dt, 'open', [symbol], [price], [size], [is_buy], metas=[meta], lots=[lots])[0]
+        t = self.__limit_on_auction(symbol, dt, price, size, is_buy, meta=meta, kind='open', lots=lots)
         if t:
             self.__update_asset_owned(symbol)
         return t
 
-    def limit_on_close(self, symbol, dt, price, size, is_buy, meta={}):
-        t = self.__limit_on_auction(symbol, dt, price, size, is_buy, meta=meta, kind='close')
+    def limit_on_close(self, symbol, dt, price, size, is_buy, meta={}, lots=None):
+        if self.__participation_rate is not None:
+            return self.auction_orders(dt, 'close', [symbol], [price], [size], [is_buy], metas=[meta], lots=[lots])[0]
+        t = self.__limit_on_auction(symbol, dt, price, size, is_buy, meta=meta, kind='close', lots=lots)
         if t:
             self.__update_asset_owned(symbol)
         return t
 
-    def __limit_on_auction(self, symbol, dt, price, size, is_buy, meta={}, kind=None):
-        symbol = symbol.lower()
+    def auction_orders(self, dt, kind, symbols, prices, sizes, is_buy, metas=None, lots=None):
+        """
+        Executes a batch of limit orders in the :param kind: ('open' or 'close') auction on :param dt:, returning
+        the trade (or None) for each order.
+
+        If the broker has a participation_rate, the shares filled in each symbol's auction are capped at that
+        fraction of the day's volume, and allocated pro rata across all the marketable orders (buys and sells)
+        for the symbol. Every unfilled remainder is recorded, with the size requested, in unfilled_orders(); the
+        orders' meta is left as it is. Fills are then executed in order, subject to the usual checks. If an auction
+        gets several batches (e.g. the strategy's orders and then resting orders), the later batches only get the
+        volume the earlier ones left.
+        """
+        n = len(symbols)
+        symbols = [self.__symbols.normalize(s) for s in symbols]
+        metas = metas if (metas is not None) else [{}]*n
+        lots = lots if (lots is not None) else [None]*n
+        is_buy = np.asarray(is_buy, dtype=bool)
+        requested = np.asarray(sizes, dtype=float)
+
+        (unique_symbols, groups) = np.unique(np.array(symbols, dtype=object), return_inverse=True)
+        auction_price = np.empty(len(unique_symbols))
+        volume = np.empty(len(unique_symbols))
+        for (i, symbol) in enumerate(unique_symbols):
+            (auction_price[i], volume[i]) = self.__assets[symbol].auction(dt, kind)
+        limit = np.asarray(prices, dtype=float)
+        marketable = np.where(is_buy, auction_price[groups] <= limit, auction_price[groups] >= limit)
+        if self.__participation_rate is None:
+            capacity = np.full(len(unique_symbols), np.inf)
+        else:
+            auction = (wall_clock_ns(dt), kind)
+            if self.__auction_volume_used[0] != auction:
+                self.__auction_volume_used = (auction, {})
+            used = self.__auction_volume_used[1]
+            capacity = np.floor(self.__participation_rate * volume) - np.array([used.get(s, 0) for s in unique_symbols])
+            capacity = np.maximum(capacity, 0)
+        fills = pro_rata_fills(groups, np.where(marketable, requested, 0), capacity)
+
+        for i in range(n):  # Reject the whole batch before anything is filled
+            if lots[i] is not None:
+                self.__get_asset_accounting(symbols[i]).check_lots(lots[i])
+
+        trades = [None]*n
+        filled = np.zeros(n)
+        for i in np.flatnonzero(fills > 0):
+            size = int(fills[i]) if isinstance(sizes[i], (int, np.integer)) else fills[i]
+            t = self.__limit_on_auction(symbols[i], dt, prices[i], size, bool(is_buy[i]), meta=metas[i], kind=kind, lots=lots[i])
+            if t:
+                self.__update_asset_owned(symbols[i])
+                filled[i] = abs(t.size)
+                if self.__participation_rate is not None:
+                    used[symbols[i]] = used.get(symbols[i], 0) + filled[i]
+            trades[i] = t
+
+        unfilled = np.flatnonzero(filled < requested)
+        if len(unfilled) > 0:
+            self.__unfilled_orders.append(pd.DataFrame({
+                'symbol': [symbols[i] for i in unfilled],
+                'date': [self.__assets[symbols[i]].date_with_time_of_day(dt, kind == 'close') for i in unfilled],
+                'price': limit[unfilled],
+                'is_buy': is_buy[unfilled],
+                'requested_size': requested[unfilled],
+                'filled_size': filled[unfilled],
+                'unfilled_size': requested[unfilled] - filled[unfilled],
+            }))
+        return trades
+
+    def place_order(self, symbol, price, size, is_buy, kind='open', expires=None, meta={}, lots=None):
+        """
+        Places a good-till-cancelled limit order for the :param kind: ('open' or 'close') auction, which rests
+        in the order book until an auction crosses its limit (see match_resting_orders), it is cancelled, or the
+        date :param expires: (if given) has passed. Returns its order id.
+        """
+        symbol = self.__symbols.normalize(symbol)
+        if symbol not in self.__assets:
+            raise InvalidOrderException("Unknown symbol: %s" % symbol)
+        if kind not in ('open', 'close'):
+            raise InvalidOrderException("Orders are for the 'open' or 'close' auction, not %r" % kind)
+        return self.__order_book.add(symbol, kind, price, size, is_buy, expires=expires, meta=meta, lots=lots)
+
+    def cancel_order(self, order_id):
+        """Cancels a resting order, returning whether it was still resting."""
+        return self.__order_book.cancel(order_id) is not None
+
+    def replace_order(self, order_id, **changes):
+        """
+        Changes the price, size, expires, meta or lots of a resting order. It keeps its order id, but loses its
+        time priority. Returns whether it was still resting.
+        """
+        return self.__order_book.replace(order_id, **changes) is not None
+
+    def resting_orders(self):
+        return self.__order_book.orders()
+
+    def resting_order_count(self):
+        return len(self.__order_book)
+
+    def match_resting_orders(self, dt, kind):
+        """
+        Executes the resting orders which cross the :param kind: auction on :param dt:, after dropping expired
+        orders. Only the orders at the top of each symbol's book are looked at, so the work is proportional to
+        the number of crossing orders rather than the size of the book. The orders are executed as one batch
+        with auction_orders(); whatever doesn't fill (e.g. beyond the participation rate) stays in the book.
+        Returns the trades.
+        """
+        self.__order_book.expire(dt)
+        crossing = []
+        for symbol in self.__order_book.symbols(kind):
+            try:
+                (price, _) = self.__assets[symbol].auction(dt, kind)
+            except KeyError:  # Not a trading day for this symbol
+                continue
+            crossing.extend(self.__order_book.crossing(symbol, kind, price))
+        if len(crossing) == 0:
+            return []
+        trades = self.auction_orders(dt, kind, [o.symbol for o in crossing], [o.price for o in crossing],
+                                     [o.size for o in crossing], [o.is_buy for o in crossing],
+                                     metas=[o.meta for o in crossing], lots=[o.lots for o in crossing])
+        for (o, t) in zip(crossing, trades):
+            remaining = o.size - (abs(t.size) if t else 0)
+            if remaining > 0:
+                self.__order_book.requeue(o._replace(size=remaining))
+        return [t for t in trades if t]
+
+    def __limit_on_auction(self, symbol, dt, price, size, is_buy, meta={}, kind=None, lots=None):
+        symbol = self.__symbols.normalize(symbol)
         if is_buy:
             signed_size = size
         else:
@@ -263,6 +652,8 @@ class Broker:
 
         market_data = self.__assets[symbol]
         asset = self.__get_asset_accounting(symbol)
+        if lots is not None:  # Before anything (cash, exposure) changes
+            asset.check_lots(lots)
         final_position = asset.quantity() + signed_size
         if not self.allow_position(symbol, final_position):
             return None
@@ -272,24 +663,30 @@ class Broker:
             final_cash = self.cash() + price*size
         if not self.allow_margin(final_cash):
             return None
+        if not self.allow_exposure(symbol, signed_size, price):
+            return None
 
+        meta = self.__meta_table.intern(meta)
         if (kind == 'open'):
-            trade = market_data.limit_on_open(dt, price, size, is_buy, meta=meta)
+            trade = market_data.limit_on_open(dt, price, size, is_buy, meta=meta, copy_meta=False)
         elif (kind == 'close'):
-            trade = market_data.limit_on_close(dt, price, size, is_buy, meta=meta)
+            trade = market_data.limit_on_close(dt, price, size, is_buy, meta=meta, copy_meta=False)
         else:
             trade = None
         if trade:
             commission = self.commission(trade.price, trade.size, trade.size > 0)
             trade = trade.with_commission(commission)
             self.__cash -= trade.cash_cost()
-            self.__get_asset_accounting(symbol.lower()).record_trade(trade)
+            self.__state_version += 1
+            self.__exposure.record_fill(symbol, trade.size, trade.price)
+            asset.record_trade(trade, lots=lots)
             self.__append_trade(trade)
         return trade
 
     def __append_trade(self, trade):
         self.__trade_callback(trade)
         self.__trades.append(trade)
+        self.__performance.record_trade(trade)
 
     def cash(self):
         return self.__cash
@@ -304,8 +701,25 @@ class Broker:
         result.append(self.__capital_gains.get())
         result = pd.concat(result)
         result['gain'] = ((result['close_price'] - result['open_price'] - result['close_commission_per_share'] - result['open_commission_per_share'])*result['size'])
+        if self.__compact:
+            categorize(result)
         return result
 
+    def storage_bytes(self):
+        """
+        Approximate bytes used by each of the broker's stores: price data, the trade log, the accounting of open
+        positions (lots and their gains so far), capital gains of closed positions, dividends and the strategy
+        values (equity curve).
+        """
+        return pd.Series({
+            'prices': sum(frame_bytes(a.df) for a in self.__assets.values()),
+            'trades': self.__trades.nbytes(),
+            'accounting': sum(a.nbytes() for a in self.__asset_accounting.values()) + self.__position_history.nbytes(),
+            'capital_gains': self.__capital_gains.nbytes(),
+            'dividends': self.__dividends.nbytes(),
+            'strategy_values': self.__asset_values.nbytes() + sum(frame_bytes(pos) for (_, _, pos) in self.__states),
+        })
+
     def trades(self):
         return self.__trades.get()
 
@@ -365,6 +779,9 @@ class BrokerException(Exception):
 class InvalidOrderException(BrokerException):
     pass
 
+_MISSING = object()
+
+
 class BrokerInterface:
     """
     This class is a wrapper around your broker, which is exposed to the strategy.
@@ -399,59 +816,165 @@ class BrokerInterface:
     0         1.0 2004-08-17 09:30:00-04:00  17.35    10    acc      bar
     """
 
-    def __init__(self, broker, dt, after_open=False):
+    def __init__(self, broker, dt, after_open=False, feature_cache=None):
         self.__broker = broker
         self.__dt = dt
         self.__after_open = after_open
+        self.feature_cache = feature_cache
         self.__trades_to_report = []
+        self.__pending_orders = []
+        self.__positions = None
+        self.__positions_marked_to_market = None
         self.__broker._set_trade_callback(lambda t: self.__trades_to_report.append(t))
 
     def cash(self):
         return self.__broker.cash()
 
     def set_date(self, dt, after_open):
+        """
+        Moves to :param dt:, before or after the open. The positions are those at this point, but they're only
+        built when the strategy asks for them, or just before anything (an order, a split) could change them.
+        """
         self.__dt = dt
         self.__after_open = after_open
-        self.__positions = self.__broker.positions()
-        self.__positions_marked_to_market = self.__broker.positions_marked_to_market(self.__dt, self.__after_open)
+        self.__positions = None
+        self.__positions_marked_to_market = None
         if (after_open == False):  # Dividends/splits take effect before market open
+            if self.__broker.has_corporate_actions(self.__dt):
+                self.__snapshot_positions()
             self.__broker.execute_dividends(self.__dt)
             self.__broker.execute_splits(self.__dt)
 
+    def __snapshot_positions(self):
+        self.positions()
+        self.positions_marked_to_market()
+
     def positions(self):
+        if self.__positions is None:
+            self.__positions = self.__broker.positions()
         return self.__positions
 
     def get_unreported_items(self):
-        trades = self.__trades_to_report
-        trades = pd.DataFrame([t.df_dict() for t in trades])
+        """The trades since the last call, as a LazyFrame which only becomes a dataframe when it is used."""
+        trades = LazyFrame.of_records(self.__trades_to_report)
         self.__trades_to_report = []
         return trades
 
     def historical_prices(self, symbol):
         return self.__broker.historical_prices(symbol, self.__dt, self.__after_open)
 
+    def adjusted_prices(self, symbol, window=None, dividends=True):
+        """
+        Same as historical_prices, but adjusted for the splits (and dividends) known today, optionally only the
+        last :param window: bars. See TradeableAsset.get_adjusted.
+        """
+        return self.__broker.adjusted_prices(symbol, self.__dt, self.__after_open, window=window, dividends=dividends)
+
+    def indicator(self, symbol, name, **params):
+        """
+        A causal indicator of :param symbol:'s price history as of the last completed bar, e.g.
+        `indicator('acc', 'max', window=20)` or `indicator('acc', 'atr')`. See daywalker.indicators for the
+        indicators and their parameters. Indicators are computed once per asset, so each lookup is O(1).
+        """
+        return self.__broker.indicator(symbol, self.__dt, name, **params)
+
+    def universe(self, top=None, min_price=None, min_history=None, window=20):
+        """
+        The symbols to consider today, most liquid first: those which traded on the last market day, closing at
+        :param min_price: or more, with :param min_history: bars or more, and of these the :param top: by mean
+        dollar volume over :param window: days. This reads one row of matrices precomputed for all the symbols
+        (see daywalker.universe), rather than the price history of each.
+        """
+        return self.__broker.universe(self.__dt, top=top, min_price=min_price, min_history=min_history, window=window)
+
+    def universe_metrics(self, window=20):
+        """Today's row of the universe metrics (close, dollar volume, history and liquidity rank) by symbol."""
+        return self.__broker.universe_metrics(window).metrics(self.__dt)
+
+    def feature(self, function, symbol, **params):
+        """
+        Returns function(prices, **params), where prices is the price history of :param symbol: from
+        historical_prices(). With a feature_cache, the result is cached keyed by the function, the parameters
+        and a fingerprint of the history (see daywalker.memoize), so it is only computed once per distinct history.
+        """
+        if self.feature_cache is None:
+            return function(self.historical_prices(symbol)[0], **params)
+        key = ('prices', function_key(function), self.__broker.history_fingerprint(symbol, self.__dt), sorted(params.items()))
+        result = self.feature_cache.get(key, default=_MISSING)
+        if result is _MISSING:
+            result = function(self.historical_prices(symbol)[0], **params)
+            self.feature_cache.put(key, result)
+        return result
+
     def commission(self, trade):
         return self.broker.commission(trade)
 
     def commissions(self):
         return self.broker.commissions()
 
-    def limit_on_open(self, symbol, price, size, is_buy, meta={}):
+    def lots(self, symbol):
+        return self.__broker.lots(symbol)
+
+    def check_orders(self, symbols, sizes, prices, is_buy):
+        return self.__broker.check_orders(symbols, sizes, prices, is_buy)
+
+    def limit_on_open(self, symbol, price, size, is_buy, meta={}, lots=None):
         if (not self.__after_open):
-            self.__broker.limit_on_open(symbol, self.__dt, price, size, is_buy, meta)
+            self.__submit(symbol, price, size, is_buy, meta, lots)
         else:
             raise InvalidOrderException("The open has already passed. You must submit a limit_on_close order.")
 
-    def limit_on_close(self, symbol, price, size, is_buy, meta={}):
+    def limit_on_close(self, symbol, price, size, is_buy, meta={}, lots=None):
         if (self.__after_open):
-            self.__broker.limit_on_close(symbol, self.__dt, price, size, is_buy, meta)
+            self.__submit(symbol, price, size, is_buy, meta, lots)
         else:
             raise InvalidOrderException("You can't submit a limit_on_close order until after the open.")
 
+    def __submit(self, symbol, price, size, is_buy, meta, lots):
+        self.__snapshot_positions()
+        if self.__broker.participation_rate() is None:
+            if self.__after_open:
+                self.__broker.limit_on_close(symbol, self.__dt, price, size, is_buy, meta, lots=lots)
+            else:
+                self.__broker.limit_on_open(symbol, self.__dt, price, size, is_buy, meta, lots=lots)
+        else:  # Volume is shared between all the orders in an auction, so they are executed together
+            self.__pending_orders.append((symbol, price, size, is_buy, meta, lots))
+
+    def place_order(self, symbol, price, size, is_buy, kind=None, expires=None, meta={}, lots=None):
+        """
+        Places a good-till-cancelled limit order, which is matched against each auction until it fills, is
+        cancelled or expires (see Broker.place_order), and returns its order id. It is for the next auction
+        (open before the open, close after it) unless :param kind: says otherwise.
+        """
+        if kind is None:
+            kind = 'close' if self.__after_open else 'open'
+        return self.__broker.place_order(symbol, price, size, is_buy, kind=kind, expires=expires, meta=meta, lots=lots)
+
+    def cancel_order(self, order_id):
+        return self.__broker.cancel_order(order_id)
+
+    def replace_order(self, order_id, **changes):
+        return self.__broker.replace_order(order_id, **changes)
+
+    def resting_orders(self):
+        return self.__broker.resting_orders()
+
+    def execute_pending_orders(self):
+        """Sends the orders submitted since the last call to the broker's auction as one batch."""
+        if len(self.__pending_orders) == 0:
+            return
+        self.__snapshot_positions()
+        (symbols, prices, sizes, is_buy, metas, lots) = zip(*self.__pending_orders)
+        self.__pending_orders = []
+        kind = 'close' if self.__after_open else 'open'
+        self.__broker.auction_orders(self.__dt, kind, list(symbols), list(prices), list(sizes), list(is_buy), metas=list(metas), lots=list(lots))
+
     def last_price(self, symbol):
         return self.__broker.last_price(symbol, self.__dt, self.__after_open)
 
     def positions_marked_to_market(self):
+        if self.__positions_marked_to_market is None:
+            self.__positions_marked_to_market = self.__broker.positions_marked_to_market(self.__dt, self.__after_open)
         return self.__positions_marked_to_market
 
 
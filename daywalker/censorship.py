@@ -1,9 +1,32 @@
 import pandas as pd
+import numpy as np
 import pytz
 import datetime
+import os
+import bisect
+import threading
+from concurrent.futures import ThreadPoolExecutor
+if __package__ is None or __package__ == '':
+    from memoize import fingerprint, function_key
+    from _utils import frame_bytes
+else:
+    from .memoize import fingerprint, function_key
+    from ._utils import frame_bytes
 
 
-__all__ = ['CensoredView']
+__all__ = ['CensoredView', 'PartitionedCensoredView', 'BitemporalCensoredView']
+
+_MISSING = object()
+
+
+def _changes(values):
+    """Whether each value differs from the one before it (the first counts as a change unless it's empty)."""
+    result = []
+    previous = None
+    for v in values:
+        result.append((v != previous) and (v not in (None, 0)))
+        previous = v
+    return np.array(result, dtype=bool)
 
 
 class CensoredView:
@@ -13,22 +36,395 @@ class CensoredView:
         self.censor_on_index = censor_on_index
         self.censor_column = censor_column
         self.default_timezone = default_timezone
+        self.__last_localized = (None, None)
+        self.__keys = (None, None)
+        self.__hashes = (None, None)
+
+    def _localize(self, dt):
+        if isinstance(dt, pd.Timestamp) and (dt.tz is not None):
+            return dt
+        (last_dt, localized) = self.__last_localized  # The market asks for the same date repeatedly
+        if (last_dt is not None) and (last_dt is dt):
+            return localized
+        result = pd.to_datetime(dt)
+        if (result.tz is None):
+            result = result.replace(tzinfo=self.default_timezone)
+        self.__last_localized = (dt, result)
+        return result
+
+    def __sorted_keys(self, df):
+        """The censor dates of df as int64 epochs, if they are tz-aware and sorted, else None."""
+        (keys_df, keys) = self.__keys
+        if keys_df is df:
+            return keys
+        dates = df.index if self.censor_on_index else df[self.censor_column]
+        keys = None
+        if isinstance(dates.dtype, pd.DatetimeTZDtype) and dates.is_monotonic_increasing:
+            keys = dates.values.astype('datetime64[ns]').view('i8')
+        self.__keys = (df, keys)
+        return keys
+
+    def __prefix_length(self, df, dt):
+        """The number of rows of df revealed on dt, which are a prefix of it if its censor dates are sorted, else None."""
+        keys = self.__sorted_keys(df)
+        if keys is None:
+            return None
+        end = np.searchsorted(keys, dt.value, side='right')  # Binary search rather than a full scan
+        if self.censor_on_index:
+            # Everything strictly before the last index value <= dt
+            end = np.searchsorted(keys, keys[end - 1], side='left') if end > 0 else 0
+        return int(end)
+
+    def __prefix_hashes(self, df):
+        """Cumulative row hashes of df, so the hash of any prefix of it is a lookup."""
+        (hashes_df, hashes) = self.__hashes
+        if hashes_df is df:
+            return hashes
+        row_hashes = pd.util.hash_pandas_object(df, index=True).values
+        weights = (2 * np.arange(len(row_hashes), dtype=np.uint64) + np.uint64(1))  # Odd, so each row's position matters
+        hashes = np.concatenate([[np.uint64(0)], np.cumsum(row_hashes * weights, dtype=np.uint64)])
+        self.__hashes = (df, hashes)
+        return hashes
+
+    def _censor(self, df, dt):
+        end = self.__prefix_length(df, dt)
+        if end is not None:
+            return df.iloc[:end].copy()  # A copy, like the masks below, so callers can't write through to the data
+        if self.censor_on_index:
+            dt = df[df.index <= dt].index.max()
+            return df[df.index < dt]
+        else:
+            return df[df[self.censor_column] <= dt]
 
     def get_censored(self, dt):
-        dt = pd.to_datetime(dt)
-        if (dt.tz is None):
-            dt = dt.replace(tzinfo=self.default_timezone)
+        return self._censor(self.df, self._localize(dt))
+
+    def nbytes(self):
+        return frame_bytes(self.df)
+
+    def fingerprint(self, dt):
+        """
+        A fingerprint of get_censored(:param dt:), used to key cached features. When the censor dates are sorted
+        and tz-aware, the result is a prefix of the data, so this is O(log rows) from cumulative row hashes (built
+        on first use), as in TradeableAsset.history_fingerprint. Otherwise the result is hashed.
+        """
+        dt = self._localize(dt)
+        end = self.__prefix_length(self.df, dt)
+        if end is None:
+            return fingerprint(self.get_censored(dt))
+        return (end, int(self.__prefix_hashes(self.df)[end]))
+
+    def new_data_on(self, dates):
+        """
+        For each of the (sorted) :param dates:, whether get_censored reveals rows which it didn't on the previous date.
+        Vectorized when the censor dates are sorted and tz-aware.
+        """
+        dates = [self._localize(dt) for dt in dates]
+        keys = self.__sorted_keys(self.df)
+        if keys is not None:
+            end = np.searchsorted(keys, np.array([dt.value for dt in dates], dtype=np.int64), side='right')
+            if self.censor_on_index:
+                end = np.where(end > 0, np.searchsorted(keys, keys[np.maximum(end - 1, 0)], side='left'), 0)
+            return np.diff(np.concatenate([[0], end])) > 0
+        return _changes([len(self._censor(self.df, dt)) for dt in dates])
+
+
+class PartitionedCensoredView(CensoredView):
+    """
+    A censored view backed by date-partitioned files (one CSV or Parquet file per day/month/etc),
+    for data sets too large to hold in memory.
+
+    The partitions are either a dict mapping the first date covered by a partition to a file, or a
+    directory whose file names (minus extension) are parseable dates, e.g. `2004-08.csv` or `2004-08-12.parquet`.
+
+    >>> import tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> wsb = pd.DataFrame({'date': pd.date_range('2004-08-12', periods=5, freq='B', tz='America/New_York'),
+    ...                     'rating': [0, 1, 0, 1, 0]})
+    >>> for (n, chunk) in enumerate([wsb[0:2], wsb[2:4], wsb[4:]]):
+    ...     chunk.to_csv(os.path.join(directory, chunk['date'].min().strftime('%Y-%m-%d') + '.csv'), index=False)
+    >>> view = PartitionedCensoredView(directory, censor_on_index=False, censor_column='date', prefetch=1)
+
+    Only the partitions which started on or before the censor date are read, but the result is the same
+    as that of a plain `CensoredView`:
+
+    >>> view.get_censored('2004-08-16')[['date', 'rating']]
+                           date  rating
+    0 2004-08-12 00:00:00-04:00       0
+    1 2004-08-13 00:00:00-04:00       1
+    2 2004-08-16 00:00:00-04:00       0
+    >>> view.loaded_partitions()
+    [Timestamp('2004-08-12 00:00:00-0400', tz='America/New_York'), Timestamp('2004-08-16 00:00:00-0400', tz='America/New_York')]
+    >>> view.close()
+
+    The next partition is read in the background by a thread pool, so it is usually ready by the time
+    the market reaches it. If a `lookback` is given, partitions which lie entirely before
+    `dt - lookback` are evicted and rows older than that are not returned:
+
+    >>> view = PartitionedCensoredView(directory, censor_on_index=False, censor_column='date', lookback=pd.Timedelta(days=2))
+    >>> view.get_censored('2004-08-18')[['date', 'rating']]
+                           date  rating
+    0 2004-08-16 00:00:00-04:00       0
+    1 2004-08-17 00:00:00-04:00       1
+    2 2004-08-18 00:00:00-04:00       0
+    >>> view.loaded_partitions()
+    [Timestamp('2004-08-16 00:00:00-0400', tz='America/New_York'), Timestamp('2004-08-18 00:00:00-0400', tz='America/New_York')]
+    >>> view.close()
+
+    Before the first partition, the result is empty but has the data's columns:
+
+    >>> view = PartitionedCensoredView(directory, censor_on_index=False, censor_column='date')
+    >>> list(view.get_censored('2004-08-11').columns), len(view.get_censored('2004-08-11'))
+    (['date', 'rating'], 0)
+    >>> view.close()
+    """
+    def __init__(self, partitions, censor_on_index=True, censor_column=None, lookback=None, prefetch=2, max_workers=2,
+                 reader=None, default_timezone=pytz.timezone('America/New_York')):
+        CensoredView.__init__(self, None, censor_on_index=censor_on_index, censor_column=censor_column, default_timezone=default_timezone)
+        if isinstance(partitions, str):
+            partitions = self.partitions_from_directory(partitions)
+        partitions = {self._localize(k): v for (k, v) in partitions.items()}
+        self.__starts = sorted(partitions.keys())
+        self.__paths = [partitions[k] for k in self.__starts]
+        self.lookback = lookback
+        self.prefetch = prefetch
+        self.reader = reader if (reader is not None) else self.read_partition
+
+        self.__lock = threading.Lock()
+        self.__loaded = {}  # Partition number -> dataframe, for partitions read but not yet appended to self.df
+        self.__pending = {}  # Partition number -> future
+        self.__executor = None
+        if prefetch > 0:
+            self.__executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.__parts = []  # (partition number, number of rows) of the partitions in self.df, in order
+
+    @staticmethod
+    def partitions_from_directory(directory):
+        result = {}
+        for filename in os.listdir(directory):
+            (stem, ext) = os.path.splitext(filename)
+            if ext.lower() not in ('.csv', '.parquet', '.pq'):
+                continue
+            result[pd.Timestamp(stem)] = os.path.join(directory, filename)
+        return result
+
+    def __fix_dates(self, dates):
+        dates = pd.to_datetime(dates, utc=True)
+        if isinstance(dates, pd.Series):
+            return dates.dt.tz_convert(self.default_timezone)
+        return dates.tz_convert(self.default_timezone)
+
+    def read_partition(self, path):
+        if path.lower().endswith('.csv'):
+            df = pd.read_csv(path, index_col=(0 if self.censor_on_index else None))
+        else:
+            df = pd.read_parquet(path)
         if self.censor_on_index:
-            dt = self.df[self.df.index <= dt].index.max()
-            return self.df[self.df.index < dt]
+            df.index = self.__fix_dates(df.index)
         else:
-            return self.df[self.df[self.censor_column] <= dt]
+            df[self.censor_column] = self.__fix_dates(df[self.censor_column])
+        return df
+
+    def __load(self, i):
+        with self.__lock:
+            if i in self.__loaded:
+                return self.__loaded[i]
+            future = self.__pending.pop(i, None)
+        df = future.result() if (future is not None) else self.reader(self.__paths[i])
+        with self.__lock:
+            self.__loaded[i] = df
+        return df
+
+    def __schedule_prefetch(self, last):
+        if self.__executor is None:
+            return
+        with self.__lock:
+            for i in range(last + 1, min(last + 1 + self.prefetch, len(self.__paths))):
+                if (i not in self.__loaded) and (i not in self.__pending) and ((len(self.__parts) == 0) or (i > self.__parts[-1][0])):
+                    self.__pending[i] = self.__executor.submit(self.reader, self.__paths[i])
+
+    def __first_needed(self, dt):
+        if self.lookback is None:
+            return 0
+        # Partition i covers [start_i, start_{i+1}), so it is needed iff start_{i+1} > dt - lookback.
+        return max(bisect.bisect_right(self.__starts, dt - self.lookback) - 1, 0)
+
+    def loaded_partitions(self):
+        with self.__lock:
+            return [self.__starts[i] for i in sorted(set(self.__loaded) | set(i for (i, _) in self.__parts))]
+
+    def prefetching_partitions(self):
+        with self.__lock:
+            return [self.__starts[i] for i in sorted(self.__pending)]
+
+    def nbytes(self):
+        """Bytes used by the visible partitions and those read ahead of time (prefetches in flight aren't counted)."""
+        with self.__lock:
+            loaded = list(self.__loaded.values())
+        return frame_bytes(self.df) + sum(frame_bytes(df) for df in loaded)
+
+    def fingerprint(self, dt):
+        dt = self._localize(dt)
+        if (self.lookback is not None) or (bisect.bisect_right(self.__starts, dt) == 0):
+            return fingerprint(self.get_censored(dt))  # At most a lookback's worth of rows (or none)
+        self.__update(dt)
+        return CensoredView.fingerprint(self, dt)
+
+    def get_censored(self, dt):
+        dt = self._localize(dt)
+        last = bisect.bisect_right(self.__starts, dt) - 1
+        if last < 0:  # Before the first partition, so nothing is revealed yet, but the columns are known
+            if len(self.__paths) == 0:
+                return pd.DataFrame()
+            if (len(self.__parts) > 0) and (self.__parts[0][0] == 0):
+                return self.df.iloc[:0].copy()
+            return self.__load(0).iloc[:0].copy()  # Kept until it's appended to self.df
+        self.__update(dt)
+        result = self._censor(self.df, dt)
+        if self.lookback is not None:
+            if self.censor_on_index:
+                result = result[result.index >= dt - self.lookback]
+            else:
+                result = result[result[self.censor_column] >= dt - self.lookback]
+        return result
+
+    def __update(self, dt):
+        """Loads the partitions visible on :param dt: (at or after its first partition) into self.df."""
+        last = bisect.bisect_right(self.__starts, dt) - 1
+        first = self.__first_needed(dt)
+        with self.__lock:
+            for i in [i for i in self.__loaded if i < first]:
+                del self.__loaded[i]
+            for i in [i for i in self.__pending if i < first]:  # Prefetched, but already behind the lookback
+                self.__pending.pop(i).cancel()
+        if (len(self.__parts) > 0) and ((self.__parts[0][0] > first) or (self.__parts[-1][0] > last)):
+            self.__parts = []  # Went back in time, so start over
+        evicted = [n for (i, n) in self.__parts if i < first]
+        if len(evicted) > 0:  # Copied, so the evicted rows are freed
+            self.df = self.df.iloc[sum(evicted):].copy()
+            if not self.censor_on_index:
+                self.df.reset_index(drop=True, inplace=True)
+            self.__parts = self.__parts[len(evicted):]
+        # Only the partitions which became visible are appended, and they are then only kept in self.df
+        start = (self.__parts[-1][0] + 1) if (len(self.__parts) > 0) else first
+        added = [(i, self.__load(i)) for i in range(start, last + 1)]
+        if len(added) > 0:
+            frames = ([self.df] if (len(self.__parts) > 0) else []) + [df for (_, df) in added]
+            self.df = pd.concat(frames, ignore_index=(not self.censor_on_index))
+            self.__parts += [(i, len(df)) for (i, df) in added]
+            with self.__lock:
+                for (i, _) in added:
+                    self.__loaded.pop(i, None)
+        self.__schedule_prefetch(last)
+
+    def new_data_on(self, dates):
+        """
+        For each of the (sorted) :param dates:, whether rows are revealed which weren't on the previous date. The
+        partitions are read one at a time and only their censor dates are kept, so the data set is never in
+        memory at once.
+        """
+        days = np.array([self._localize(dt).value for dt in dates], dtype=np.int64)
+        revealed = np.zeros(len(days) + 1, dtype=np.int64)  # Number of censor dates first revealed on each date
+        lowest = None
+        for i in range(len(self.__paths)):
+            df = self.reader(self.__paths[i])
+            keys = self.__fix_dates(df.index if self.censor_on_index else df[self.censor_column])
+            keys = np.asarray(keys.values.astype('datetime64[ns]').view('i8'))
+            del df
+            if self.censor_on_index:
+                # A row is revealed once a later index value is reached, so each distinct value reveals the one before it
+                keys = np.unique(keys)
+                if len(keys) > 0:
+                    lowest = keys[0] if lowest is None else min(lowest, keys[0])
+            np.add.at(revealed, np.searchsorted(days, keys, side='left'), 1)
+        if lowest is not None:  # The lowest index value reveals nothing
+            revealed[np.searchsorted(days, lowest, side='left')] -= 1
+        return revealed[:len(days)] > 0
+
+    def close(self):
+        if self.__executor is not None:
+            self.__executor.shutdown(wait=True)
+            self.__executor = None
+        with self.__lock:
+            self.__pending = {}
+
+
+class BitemporalCensoredView(CensoredView):
+    """
+    A censored view of data which gets revised, with a row per vintage: each row has the date of the
+    observation (:param observation_column:, or the index if None) and the date it became known
+    (:param knowledge_column:). get_censored returns, for each observation known by then, its latest revision.
+
+    >>> releases = pd.DataFrame({'month': pd.to_datetime(['2020-01-01', '2020-02-01', '2020-01-01', '2020-02-01']),
+    ...                          'released': pd.to_datetime(['2020-02-07', '2020-03-06', '2020-03-06', '2020-04-03']),
+    ...                          'unemployment': [3.6, 3.5, 3.5, 3.4]})
+    >>> view = BitemporalCensoredView(releases, observation_column='month', knowledge_column='released')
+    >>> view.get_censored('2020-03-01')[['month', 'unemployment']]
+           month  unemployment
+    0 2020-01-01           3.6
+    >>> view.get_censored('2020-03-06')[['month', 'unemployment']]  # January was revised when February came out
+           month  unemployment
+    2 2020-01-01           3.5
+    1 2020-02-01           3.5
+    >>> view.new_data_on(['2020-03-05', '2020-03-06', '2020-03-09'])
+    array([ True,  True, False])
+
+    Vintages are sorted by (observation, knowledge date) once, so each observation has a chain of revisions,
+    and a query finds the latest known revision of every chain with one binary search. Observations are also
+    indexed by when they were first known, so a query only looks at the ones in its result.
+    """
+    def __init__(self, df, observation_column=None, knowledge_column='knowledge_date', default_timezone=pytz.timezone('America/New_York')):
+        CensoredView.__init__(self, df, censor_on_index=False, censor_column=knowledge_column, default_timezone=default_timezone)
+        self.observation_column = observation_column
+        observations = self.__epochs(df.index if observation_column is None else df[observation_column])
+        knowledge = self.__epochs(df[knowledge_column])
+        order = np.lexsort((knowledge, observations))
+        self.__rows = order
+        knowledge = knowledge[order]
+        (_, group_start, group_sizes) = np.unique(observations[order], return_index=True, return_counts=True)
+        # The knowledge dates as dense ranks, offset per observation, so one searchsorted finds every chain's latest known revision
+        self.__known_times = np.unique(knowledge)
+        group = np.repeat(np.arange(len(group_start)), group_sizes)
+        self.__chain_keys = group * (len(self.__known_times) + 1) + np.searchsorted(self.__known_times, knowledge)
+        first_known = knowledge[group_start]
+        self.__known_order = np.argsort(first_known, kind='stable')
+        self.__first_known = first_known[self.__known_order]
+        self.__data_hash = None
+
+    def __epochs(self, dates):
+        dates = pd.DatetimeIndex(dates)
+        if dates.tz is None:
+            dates = dates.tz_localize(self.default_timezone)
+        return dates.asi8
+
+    def get_censored(self, dt):
+        dt = self._localize(dt).value
+        n_known = np.searchsorted(self.__known_times, dt, side='right')  # Rank of the first knowledge date after dt
+        # The observations first known by dt, back in observation order
+        groups = np.sort(self.__known_order[:np.searchsorted(self.__first_known, dt, side='right')])
+        latest = np.searchsorted(self.__chain_keys, groups * (len(self.__known_times) + 1) + n_known, side='left') - 1
+        return self.df.iloc[self.__rows[latest]]
+
+    def nbytes(self):
+        arrays = [self.__rows, self.__known_times, self.__chain_keys, self.__known_order, self.__first_known]
+        return frame_bytes(self.df) + sum(a.nbytes for a in arrays)
+
+    def fingerprint(self, dt):
+        # The result only depends on how many of the distinct knowledge dates are known by dt
+        if self.__data_hash is None:
+            self.__data_hash = fingerprint(self.df)
+        return (self.__data_hash, int(np.searchsorted(self.__known_times, self._localize(dt).value, side='right')))
+
+    def new_data_on(self, dates):
+        known = np.searchsorted(self.__known_times, [self._localize(dt).value for dt in dates], side='right')
+        return np.diff(np.concatenate([[0], known])) > 0
 
 
 class CensoredData:
-    def __init__(self):
+    def __init__(self, feature_cache=None):
         self.__data = {}
         self.__dt = None
+        self.feature_cache = feature_cache
 
     def add_data(self, name, data, censor_on_index=True, censor_column=None):
         if isinstance(data, CensoredView):
@@ -41,3 +437,27 @@ class CensoredData:
 
     def get_data(self, name):
         return self.__data[name].get_censored(self.__dt)
+
+    def nbytes(self):
+        """Bytes used by each data set."""
+        return pd.Series({name: view.nbytes() for (name, view) in self.__data.items()}, dtype='int64')
+
+    def new_data_on(self, name, dates):
+        """For each of :param dates:, whether data set :param name: has rows which weren't visible on the previous date."""
+        return self.__data[name].new_data_on(dates)
+
+    def feature(self, function, name, **params):
+        """
+        Returns function(data, **params), where data is get_data(:param name:), cached in the feature_cache
+        (if any) keyed by the function, the parameters and a fingerprint of the censored data (see
+        CensoredView.fingerprint), so a cache hit doesn't read the data.
+        """
+        if self.feature_cache is None:
+            return function(self.get_data(name), **params)
+        key = ('data', function_key(function), name, self.__data[name].fingerprint(self.__dt), sorted(params.items()))
+        result = self.feature_cache.get(key, default=_MISSING)
+        if result is _MISSING:
+            result = function(self.get_data(name), **params)
+            self.feature_cache.put(key, result)
+        return result
+
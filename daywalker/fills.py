@@ -0,0 +1,40 @@
+import numpy as np
+
+
+__all__ = ['pro_rata_fills']
+
+
+def pro_rata_fills(groups, sizes, capacity):
+    """
+    Allocates limited capacity (e.g. the shares available in an auction) across a batch of orders.
+
+    :param groups: the group (e.g. symbol) of each order, as integers in [0, len(capacity))
+    :param sizes: the (unsigned) size of each order; orders which shouldn't fill have size 0
+    :param capacity: the number of shares available to each group
+
+    Orders in a group whose total size fits within its capacity fill in full. Otherwise the capacity is
+    split pro rata in whole shares, with shares left over from rounding down going to the orders with the
+    largest fractional remainders (earlier orders win ties). Everything is computed for the whole batch at once.
+
+    >>> pro_rata_fills([0, 0, 0, 1], [100, 50, 50, 10], [101, 1000])
+    array([51., 25., 25., 10.])
+    """
+    groups = np.asarray(groups, dtype=np.int64)
+    sizes = np.asarray(sizes, dtype=float)
+    capacity = np.asarray(capacity, dtype=float)
+    n = len(sizes)
+    demand = np.bincount(groups, weights=sizes, minlength=len(capacity))
+    capped = demand > capacity
+    fraction = np.where(capped, capacity / np.where(demand > 0, demand, 1), 1.0)
+    exact = sizes * fraction[groups]
+    fills = np.where(capped[groups], np.floor(exact), sizes)
+
+    leftover = np.where(capped, np.floor(capacity) - np.bincount(groups, weights=fills, minlength=len(capacity)), 0)
+    if (leftover > 0).any():
+        remainder = np.where(capped[groups], exact - fills, 0)
+        order = np.lexsort((np.arange(n), -remainder, groups))  # By group, then largest remainder first
+        starts = np.searchsorted(groups[order], np.arange(len(capacity)))
+        rank = np.empty(n, dtype=np.int64)
+        rank[order] = np.arange(n) - starts[groups[order]]
+        fills += (rank < leftover[groups]) & (remainder > 0)
+    return fills
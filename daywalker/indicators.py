@@ -0,0 +1,78 @@
+import pandas as pd
+import numpy as np
+
+
+__all__ = ['compute_indicator', 'INDICATORS']
+
+
+def _window(series, window):
+    if window is None:
+        return series.expanding(min_periods=1)
+    return series.rolling(window, min_periods=window)
+
+
+def _max(df, column='close', window=None):
+    return _window(df[column], window).max()
+
+
+def _min(df, column='close', window=None):
+    return _window(df[column], window).min()
+
+
+def _mean(df, column='close', window=None):
+    return _window(df[column], window).mean()
+
+
+def _std(df, column='close', window=None):
+    return _window(df[column], window).std()
+
+
+def _ewma(df, column='close', span=20):
+    return df[column].ewm(span=span, adjust=False).mean()
+
+
+def _returns(df, column='close', periods=1):
+    return df[column] / df[column].shift(periods) - 1
+
+
+def _atr(df, window=14):
+    previous_close = df['close'].shift(1)
+    true_range = pd.concat([df['high'] - df['low'], (df['high'] - previous_close).abs(), (df['low'] - previous_close).abs()], axis=1).max(axis=1)
+    return true_range.ewm(alpha=1.0 / window, adjust=False, min_periods=window).mean()  # Wilder's smoothing
+
+
+# Name -> function(price dataframe, **params) returning a series aligned with the dataframe. Every function
+# must be causal: the value in a row may only depend on that row and the ones before it.
+INDICATORS = {
+    'max': _max,
+    'min': _min,
+    'mean': _mean,
+    'std': _std,
+    'ewma': _ewma,
+    'returns': _returns,
+    'atr': _atr,
+}
+
+
+def compute_indicator(df, name, **params):
+    """
+    Computes indicator :param name: (see INDICATORS) over the whole of a price dataframe in one vectorized pass,
+    returning a float array with a value for each row. The indicator in a row only uses bars up to that row.
+
+    - max, min, mean, std: of :param column: (default 'close'), over a rolling :param window: of bars, or
+      expanding if the window is None
+    - ewma: exponentially weighted mean of :param column: with the given :param span:
+    - returns: :param column: over :param periods: bars
+    - atr: average true range (from high, low and the previous close), with Wilder's smoothing over :param window:
+
+    >>> df = pd.DataFrame({'high': [11.0, 12.0, 12.5, 12.0], 'low': [9.0, 10.5, 11.0, 10.0], 'close': [10.0, 12.0, 11.0, 11.5]})
+    >>> compute_indicator(df, 'max')
+    array([10., 12., 12., 12.])
+    >>> compute_indicator(df, 'mean', window=2)
+    array([  nan, 11.  , 11.5 , 11.25])
+    >>> compute_indicator(df, 'atr', window=2)
+    array([  nan, 2.   , 1.75 , 1.875])
+    """
+    if name not in INDICATORS:
+        raise ValueError("Unknown indicator " + str(name) + ", expected one of " + ", ".join(INDICATORS))
+    return np.asarray(INDICATORS[name](df, **params), dtype=float)
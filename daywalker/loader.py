@@ -0,0 +1,149 @@
+import os
+import pickle
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+if __package__ is None or __package__ == '':
+    from market_data import TradeableAsset
+else:
+    from .market_data import TradeableAsset
+
+
+__all__ = ['load_prices', 'read_price_file']
+
+EXTENSIONS = ('.csv', '.parquet', '.pq')
+CACHE_FILENAME = 'daywalker_prices.pickle'
+
+
+def read_price_file(path):
+    """
+    Reads and validates a single price file (Tiingo style, with a `date` column and TradeableAsset.COLUMNS).
+    Returns (dataframe indexed by date, None) on success and (None, reason) if the file is invalid.
+    """
+    try:
+        if path.lower().endswith('.csv'):
+            df = pd.read_csv(path)
+        else:
+            df = pd.read_parquet(path)
+    except Exception as e:
+        return (None, "unreadable (" + str(e) + ")")
+    missing = [c for c in ['date'] + TradeableAsset.COLUMNS if c not in df.columns]
+    if len(missing) > 0:
+        return (None, "missing columns " + ", ".join(missing))
+    try:
+        dates = pd.to_datetime(df['date'])
+        if not pd.api.types.is_datetime64_any_dtype(dates):  # Mixed UTC offsets
+            dates = pd.to_datetime([pd.Timestamp(d).tz_localize(None) for d in dates])
+    except (ValueError, TypeError) as e:
+        return (None, "unparseable dates (" + str(e) + ")")
+    # Like TradeableAsset, keep only the calendar date, as written (no conversion between timezones)
+    if getattr(dates.dt, 'tz', None) is not None:
+        dates = dates.dt.tz_localize(None)
+    df['date'] = pd.Series(dates, index=df.index).dt.normalize()
+    if df['date'].duplicated().any():
+        return (None, "duplicate dates")
+    if not df['date'].is_monotonic_increasing:
+        return (None, "dates are not sorted")
+    return (df.set_index('date')[TradeableAsset.COLUMNS], None)
+
+
+def _read_price_files(paths):
+    return [read_price_file(p) for p in paths]
+
+
+def _chunks(items, n):
+    size = max(1, (len(items) + n - 1) // n)
+    return [items[i:i+size] for i in range(0, len(items), size)]
+
+
+def load_prices(directory, broker=None, processes=None, cache_dir=None, skip_invalid=False, compact=False):
+    """
+    Loads a directory of per-symbol price files (`<symbol>.csv` or `<symbol>.parquet`) into TradeableAssets.
+
+    Files are parsed and validated in a process pool. If :param cache_dir: is given, the parsed prices are
+    saved there, keyed by each file's modification time and size, so that later loads only parse files
+    that changed. If a :param broker: is passed, the assets are added to it in bulk. :param compact: builds
+    the assets in compact storage (see TradeableAsset).
+
+    >>> import tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> prices = pd.DataFrame({'date': ['2004-08-12', '2004-08-13'], 'open': [17.5, 17.5], 'high': [17.58, 17.51],
+    ...                        'low': [17.5, 17.5], 'close': [17.5, 17.51], 'volume': [2545100, 593000],
+    ...                        'divCash': [0.0, 0.0], 'splitFactor': [1.0, 1.0]})
+    >>> prices.to_csv(os.path.join(directory, 'ACC.csv'), index=False)
+    >>> prices[::-1].to_csv(os.path.join(directory, 'bad.csv'), index=False)
+    >>> assets = load_prices(directory, processes=1, cache_dir=directory, skip_invalid=True)
+    Skipping bad.csv: dates are not sorted
+    >>> sorted(assets.keys())
+    ['acc']
+    >>> assets['acc'].get_censored('2004-08-13', after_open=True)[1]
+    17.5
+    >>> list(assets['acc'].df.index.strftime('%Y-%m-%d'))
+    ['2004-08-12', '2004-08-13']
+
+    Tiingo's UTC midnight timestamps keep their calendar date too:
+
+    >>> prices.assign(date=['2004-08-12T00:00:00.000Z', '2004-08-13T00:00:00.000Z']).to_csv(os.path.join(directory, 'tiingo.csv'), index=False)
+    >>> (df, _) = read_price_file(os.path.join(directory, 'tiingo.csv'))
+    >>> list(df.index.strftime('%Y-%m-%d'))
+    ['2004-08-12', '2004-08-13']
+
+    The second time around, unchanged files come from the cache:
+
+    >>> assets = load_prices(directory, processes=1, cache_dir=directory, skip_invalid=True)
+    Skipping bad.csv: dates are not sorted
+    """
+    paths = sorted(os.path.join(directory, f) for f in os.listdir(directory) if os.path.splitext(f)[1].lower() in EXTENSIONS)
+
+    cache = {}
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = os.path.join(cache_dir, CACHE_FILENAME)
+        if os.path.exists(cache_path):
+            with open(cache_path, 'rb') as f:
+                cache = pickle.load(f)
+
+    results = {}
+    to_parse = []
+    for path in paths:
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+        cached = cache.get(path)
+        if (cached is not None) and (cached[0] == key):
+            results[path] = cached[1]
+        else:
+            to_parse.append((path, key))
+
+    if len(to_parse) > 0:
+        parse_paths = [p for (p, _) in to_parse]
+        if (processes == 1) or (len(parse_paths) == 1):
+            parsed = _read_price_files(parse_paths)
+        else:
+            processes = processes or os.cpu_count() or 1
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                parsed = [r for chunk in executor.map(_read_price_files, _chunks(parse_paths, 4*processes)) for r in chunk]
+        for ((path, key), result) in zip(to_parse, parsed):
+            results[path] = result
+            cache[path] = (key, result)
+        if cache_path is not None:
+            cache = {p: cache[p] for p in paths}  # Forget files which were deleted
+            with open(cache_path, 'wb') as f:
+                pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    assets = {}
+    errors = []
+    for path in paths:
+        (df, error) = results[path]
+        if error is not None:
+            errors.append(os.path.basename(path) + ": " + error)
+            continue
+        symbol = os.path.splitext(os.path.basename(path))[0].lower()
+        assets[symbol] = TradeableAsset(symbol, df, compact=compact)
+    if len(errors) > 0:
+        if not skip_invalid:
+            raise ValueError("Invalid price files: " + "; ".join(errors))
+        for e in errors:
+            print("Skipping " + e)
+
+    if broker is not None:
+        broker.add_assets(assets)
+    return assets
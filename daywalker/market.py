@@ -3,12 +3,15 @@ if __package__ is None or __package__ == '':
     from broker import Broker, BrokerInterface, InteractiveBrokers
     from strategy import Strategy
     from censorship import CensoredData
+    from _utils import DictableToDataframe
 else:
     from .market_data import TradeableAsset
     from .broker import Broker, BrokerInterface, InteractiveBrokers
     from .strategy import Strategy
     from .censorship import CensoredData
+    from ._utils import DictableToDataframe
 import pandas as pd
+import numpy as np
 import abc
 
 __all__ = ['Market']
@@ -116,8 +119,15 @@ class Market:
     >>> initial_cash = m.broker.cash() + (trades['price']*trades['size']).sum() + trades['commission'].sum() - div['amount'].sum()   # This should add up to 10000.0, but fuck floating point
     >>> abs(initial_cash - 10000) < 1e-6
     True
+
+    With `deferred_valuation`, the broker doesn't value the portfolio during the run, but values every day in
+    bulk when the strategy values are asked for, with the same results:
+    >>> deferred = InteractiveBrokers(10000, {'acc': ta}, deferred_valuation=True)
+    >>> Market(prices['date'].min(), prices['date'].max(), _TestStrategy('acc'), deferred).run()
+    >>> deferred.strategy_values().equals(m.broker.strategy_values())
+    True
     """
-    def __init__(self, start_date, end_date, strategy, broker, other_data=None):
+    def __init__(self, start_date, end_date, strategy, broker, other_data=None, feature_cache=None, memory_sample_every=None):
         self.start_date = start_date
         self.end_date = end_date
         self.strategy = strategy
@@ -128,6 +138,11 @@ class Market:
             self.other_data = other_data
         else:
             raise ValueError("other_data argument must be an instance of CensoredData. You passed in a " + str(type(other_data)))
+        self.feature_cache = feature_cache  # A daywalker.memoize.FeatureCache shared by the broker interface and other_data
+        if feature_cache is not None:
+            self.other_data.feature_cache = feature_cache
+        self.memory_sample_every = memory_sample_every  # Take a memory_report() every this many trading days during run()
+        self.__memory_samples = DictableToDataframe()
 
     def set_strategy(self, strategy):
         self.strategy = strategy
@@ -141,26 +156,103 @@ class Market:
     def strategy_log(self, name):
         return self.strategy.get_log(name)
 
-    def run(self):
+    def memory_report(self):
+        """
+        Approximate bytes used by each component of the backtest: the broker's stores (see Broker.storage_bytes),
+        the strategy's logs, the alternative data and the feature cache. See Broker.lot_counts for the lots
+        behind 'accounting', and memory_history for how the components grew during the run.
+        """
+        report = self.broker.storage_bytes()
+        report['strategy_logs'] = self.strategy.log_bytes()
+        report['other_data'] = self.other_data.nbytes().sum()
+        report['feature_cache'] = self.feature_cache.nbytes() if (self.feature_cache is not None) else 0
+        return report.astype('int64')
+
+    def memory_history(self):
+        """The memory reports (and the total number of open lots) sampled every memory_sample_every trading days."""
+        return self.__memory_samples.get()
+
+    def __sample_memory(self, dt):
+        sample = {'date': dt}
+        sample.update(self.memory_report().to_dict())
+        sample['lots'] = int(self.broker.lot_counts().sum())
+        self.__memory_samples.append(sample)
+
+    def __sample_due(self, first, last):
+        """Whether a memory sample falls due on one of the trading days numbered first to last - 1."""
+        every = self.memory_sample_every
+        return (every is not None) and ((last - 1) // every > (first - 1) // every)
+
+    def trading_days(self):
+        """The days from start_date to end_date on which any asset trades."""
+        days = []
         dt = self.start_date
-        bi = BrokerInterface(self.broker, dt, after_open=False)
         while (dt <= self.end_date):
-            if (not self.broker.trading_day(dt)):  # Some days are holidates, and there is no data present.
-                dt = dt + pd.offsets.BDay()
+            if self.broker.trading_day(dt):  # Some days are holidates, and there is no data present.
+                days.append(dt)
+            dt = dt + pd.offsets.BDay()
+        return days
+
+    def run(self):
+        days = self.trading_days()
+        schedule = self.strategy.schedule()
+        if schedule is None:
+            wake = np.ones(len(days), dtype=bool)
+        else:
+            wake = schedule.wake_days(days, self.other_data)
+        bi = BrokerInterface(self.broker, self.start_date, after_open=False, feature_cache=self.feature_cache)
+        watch_fills = (schedule is not None) and schedule.on_fill
+        i = 0
+        while (i < len(days)):
+            if not wake[i]:  # The strategy sleeps through to the next day it's scheduled on
+                j = i
+                while (j < len(days)) and (not wake[j]):
+                    j += 1
+                start = i
+                while (i < j) and (self.broker.resting_order_count() > 0):  # Resting orders can fill on any day
+                    if watch_fills:
+                        fills = self.broker.fill_count()
+                    self.__idle_day(days[i])
+                    i += 1
+                    if watch_fills and (self.broker.fill_count() > fills) and (i < len(days)):
+                        wake[i] = True
+                        j = i
+                if i < j:
+                    self.broker.fast_forward(days[i:j], [dt + pd.offsets.BDay() for dt in days[i:j]])
+                if self.__sample_due(start, j):
+                    self.__sample_memory(days[j - 1])
+                i = j
                 continue
+            dt = days[i]
+            if watch_fills:
+                fills = self.broker.fill_count()
             bi.set_date(dt, False)
             self.other_data.set_date(dt)
 
             trades = bi.get_unreported_items()
             self.strategy.pre_open(dt, bi, trades, self.other_data)
+            bi.execute_pending_orders()
+            self.broker.match_resting_orders(dt, 'open')
 
             bi.set_date(dt, True)
             trades = bi.get_unreported_items()
             self.strategy.pre_close(dt, bi, trades, self.other_data)
-            dt = dt + pd.offsets.BDay()
-            self.broker.record_strategy_values(dt)
-
+            bi.execute_pending_orders()
+            self.broker.match_resting_orders(dt, 'close')
+            self.broker.record_strategy_values(dt + pd.offsets.BDay())
+            if watch_fills and (self.broker.fill_count() > fills) and (i + 1 < len(days)):
+                wake[i + 1] = True
+            if self.__sample_due(i, i + 1):
+                self.__sample_memory(dt)
+            i += 1
 
+    def __idle_day(self, dt):
+        """A day the strategy sleeps through, but which resting orders can still trade on."""
+        self.broker.execute_dividends(dt)
+        self.broker.execute_splits(dt)
+        self.broker.match_resting_orders(dt, 'open')
+        self.broker.match_resting_orders(dt, 'close')
+        self.broker.record_strategy_values(dt + pd.offsets.BDay())
 
 if __name__ == '__main__':
     import sys
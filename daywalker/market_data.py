@@ -5,11 +5,13 @@ import datetime
 import numbers
 import pytz
 if __package__ is None or __package__ == '':
-    from _utils import DictableToDataframe, HasDfDict
+    from _utils import DictableToDataframe, HasDfDict, wall_clock_ns
     from accounting import Trade
+    from indicators import compute_indicator
 else:
-    from ._utils import DictableToDataframe, HasDfDict
+    from ._utils import DictableToDataframe, HasDfDict, wall_clock_ns
     from .accounting import Trade
+    from .indicators import compute_indicator
 
 
 class TradeableAsset:
@@ -74,13 +76,32 @@ class TradeableAsset:
 
     Note that when a trade is computed via this class, **it is not recorded anywhere.** This class
     just handles market data and the possibility of a trade.
+
+    Indicators (see daywalker.indicators) are computed once for the whole history, and looked up as of the last
+    bar before a date:
+
+    >>> ta.indicator('2004-08-16', 'max')  # The highest close of 2004-08-12 and 2004-08-13
+    17.51
+
+    For large universes, :param compact: stores open/high/low/close as float32 and volume as uint32 in units
+    of `volume_scale` shares, roughly halving the memory used. Dividends and split factors stay float64.
+    Prices leaving the asset (fills, marks) are rounded to PRICE_DECIMALS, which recovers the original
+    price whenever float32 can resolve it (prices below about $10,000 with at most 4 decimals).
+
+    >>> compact = TradeableAsset('acc', price_series, compact=True)
+    >>> compact.df.dtypes['close'], compact.df.dtypes['volume'], compact.volume_scale
+    (dtype('float32'), dtype('uint32'), 1)
+    >>> compact.limit_on_close('2004-08-13', price=10, size=5, is_buy=False).price
+    17.51
     """
 
     COLUMNS = ['open', 'high', 'low', 'close', 'volume', 'divCash', 'splitFactor']
+    COMPACT_PRICE_COLUMNS = ['open', 'high', 'low', 'close']
+    PRICE_DECIMALS = 4
 
     def __init__(self, symbol, df,
                  open_time=datetime.time(9,30,tzinfo=pytz.timezone('America/New_York')),
-                 close_time=datetime.time(16,0,tzinfo=pytz.timezone('America/New_York'))):
+                 close_time=datetime.time(16,0,tzinfo=pytz.timezone('America/New_York')), compact=False):
         """
         Note that the input DF will have the timezone stripped from it's timestamps.
 
@@ -91,28 +112,200 @@ class TradeableAsset:
         if 'date' in df.columns:
             self.df['date'] = pd.to_datetime(self.df['date'].dt.date)
             self.df = df.set_index('date')[self.COLUMNS]
+        if not self.df.index.is_monotonic_increasing:
+            self.df = self.df.sort_index()
+        self.compact = compact
+        self.volume_scale = 1
+        if compact:
+            self.__compact_columns()
         self.start_date = self.df.index.min()
         self.end_date = self.df.index.max()
         self.open_time = open_time
         self.close_time = close_time
 
+        # Days are keyed internally by integer epochs, and the auction times are computed once per row
+        # rather than once per order.
+        self.days = self.df.index.values.astype('datetime64[ns]').view('i8')
+        self.__row_of_day = dict(zip(self.days.tolist(), range(len(self.days))))
+        self.__prices = {'open': self.df['open'].values, 'close': self.df['close'].values}
+        self.__volume = self.df['volume'].values
+        self.__auction_times = {'open': self.__auction_times_of(open_time), 'close': self.__auction_times_of(close_time)}
+        self.__prefix_hashes = None
+        self.__adjustments = {}  # dividends -> (price, volume) cumulative adjustment factors
+        self.__indicators = {}
+
+    def __compact_columns(self):
+        df = self.df.copy()
+        for c in self.COMPACT_PRICE_COLUMNS:
+            df[c] = df[c].astype(np.float32)
+        volume = df['volume'].values.astype(float)
+        largest = np.nanmax(volume) if len(volume) > 0 else 0
+        while largest / self.volume_scale > np.iinfo(np.uint32).max:
+            self.volume_scale *= 10
+        df['volume'] = np.round(np.nan_to_num(volume) / self.volume_scale).astype(np.uint32)
+        self.df = df
+
+    def compacted(self):
+        """A copy of this asset in compact storage."""
+        if self.compact:
+            return self
+        return TradeableAsset(self.symbol, self.df, open_time=self.open_time, close_time=self.close_time, compact=True)
+
+    def exact_price(self, price):
+        """A price (or array of prices) read from self.df as float64. In compact mode, this undoes the float32 rounding."""
+        if self.compact:
+            if np.ndim(price) == 0:
+                return float(np.round(np.float64(price), self.PRICE_DECIMALS))
+            return np.round(np.asarray(price, dtype=np.float64), self.PRICE_DECIMALS)
+        return price
+
+    def closes_before(self, dts):
+        """
+        For each of :param dts: (int64 wall clock epochs), the last close of get_censored(dt), i.e. the close
+        of the second-to-last trading day on or before it. NaN if there is no such day.
+        """
+        rows = np.searchsorted(self.days, dts, side='right') - 2
+        closes = self.exact_price(self.df['close'].values)
+        return np.where(rows >= 0, np.asarray(closes, dtype=float)[np.maximum(rows, 0)], np.nan)
+
+    def __auction_times_of(self, time_of_day):
+        times = self.df.index + pd.Timedelta(hours=time_of_day.hour, minutes=time_of_day.minute)
+        if time_of_day.tzinfo is not None:
+            times = times.tz_localize(time_of_day.tzinfo)
+        return times
+
+    def row_of_day(self, dt):
+        """The row of :param dt: in self.df, or None if it isn't a trading day."""
+        return self.__row_of_day.get(wall_clock_ns(dt))
+
     def get_censored(self, dt, after_open=False):
-        dt = self.df[self.df.index <= dt].index.max()
+        """
+        Returns the price history strictly before the last trading day on or before :param dt: and, if
+        :param after_open:, that day's open price. The history is a copy, so strategies can modify it freely.
+        """
+        (censored, open_price) = self.__censored(dt, after_open)
+        return (censored.copy(), open_price)
 
-        censored = self.df[self.df.index < dt]
+    def last_price(self, dt, after_open=False):
+        """
+        The latest price known on :param dt:: the open if :param after_open:, else the last close of
+        get_censored(dt). Reads the price without copying the history.
+        """
+        (censored, open_price) = self.__censored(dt, after_open)
+        if after_open:
+            return open_price
+        return self.exact_price(censored['close'].values[-1])
+
+    def __censored(self, dt, after_open):
+        """get_censored, with the history as a slice of self.df rather than a copy."""
+        row = np.searchsorted(self.days, wall_clock_ns(dt), side='right') - 1
+        censored = self.df.iloc[:max(row, 0)]
         if after_open:
-            return (censored, self.df['open'][dt])
+            if row < 0:
+                raise KeyError(dt)
+            return (censored, self.exact_price(self.__prices['open'][row]))
         else:
             return (censored, None)
 
+    def __adjustment_factors(self, dividends):
+        """
+        Cumulative products of the price and volume adjustments of each row, computed once. Prices in row i
+        adjusted as of row r are multiplied by prices[r] / prices[i], and volumes by volumes[i] / volumes[r].
+        """
+        key = bool(dividends)
+        if key not in self.__adjustments:
+            split = self.df['splitFactor'].values.astype(float)
+            factor = 1.0 / split
+            if dividends and len(self.df) > 1:
+                # The dividend is per share after the ex-date's split, so compare it to the previous close in those shares
+                previous_close = np.asarray(self.exact_price(self.df['close'].values[:-1]), dtype=float) / split[1:]
+                factor[1:] *= 1 - self.df['divCash'].values[1:] / previous_close
+            self.__adjustments[key] = (np.cumprod(factor), np.cumprod(1.0 / split))
+        return self.__adjustments[key]
+
+    def get_adjusted(self, dt, after_open=False, window=None, dividends=True):
+        """
+        Same as get_censored, but with the history adjusted for the splits (and, if :param dividends:, the
+        dividends) known on :param dt:, i.e. those up to and including that day. Splits after :param dt:
+        aren't applied, so the history is what an adjusted price feed would have shown on the day.
+
+        Only the last :param window: rows are returned if it is given. The cumulative adjustments are computed
+        once, so each call only rescales the rows it returns.
+
+        >>> prices = pd.DataFrame({'date': pd.date_range('2004-08-12', periods=5, freq='B'),
+        ...                        'open': [10.0, 10.0, 10.0, 5.0, 5.0], 'high': 10.0, 'low': 5.0, 'close': [10.0, 10.0, 10.0, 5.0, 5.5],
+        ...                        'volume': 100, 'divCash': 0.0, 'splitFactor': [1.0, 1.0, 1.0, 2.0, 1.0]})
+        >>> ta = TradeableAsset('acc', prices)
+        >>> list(ta.get_adjusted('2004-08-16')[0]['close'])  # Before the split
+        [10.0, 10.0]
+        >>> history = ta.get_adjusted('2004-08-18', window=3)[0]
+        >>> list(history['close']), list(history['volume'])
+        ([5.0, 5.0, 5.0], [200.0, 200.0, 100.0])
+        """
+        row = np.searchsorted(self.days, wall_clock_ns(dt), side='right') - 1
+        (history, open_price) = self.__censored(dt, after_open)
+        end = len(history)
+        start = 0 if window is None else max(end - window, 0)
+        history = history.iloc[start:end].copy()
+        if end > 0:
+            (price_factors, volume_factors) = self.__adjustment_factors(dividends)
+            scale = price_factors[row] / price_factors[start:end]
+            for c in self.COMPACT_PRICE_COLUMNS:
+                history[c] = np.asarray(self.exact_price(history[c].values), dtype=float) * scale
+            history['volume'] = history['volume'].values * float(self.volume_scale) * (volume_factors[start:end] / volume_factors[row])
+        return (history, open_price)
+
+    def register_indicator(self, name, **params):
+        """Computes indicator :param name: (see daywalker.indicators) for every bar, once. Returns the array."""
+        key = (name, tuple(sorted(params.items())))
+        values = self.__indicators.get(key)
+        if values is None:
+            values = compute_indicator(self.df, name, **params)
+            self.__indicators[key] = values
+        return values
+
+    def indicator(self, dt, name, **params):
+        """
+        The value of an indicator as of the last bar of get_censored(:param dt:), i.e. the last completed bar before
+        :param dt:'s trading day, or NaN if there is none. The indicator is precomputed by register_indicator, so this
+        is a single index lookup, and since only bars before :param dt: are revealed it can't leak future data.
+        """
+        values = self.register_indicator(name, **params)
+        row = self.__row_of_day.get(wall_clock_ns(dt))
+        if row is None:
+            row = np.searchsorted(self.days, wall_clock_ns(dt), side='right') - 1
+        if row < 1:
+            return np.nan
+        return values[row - 1]
+
+    def history_fingerprint(self, dt):
+        """
+        A fingerprint of the price history returned by get_censored(:param dt:), computed in O(1) from
+        cumulative row hashes (built on first use). Used to key cached features.
+        """
+        if self.__prefix_hashes is None:
+            row_hashes = pd.util.hash_pandas_object(self.df, index=True).values
+            weights = (2 * np.arange(len(row_hashes), dtype=np.uint64) + np.uint64(1))  # Odd, so each row's position matters
+            self.__prefix_hashes = np.concatenate([[np.uint64(0)], np.cumsum(row_hashes * weights, dtype=np.uint64)])
+        row = np.searchsorted(self.days, wall_clock_ns(dt), side='right') - 1
+        n = max(row, 0)
+        return (self.symbol, n, int(self.__prefix_hashes[n]))
+
     def trading_days(self):
         return set(self.df.index)
 
-    def limit_on_open(self, dt, price, size, is_buy, *, meta={}):
-        return self.__handle_auction(dt, price, size, is_buy, 'open', meta, auction_time=self.open_time)
+    def auction(self, dt, kind):
+        """The price and volume of the :param kind: ('open' or 'close') auction on :param dt:. Raises KeyError if it isn't a trading day."""
+        row = self.__row_of_day.get(wall_clock_ns(dt))
+        if row is None:
+            raise KeyError(dt)
+        return (self.exact_price(self.__prices[kind][row]), self.__volume[row] * self.volume_scale)
 
-    def limit_on_close(self, dt, price, size, is_buy, *, meta={}):
-        return self.__handle_auction(dt, price, size, is_buy, 'close', meta, auction_time=self.close_time)
+    def limit_on_open(self, dt, price, size, is_buy, *, meta={}, copy_meta=True):
+        return self.__handle_auction(dt, price, size, is_buy, 'open', meta, copy_meta=copy_meta)
+
+    def limit_on_close(self, dt, price, size, is_buy, *, meta={}, copy_meta=True):
+        return self.__handle_auction(dt, price, size, is_buy, 'close', meta, copy_meta=copy_meta)
 
     def __copy_add_to_meta(self, meta, kv):
         meta = meta.copy()
@@ -121,25 +314,33 @@ class TradeableAsset:
         return meta
 
     def date_with_time_of_day(self, dt, after_open):
+        row = self.row_of_day(dt)
+        if row is not None:
+            return self.__auction_times['close' if after_open else 'open'][row]
         if after_open:
             return dt.replace(hour=self.close_time.hour, minute=self.close_time.minute, tzinfo=self.close_time.tzinfo)
         else:
             return dt.replace(hour=self.open_time.hour, minute=self.open_time.minute, tzinfo=self.open_time.tzinfo)
 
-    def __handle_auction(self, dt, price, size, is_buy, kind, meta={}, auction_time=None):
+    def __handle_auction(self, dt, price, size, is_buy, kind, meta={}, copy_meta=True):
         """
         This will return a trade that the market would execute.
 
         This class does NOT actually handle the trade itself.
+
+        The meta dict is copied unless :param copy_meta: is False, which callers that already
+        hold a private (e.g. interned) copy can use to avoid a per-order allocation.
         """
         assert isinstance(price, numbers.Number)
         assert isinstance(size, numbers.Number)
         assert (kind == 'close') or (kind == 'open')
-        if isinstance(dt, str):
-            dt = pd.Timestamp(dt)
-        dt_report = dt.replace(hour=auction_time.hour, minute=auction_time.minute, tzinfo=auction_time.tzinfo)
-        open_price = self.df[kind][dt]
-        meta = meta.copy()
+        row = self.__row_of_day.get(wall_clock_ns(dt))
+        if row is None:
+            raise KeyError(dt)
+        dt_report = self.__auction_times[kind][row]
+        open_price = self.exact_price(self.__prices[kind][row])
+        if copy_meta:
+            meta = meta.copy()
         if is_buy:
             if (open_price <= price):
                 t = Trade(open_price, size, self.symbol, dt_report, commission=0, meta=meta)
@@ -150,6 +351,144 @@ class TradeableAsset:
                 return t
 
 
+class SymbolIndex:
+    """
+    A registry of integer symbol ids for a universe of TradeableAssets, recording each symbol's listing interval
+    (its first and last day of data) and the days on which it pays a dividend or splits.
+
+    In a survivorship-free universe most symbols are dead on any given day, so the broker uses this to restrict
+    daily work to the symbols which are live, or which have a corporate action, on that day.
+
+    >>> import pandas as pd
+    >>> def prices(days, divCash=0.0):
+    ...     return pd.DataFrame({'date': pd.to_datetime(days), 'open': 1.0, 'high': 1.0, 'low': 1.0, 'close': 1.0,
+    ...                          'volume': 100, 'divCash': divCash, 'splitFactor': 1.0})
+    >>> si = SymbolIndex()
+    >>> si.add('OLD', TradeableAsset('old', prices(['2004-08-12', '2004-08-13'])))
+    0
+    >>> si.add('new', TradeableAsset('new', prices(['2004-08-13', '2004-08-16'], divCash=[0.0, 0.5])))
+    1
+    >>> si.id_of('Old'), si.normalize('Old')
+    (0, 'old')
+    >>> si.names(si.live('2004-08-16'))
+    ['new']
+    >>> si.names(si.delisted_before([0, 1], '2004-08-16'))
+    ['old']
+    >>> si.names(si.corporate_actions('2004-08-16'))
+    ['new']
+    >>> si.is_trading_day('2004-08-14'), si.is_trading_day('2004-08-16')
+    (False, True)
+
+    Replacing a symbol's asset forgets the days of the old one:
+
+    >>> si.add('new', TradeableAsset('new', prices(['2004-08-13', '2004-08-17'])))
+    1
+    >>> si.is_trading_day('2004-08-16'), si.is_trading_day('2004-08-17'), si.names(si.corporate_actions('2004-08-16'))
+    (False, True, [])
+    """
+    def __init__(self):
+        self.__symbols = []
+        self.__ids = {}
+        self.__names = {}
+        self.__first_day = []
+        self.__last_day = []
+        self.__final_close = []
+        self.__arrays = None
+        self.__actions = {}
+        self.__days = {}  # Day -> number of symbols trading on it
+        self.__days_of = []  # Indexed by symbol id
+
+    def __len__(self):
+        return len(self.__symbols)
+
+    def normalize(self, symbol):
+        """The canonical (lower case) name of :param symbol:, cached so that each spelling is only lowered once."""
+        name = self.__names.get(symbol)
+        if name is None:
+            name = symbol.lower()
+            self.__names[symbol] = name
+        return name
+
+    def id_of(self, symbol):
+        """The integer id of :param symbol:. Raises KeyError if it isn't registered."""
+        return self.__ids[self.normalize(symbol)]
+
+    def name(self, symbol_id):
+        return self.__symbols[symbol_id]
+
+    def names(self, symbol_ids):
+        return [self.__symbols[i] for i in symbol_ids]
+
+    def add(self, symbol, asset):
+        """Registers (or replaces) the asset for :param symbol:, returning its id."""
+        symbol = self.normalize(symbol)
+        symbol_id = self.__ids.get(symbol)
+        if symbol_id is None:
+            symbol_id = len(self.__symbols)
+            self.__ids[symbol] = symbol_id
+            self.__symbols.append(symbol)
+            self.__first_day.append(0)
+            self.__last_day.append(0)
+            self.__final_close.append(np.nan)
+            self.__days_of.append(np.zeros(0, dtype=np.int64))
+        else:  # Forget the replaced asset's days
+            for day_ids in self.__actions.values():
+                day_ids.discard(symbol_id)
+            for day in self.__days_of[symbol_id].tolist():
+                self.__days[day] -= 1
+                if self.__days[day] == 0:
+                    del self.__days[day]
+        days = asset.days
+        if len(days) > 0:
+            self.__first_day[symbol_id] = int(days[0])
+            self.__last_day[symbol_id] = int(days[-1])
+            self.__final_close[symbol_id] = float(asset.exact_price(asset.df['close'].values[-1]))
+        else:  # Never listed
+            (self.__first_day[symbol_id], self.__last_day[symbol_id]) = (np.iinfo(np.int64).max, np.iinfo(np.int64).min)
+        has_action = (asset.df['divCash'].values != 0) | (asset.df['splitFactor'].values != 1.0)
+        for day in days[has_action].tolist():
+            self.__actions.setdefault(day, set()).add(symbol_id)
+        self.__days_of[symbol_id] = days  # The asset's own array, not a copy
+        for day in days.tolist():
+            self.__days[day] = self.__days.get(day, 0) + 1
+        self.__arrays = None
+        return symbol_id
+
+    def __interval_arrays(self):
+        if self.__arrays is None:
+            self.__arrays = (np.array(self.__first_day, dtype=np.int64), np.array(self.__last_day, dtype=np.int64),
+                             np.array(self.__final_close, dtype=float))
+        return self.__arrays
+
+    def first_day(self, symbol_ids):
+        return self.__interval_arrays()[0][symbol_ids]
+
+    def last_day(self, symbol_ids):
+        return self.__interval_arrays()[1][symbol_ids]
+
+    def final_close(self, symbol_ids):
+        """The last closing price of each symbol, which is what a delisted holding is worth."""
+        return self.__interval_arrays()[2][symbol_ids]
+
+    def live(self, dt):
+        """Ids of the symbols listed on :param dt: (between their first and last day of data)."""
+        day = wall_clock_ns(dt)
+        (first, last, _) = self.__interval_arrays()
+        return np.flatnonzero((first <= day) & (last >= day))
+
+    def delisted_before(self, symbol_ids, dt):
+        """The subset of :param symbol_ids: whose last day of data is before :param dt:."""
+        symbol_ids = np.asarray(symbol_ids, dtype=np.int64)
+        return symbol_ids[self.last_day(symbol_ids) < wall_clock_ns(dt)]
+
+    def corporate_actions(self, dt):
+        """Ids of the symbols with a dividend or split on :param dt:."""
+        return sorted(self.__actions.get(wall_clock_ns(dt), ()))
+
+    def is_trading_day(self, dt):
+        return wall_clock_ns(dt) in self.__days
+
+
 if __name__=='__main__':
     import sys
     sys.path.append('.')
@@ -0,0 +1,221 @@
+import os
+import pickle
+import hashlib
+import functools
+import collections
+import tempfile
+import types
+import pandas as pd
+import numpy as np
+
+
+__all__ = ['FeatureCache', 'memoize', 'fingerprint', 'function_key']
+
+
+def function_key(function):
+    """
+    Identifies a function by its qualified name and a hash of what it computes: its code (including nested
+    functions, lambdas and comprehensions), its default arguments and the values its closure captured. Cached
+    results are therefore invalidated when the function is edited, and closures over different values don't
+    share results. The key is the same in every process, and doesn't depend on the module the function was
+    imported as (e.g. `__main__` in a sweep script).
+
+    >>> def make(n):
+    ...     return lambda x: [x + n for _ in range(2)]
+    >>> function_key(make(1)) == function_key(make(1)), function_key(make(1)) == function_key(make(2))
+    (True, False)
+    """
+    function = getattr(function, '__wrapped__', function)
+    h = hashlib.sha256()
+    _hash_function(function, h, set())
+    return function.__qualname__ + ':' + h.hexdigest()[:16]
+
+
+def _hash_code(code, h):
+    h.update(code.co_code)
+    h.update(repr(code.co_names).encode())
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):  # Its repr includes a memory address
+            _hash_code(const, h)
+        else:
+            h.update(repr(const).encode())
+
+
+def _hash_function(function, h, seen):
+    if id(function) in seen:  # E.g. a recursive inner function, which captures itself
+        return
+    seen.add(id(function))
+    _hash_code(function.__code__, h)
+    _hash_value(function.__defaults__, h, seen)
+    _hash_value(function.__kwdefaults__, h, seen)
+    for cell in (function.__closure__ or ()):
+        try:
+            value = cell.cell_contents
+        except ValueError:  # Not assigned yet
+            value = None
+        _hash_value(value, h, seen)
+
+
+def _hash_value(value, h, seen):
+    if isinstance(value, types.FunctionType):
+        _hash_function(value, h, seen)
+    elif isinstance(value, (tuple, list)):
+        h.update(b'(')
+        for v in value:
+            _hash_value(v, h, seen)
+        h.update(b')')
+    elif isinstance(value, (pd.DataFrame, pd.Series, np.ndarray)):
+        h.update(fingerprint(value).encode())
+    else:
+        try:
+            h.update(pickle.dumps(value, protocol=4))
+        except Exception:  # Unpicklable, so fall back to its repr
+            h.update(repr(value).encode())
+
+
+def fingerprint(data):
+    """
+    A hash of the contents (values, index and columns) of a dataframe, series or array.
+
+    >>> df = pd.DataFrame({'close': [1.0, 2.0]})
+    >>> fingerprint(df) == fingerprint(df.copy()), fingerprint(df) == fingerprint(df.iloc[:1])
+    (True, False)
+    """
+    h = hashlib.sha256()
+    if isinstance(data, (pd.DataFrame, pd.Series)):
+        h.update(pd.util.hash_pandas_object(data, index=True).values.tobytes())
+        if isinstance(data, pd.DataFrame):
+            h.update(repr(list(data.columns)).encode())
+    else:
+        data = np.asarray(data)
+        h.update(repr((data.shape, data.dtype.str)).encode())
+        h.update(np.ascontiguousarray(data).tobytes())
+    return h.hexdigest()
+
+
+class FeatureCache:
+    """
+    A least-recently-used cache of computed features, stored as one pickle per entry in :param directory: (or
+    only in memory if :param directory: is None) and limited to about :param max_bytes:.
+
+    Entries are written atomically, so several processes (e.g. the workers of a parameter sweep) can share a
+    directory. Each process evicts by its own view of recent use.
+
+    >>> cache = FeatureCache(tempfile.mkdtemp(), max_bytes=600)
+    >>> cache.put(('a',), np.zeros(10))
+    >>> cache.get(('a',)).sum(), cache.get(('b',), default='missing')
+    (0.0, 'missing')
+    >>> for k in ['b', 'c', 'd']:
+    ...     cache.put((k,), np.zeros(10))
+    >>> cache.get(('a',)) is None  # The least recently used entries were evicted
+    True
+    >>> cache.hits, cache.misses
+    (1, 2)
+    """
+    def __init__(self, directory=None, max_bytes=1 << 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.__entries = collections.OrderedDict()  # Digest -> size in bytes, least recently used first
+        self.__memory = {}
+        self.__bytes = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            existing = []
+            for entry in os.scandir(directory):
+                if entry.name.endswith('.pickle'):
+                    stat = entry.stat()
+                    existing.append((stat.st_mtime_ns, entry.name[:-len('.pickle')], stat.st_size))
+            for (_, digest, size) in sorted(existing):
+                self.__entries[digest] = size
+                self.__bytes += size
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def nbytes(self):
+        return self.__bytes
+
+    @staticmethod
+    def digest(key):
+        return hashlib.sha256(pickle.dumps(key, protocol=4)).hexdigest()
+
+    def __path(self, digest):
+        return os.path.join(self.directory, digest + '.pickle')
+
+    def get(self, key, default=None):
+        digest = self.digest(key)
+        if digest in self.__entries:
+            try:
+                if self.directory is None:
+                    value = self.__memory[digest]
+                else:
+                    with open(self.__path(digest), 'rb') as f:
+                        value = pickle.load(f)
+                    os.utime(self.__path(digest))  # Recently used, for the next process that scans the directory
+            except (OSError, EOFError, pickle.UnpicklingError):  # Evicted or being replaced by another process
+                self.__forget(digest)
+            else:
+                self.__entries.move_to_end(digest)
+                self.hits += 1
+                return value
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        digest = self.digest(key)
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        self.__forget(digest)
+        if self.directory is None:
+            self.__memory[digest] = value
+        else:
+            (fd, tmp) = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, self.__path(digest))
+        self.__entries[digest] = len(data)
+        self.__bytes += len(data)
+        while (self.__bytes > self.max_bytes) and (len(self.__entries) > 1):
+            self.__evict(next(iter(self.__entries)))
+
+    def __forget(self, digest):
+        size = self.__entries.pop(digest, None)
+        if size is not None:
+            self.__bytes -= size
+        self.__memory.pop(digest, None)
+
+    def __evict(self, digest):
+        self.__forget(digest)
+        if self.directory is not None:
+            try:
+                os.remove(self.__path(digest))
+            except OSError:
+                pass
+
+
+def memoize(function):
+    """
+    Memoizes a feature computed from censored data. The decorated function takes the censored data as its first
+    argument, followed by keyword parameters, e.g. `momentum(prices, window=20)`. It is called through a data
+    source, which passes it only the data known at the current date:
+
+    - `momentum(broker, 'acc', window=20)` with the BrokerInterface computes it on `broker.historical_prices('acc')`,
+    - `momentum(other_data, 'earnings', window=20)` with CensoredData computes it on `other_data.get_data('earnings')`.
+
+    Results are cached (see FeatureCache) keyed by the function, the symbol/dataset, the parameters and a
+    fingerprint of the censored data, so later runs reuse them whenever the data known at a date is unchanged.
+    Because the function never sees anything else, a cached value can't contain data past the censor date.
+
+    >>> @memoize
+    ... def mean_close(prices, window=2):
+    ...     return prices['close'].iloc[-window:].mean()
+    >>> mean_close(pd.DataFrame({'close': [1.0, 2.0, 4.0]}), window=2)  # Called directly, it isn't cached
+    3.0
+    """
+    @functools.wraps(function)
+    def wrapper(source, *args, **params):
+        if callable(getattr(type(source), 'feature', None)):
+            return source.feature(function, *args, **params)
+        return function(source, *args, **params)
+    return wrapper
@@ -0,0 +1,201 @@
+from collections import namedtuple
+import heapq
+import pandas as pd
+if __package__ is None or __package__ == '':
+    from _utils import HasDfDict, wall_clock_ns
+else:
+    from ._utils import HasDfDict, wall_clock_ns
+
+
+__all__ = ['RestingOrder', 'OrderBook']
+
+_NO_HEAP = object()
+
+
+class RestingOrder(namedtuple('RestingOrder', ['order_id', 'symbol', 'kind', 'price', 'size', 'is_buy', 'expires', 'meta', 'lots', 'priority']), HasDfDict):
+    __slots__ = ()
+    DICT_COLUMNS = ['order_id', 'symbol', 'kind', 'price', 'size', 'is_buy', 'expires']
+    META_FIELDS = [('meta', '')]
+
+
+class OrderBook:
+    """
+    Good-till-cancelled limit orders, resting until they cross an auction price, are cancelled or expire.
+
+    Each (symbol, auction kind) has a heap of bids (highest price first) and one of asks (lowest price first),
+    both in time priority at the same price, so the orders crossing an auction are popped off the top without
+    looking at the rest. Cancelled and replaced orders are dropped from the heaps lazily, and a heap is rebuilt
+    from its live entries once it holds more dead entries than live ones, so it stays O(resting orders) in size.
+
+    >>> book = OrderBook()
+    >>> low = book.add('acc', 'open', price=17.0, size=10, is_buy=True)
+    >>> high = book.add('acc', 'open', price=18.0, size=5, is_buy=True, expires='2004-08-16')
+    >>> ask = book.add('acc', 'open', price=17.5, size=5, is_buy=False)
+    >>> (bid, offer) = book.crossing('acc', 'open', 17.54)  # The bid at 17 doesn't cross
+    >>> bid.order_id, offer.order_id
+    (1, 2)
+    >>> book.requeue(bid._replace(size=2))  # Only 3 of the 5 filled
+    >>> book.replace(low, price=18.0).order_id  # Keeps its id, but queues behind order 1 at 18
+    0
+    >>> crossed = book.crossing('acc', 'open', 17.8)
+    >>> [(o.order_id, o.size) for o in crossed]
+    [(1, 2), (0, 10)]
+    >>> for o in crossed:
+    ...     book.requeue(o)
+    >>> [o.order_id for o in book.expire('2004-08-17')], len(book)
+    ([1], 1)
+    """
+    def __init__(self):
+        self.__orders = {}  # Order id -> RestingOrder, for the orders in the book
+        self.__books = {}  # (symbol, kind) -> (bids, asks), heaps of (price key, priority, order id, entry)
+        self.__expiries = []  # Heap of (expiry, priority, order id, entry)
+        self.__entries = {}  # Order id -> the entry number of its current heap entries, so older ones are dead
+        self.__next_entry = 0
+        self.__dead = {}  # (symbol, kind, is_buy), or None for the expiries -> number of dead entries in that heap
+        self.__next_id = 0
+        self.__next_priority = 0
+
+    def __len__(self):
+        return len(self.__orders)
+
+    def get(self, order_id):
+        return self.__orders.get(order_id)
+
+    def orders(self):
+        """The resting orders, in the order they were placed."""
+        result = pd.DataFrame([o.df_dict() for o in sorted(self.__orders.values(), key=lambda o: o.order_id)])
+        if len(result) > 0:
+            result['expires'] = pd.to_datetime(result['expires'])
+        return result
+
+    def add(self, symbol, kind, price, size, is_buy, expires=None, meta={}, lots=None):
+        """Adds an order, good through the date :param expires: (if given), and returns its order id."""
+        order_id = self.__next_id
+        self.__next_id += 1
+        expires = wall_clock_ns(expires) if (expires is not None) else None
+        self.__push(RestingOrder(order_id, symbol, kind, price, size, is_buy, expires, meta, lots, None))
+        return order_id
+
+    def __push(self, order):
+        if order.priority is None:  # Time priority is a sequence number, renewed when the order is replaced
+            order = order._replace(priority=self.__next_priority)
+            self.__next_priority += 1
+        (priority, entry) = (order.priority, self.__next_entry)
+        self.__next_entry += 1
+        self.__orders[order.order_id] = order
+        self.__entries[order.order_id] = entry
+        (bids, asks) = self.__books.setdefault((order.symbol, order.kind), ([], []))
+        if order.is_buy:
+            heapq.heappush(bids, (-order.price, priority, order.order_id, entry))
+        else:
+            heapq.heappush(asks, (order.price, priority, order.order_id, entry))
+        if order.expires is not None:
+            heapq.heappush(self.__expiries, (order.expires, priority, order.order_id, entry))
+
+    def __live(self, order_id, entry):
+        return self.__entries.get(order_id) == entry
+
+    def __heap(self, name):
+        return self.__expiries if name is None else self.__books[name[:2]][0 if name[2] else 1]
+
+    def __remove(self, order_id, popped_from=_NO_HEAP):
+        """
+        Removes an order, whose entries in its heaps (except the one it was just popped from) are now dead. A heap
+        is rebuilt from its live entries once they are outnumbered by dead ones.
+        """
+        order = self.__orders.pop(order_id, None)
+        if order is None:
+            return None
+        del self.__entries[order_id]
+        names = [(order.symbol, order.kind, order.is_buy)] + ([None] if order.expires is not None else [])
+        for name in names:
+            if name == popped_from:
+                continue
+            heap = self.__heap(name)
+            dead = self.__dead.get(name, 0) + 1
+            if 2 * dead > len(heap):
+                heap[:] = [entry for entry in heap if self.__live(entry[2], entry[3])]
+                heapq.heapify(heap)
+                dead = 0
+            self.__dead[name] = dead
+        return order
+
+    def __pop(self, name):
+        """Pops the top entry of a heap, returning its order id and whether its order is resting."""
+        (_, _, order_id, entry) = heapq.heappop(self.__heap(name))
+        live = self.__live(order_id, entry)
+        if not live:
+            self.__dead[name] -= 1
+        return (order_id, live)
+
+    def cancel(self, order_id):
+        """Removes an order, returning it (or None if it isn't resting)."""
+        return self.__remove(order_id)
+
+    def replace(self, order_id, **changes):
+        """
+        Changes the price, size, expiry, meta or lots of a resting order, which keeps its order id but goes to the
+        back of the queue at its price. Returns the new order, or None if it isn't resting.
+        """
+        order = self.cancel(order_id)
+        if order is None:
+            return None
+        if changes.get('expires') is not None:
+            changes['expires'] = wall_clock_ns(changes['expires'])
+        order = order._replace(priority=None, **changes)
+        self.__push(order)
+        return self.__orders[order_id]
+
+    def requeue(self, order):
+        """Puts back an order taken by crossing() (e.g. the unfilled part of it), with its time priority."""
+        self.__push(order)
+
+    def expire(self, dt):
+        """Removes and returns the orders which expired before :param dt:."""
+        day = wall_clock_ns(dt)
+        expired = []
+        while (len(self.__expiries) > 0) and (self.__expiries[0][0] < day):
+            (order_id, live) = self.__pop(None)
+            if live:
+                expired.append(self.__remove(order_id, popped_from=None))
+        return expired
+
+    def symbols(self, kind):
+        """The symbols with resting orders for the :param kind: auction."""
+        return [symbol for (symbol, k) in self.__books if k == kind]
+
+    def crossing(self, symbol, kind, price):
+        """
+        Removes and returns the orders for :param symbol:'s :param kind: auction which cross :param price: (bids at or
+        above it, then asks at or below it), best price first. Use requeue() to put back what doesn't fill.
+        """
+        key = (symbol, kind)
+        if key not in self.__books:
+            return []
+        result = []
+        for (side, is_buy, crosses) in zip(self.__books[key], [True, False], [lambda k: -k >= price, lambda k: k <= price]):
+            name = (symbol, kind, is_buy)
+            while len(side) > 0:
+                (k, _, order_id, entry) = side[0]
+                if (not self.__live(order_id, entry)) or crosses(k):
+                    (order_id, live) = self.__pop(name)
+                    if live:
+                        result.append(self.__remove(order_id, popped_from=name))
+                else:
+                    break
+        if (len(self.__books[key][0]) == 0) and (len(self.__books[key][1]) == 0):
+            del self.__books[key]
+            for is_buy in [True, False]:
+                self.__dead.pop((symbol, kind, is_buy), None)
+        return result
+
+    def heap_sizes(self):
+        """The number of entries, live or dead, in the bid and ask heaps and in the expiry heap."""
+        return (sum(len(bids) + len(asks) for (bids, asks) in self.__books.values()), len(self.__expiries))
+
+
+if __name__ == '__main__':
+    import sys
+    sys.path.append('.')
+    import doctest
+    doctest.testmod()
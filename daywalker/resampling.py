@@ -0,0 +1,202 @@
+import pandas as pd
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+
+__all__ = ['block_bootstrap_indices', 'stationary_bootstrap_indices', 'return_statistics', 'bootstrap_returns',
+           'bootstrap_trades', 'random_entry_null', 'p_value']
+
+# Resamples are generated and evaluated in batches of this many rows, each with its own seed spawned from the
+# caller's seed. Results therefore don't depend on the number of processes.
+BATCH_SIZE = 1000
+
+
+def block_bootstrap_indices(n, n_samples, block_length, rng):
+    """
+    Indices for a circular moving block bootstrap of a series of length :param n:, as an (n_samples, n) array.
+    Each resample is made of blocks of :param block_length: consecutive observations, starting at random.
+
+    >>> block_bootstrap_indices(6, 2, 3, np.random.default_rng(0))
+    array([[5, 0, 1, 3, 4, 5],
+           [3, 4, 5, 1, 2, 3]])
+    """
+    n_blocks = -(-n // block_length)
+    starts = rng.integers(0, n, size=(n_samples, n_blocks))
+    indices = starts[:, :, None] + np.arange(block_length)[None, None, :]
+    return indices.reshape(n_samples, n_blocks * block_length)[:, :n] % n
+
+
+def stationary_bootstrap_indices(n, n_samples, mean_block_length, rng):
+    """
+    Indices for the stationary bootstrap of Politis and Romano, as an (n_samples, n) array. Blocks start at random
+    and have geometrically distributed lengths with mean :param mean_block_length:, wrapping around the series.
+
+    >>> idx = stationary_bootstrap_indices(1000, 3, 10, np.random.default_rng(0))
+    >>> idx.shape
+    (3, 1000)
+    >>> continues = (idx[:, 1:] == (idx[:, :-1] + 1) % 1000)
+    >>> 0.85 < continues.mean() < 0.95  # A new block starts with probability 1/10
+    True
+    """
+    new_block = rng.random((n_samples, n)) < (1.0 / mean_block_length)
+    new_block[:, 0] = True
+    positions = np.broadcast_to(np.arange(n), (n_samples, n))
+    block_start = np.maximum.accumulate(np.where(new_block, positions, 0), axis=1)
+    starts = rng.integers(0, n, size=(n_samples, n))
+    return (np.take_along_axis(starts, block_start, axis=1) + positions - block_start) % n
+
+
+def return_statistics(returns, periods_per_year=252):
+    """
+    Statistics of each row of a 2-D array of periodic returns, computed for all rows at once.
+
+    >>> return_statistics(np.array([[0.1, -0.1, 0.1], [0.0, 0.0, 0.0]]))
+       mean_return  return_std    sharpe  total_return  max_drawdown
+    0     0.033333     0.11547  4.582576         0.089          -0.1
+    1     0.000000     0.00000       NaN         0.000           0.0
+    """
+    returns = np.atleast_2d(np.asarray(returns, dtype=float))
+    mean = returns.mean(axis=1)
+    std = returns.std(axis=1, ddof=1) if returns.shape[1] > 1 else np.full(len(returns), np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sharpe = np.where(std > 0, mean / std * np.sqrt(periods_per_year), np.nan)
+    equity = np.cumprod(1 + returns, axis=1)
+    peak = np.maximum(np.maximum.accumulate(equity, axis=1), 1.0)
+    return pd.DataFrame({
+        'mean_return': mean,
+        'return_std': std,
+        'sharpe': sharpe,
+        'total_return': equity[:, -1] - 1,
+        'max_drawdown': np.minimum((equity / peak - 1).min(axis=1), 0.0),
+    })
+
+
+def _batches(n_samples, seed):
+    sizes = [BATCH_SIZE] * (n_samples // BATCH_SIZE)
+    if n_samples % BATCH_SIZE > 0:
+        sizes.append(n_samples % BATCH_SIZE)
+    return list(zip(sizes, np.random.SeedSequence(seed).spawn(len(sizes))))
+
+
+def _run(function, arguments, n_samples, seed, processes):
+    """Runs function(*arguments, size, seed_sequence) over batches of resamples, in a process pool if :param processes: > 1."""
+    jobs = [tuple(arguments) + batch for batch in _batches(n_samples, seed)]
+    if (processes is None) or (processes <= 1) or (len(jobs) <= 1):
+        results = [function(*job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            results = list(executor.map(function, *zip(*jobs)))
+    return pd.concat(results, ignore_index=True)
+
+
+def _equity_returns(strategy_values):
+    equity = (strategy_values['cash'] + strategy_values['long_equities'] + strategy_values['short_equities']).values.astype(float)
+    return equity[1:] / equity[:-1] - 1
+
+
+def _returns_batch(returns, method, block_length, periods_per_year, size, seed_sequence):
+    rng = np.random.default_rng(seed_sequence)
+    if method == 'stationary':
+        indices = stationary_bootstrap_indices(len(returns), size, block_length, rng)
+    elif method == 'block':
+        indices = block_bootstrap_indices(len(returns), size, block_length, rng)
+    else:  # iid
+        indices = rng.integers(0, len(returns), size=(size, len(returns)))
+    return return_statistics(returns[indices], periods_per_year=periods_per_year)
+
+
+def bootstrap_returns(strategy_values, n_samples=10000, method='stationary', block_length=20, seed=None, processes=None, periods_per_year=252):
+    """
+    Bootstraps the daily returns of the equity curve in `Broker.strategy_values()`, returning the statistics
+    (see return_statistics) of each of :param n_samples: resampled return series.
+
+    :param method: is 'stationary' (blocks of mean length :param block_length:), 'block' (blocks of fixed length)
+    or 'iid'. Resamples are drawn in batches, spread over :param processes: processes, and the result only
+    depends on :param seed:.
+
+    >>> values = pd.DataFrame({'cash': 0.0, 'short_equities': 0.0,
+    ...                        'long_equities': 100 * np.cumprod(1 + np.random.default_rng(1).normal(0.001, 0.01, 500))})
+    >>> samples = bootstrap_returns(values, n_samples=2500, seed=42)
+    >>> len(samples), list(samples.columns)
+    (2500, ['mean_return', 'return_std', 'sharpe', 'total_return', 'max_drawdown'])
+    >>> samples.equals(bootstrap_returns(values, n_samples=2500, seed=42))
+    True
+    """
+    returns = _equity_returns(strategy_values)
+    return _run(_returns_batch, (returns, method, block_length, periods_per_year), n_samples, seed, processes)
+
+
+def _trades_batch(gains, size, seed_sequence):
+    rng = np.random.default_rng(seed_sequence)
+    resampled = gains[rng.integers(0, len(gains), size=(size, len(gains)))]
+    mean = resampled.mean(axis=1)
+    std = resampled.std(axis=1, ddof=1) if len(gains) > 1 else np.full(size, np.nan)
+    return pd.DataFrame({
+        'total_gain': resampled.sum(axis=1),
+        'mean_gain': mean,
+        'win_rate': (resampled > 0).mean(axis=1),
+        'trade_sharpe': np.where(std > 0, mean / np.where(std > 0, std, 1), np.nan),
+    })
+
+
+def bootstrap_trades(capital_gains, n_samples=10000, group_by=None, seed=None, processes=None):
+    """
+    Resamples realized gains (from `Broker.capital_gains()`) with replacement. With :param group_by: (e.g.
+    'open_trade_story_id'), the gains of each group are summed first, so that a trade closed in several lots
+    is resampled as one trade.
+
+    >>> cg = pd.DataFrame({'gain': [10.0, -5.0, 2.0, 3.0], 'open_trade_story_id': ['a', 'b', 'c', 'c']})
+    >>> samples = bootstrap_trades(cg, n_samples=2000, group_by='open_trade_story_id', seed=0)
+    >>> sorted(samples['total_gain'].unique())  # Every sum of 3 draws from a=10, b=-5 and c=5
+    [-15.0, -5.0, 0.0, 5.0, 10.0, 15.0, 20.0, 25.0, 30.0]
+    """
+    gains = capital_gains['gain']
+    if group_by is not None:
+        gains = gains.groupby(capital_gains[group_by], sort=False).sum()
+    return _run(_trades_batch, (gains.values.astype(float),), n_samples, seed, processes)
+
+
+def _random_entry_batch(closes, holding_periods, sizes, size, seed_sequence):
+    rng = np.random.default_rng(seed_sequence)
+    n_days = closes.shape[0]
+    # Entry rows are drawn uniformly among those which leave room for the holding period
+    entries = (rng.random((size, len(holding_periods))) * (n_days - holding_periods)).astype(np.int64)
+    columns = np.arange(closes.shape[1])
+    gains = (closes[entries + holding_periods, columns] - closes[entries, columns]) * sizes
+    gains = np.nan_to_num(gains)
+    return pd.DataFrame({'total_gain': gains.sum(axis=1), 'mean_gain': gains.mean(axis=1), 'win_rate': (gains > 0).mean(axis=1)})
+
+
+def random_entry_null(capital_gains, closes, n_samples=10000, seed=None, processes=None):
+    """
+    A null distribution for the strategy's trades: each realized lot in :param capital_gains: is replaced by a
+    random entry into the same symbol, with the same size and holding period (in trading days), and the total
+    gain of each such random strategy is computed.
+
+    :param closes: is a date x symbol dataframe of closing prices (dates naive, sorted). Entries and exits are
+    at the close, and commissions are ignored.
+
+    >>> closes = pd.DataFrame({'acc': np.arange(10.0, 20.0)}, index=pd.date_range('2020-01-01', periods=10))
+    >>> cg = pd.DataFrame({'symbol': ['acc'], 'size': [10], 'open_date': [pd.Timestamp('2020-01-02')],
+    ...                    'close_date': [pd.Timestamp('2020-01-05')]})
+    >>> random_entry_null(cg, closes, n_samples=100, seed=0)['total_gain'].unique()
+    array([30.])
+    """
+    dates = closes.index.values.astype('datetime64[ns]')
+
+    def rows(column):
+        values = pd.to_datetime(capital_gains[column])
+        if values.dt.tz is not None:
+            values = values.dt.tz_localize(None)
+        return np.searchsorted(dates, values.dt.normalize().values.astype('datetime64[ns]'), side='right') - 1
+
+    holding_periods = np.clip(rows('close_date') - rows('open_date'), 0, len(dates) - 1)
+    panel = closes[capital_gains['symbol'].values].values.astype(float)  # One column per lot
+    sizes = capital_gains['size'].values.astype(float)
+    return _run(_random_entry_batch, (panel, holding_periods, sizes), n_samples, seed, processes)
+
+
+def p_value(observed, samples):
+    """The fraction of :param samples: at least as large as :param observed: (with the usual +1 correction)."""
+    samples = np.asarray(samples)
+    return (1 + np.sum(samples >= observed)) / (1 + len(samples))
@@ -0,0 +1,163 @@
+from collections import namedtuple
+import pandas as pd
+import numpy as np
+
+
+__all__ = ['RiskLimits', 'ExposureTracker']
+
+
+class RiskLimits(namedtuple('RiskLimits', ['max_gross_leverage', 'max_net_leverage', 'max_concentration', 'max_short_leverage'])):
+    """
+    Pre-trade risk limits, each expressed as a multiple of equity (cash plus the market value of positions).
+    A limit of None is not checked.
+
+    - max_gross_leverage: sum of absolute position values / equity
+    - max_net_leverage: absolute value of the sum of position values / equity
+    - max_concentration: absolute value of any single position / equity
+    - max_short_leverage: absolute value of all short positions / equity
+    """
+    __slots__ = ()
+RiskLimits.__new__.__defaults__ = (None, None, None, None)
+
+
+class ExposureTracker:
+    """
+    Tracks portfolio exposure incrementally, so that risk limits can be checked per order in O(1).
+
+    The broker updates the tracker on every fill and split, and re-marks it with each day's closing prices.
+
+    >>> et = ExposureTracker(RiskLimits(max_gross_leverage=1.5, max_concentration=0.5))
+    >>> et.record_fill('acc', 100, 20.0)
+    >>> et.record_fill('xyz', -50, 10.0)
+    >>> et.gross(), et.net(), et.short()
+    (2500.0, 1500.0, 500.0)
+    >>> et.mark('acc', 22.0)
+    >>> et.gross(), et.net()
+    (2700.0, 1700.0)
+
+    With $10,000 of equity, buying another 200 acc at $22 would take acc to 60% of equity:
+
+    >>> et.allow_order('acc', 200, 22.0, equity=10000.0)
+    False
+    >>> et.allow_order('acc', 100, 22.0, equity=10000.0)
+    True
+
+    A batch of orders is checked in one pass, assuming each allowed order fills after the ones before it. A
+    rejected order doesn't count against the orders after it:
+
+    >>> orders = pd.DataFrame({'symbol': ['acc', 'xyz', 'foo', 'acc'], 'size': [100, 50, 200, 100], 'price': [22.0, 10.0, 20.0, 22.0]})
+    >>> et.allow_orders(orders['symbol'], orders['size'], orders['price'], equity=10000.0)
+    array([ True,  True,  True, False])
+    >>> et.allow_orders(['acc', 'acc'], [1000, 100], [22.0, 22.0], equity=10000.0)
+    array([False,  True])
+
+    Once a position has drifted over a limit, orders which reduce it are still allowed, but adding to it isn't:
+
+    >>> et.mark('acc', 60.0)  # acc is now 60% of equity
+    >>> et.allow_order('acc', -10, 60.0, equity=10000.0), et.allow_order('acc', 10, 60.0, equity=10000.0)
+    (True, False)
+    """
+    def __init__(self, limits=None):
+        self.limits = limits if (limits is not None) else RiskLimits()
+        self.__quantity = {}
+        self.__price = {}
+        self.__gross = 0.0
+        self.__net = 0.0
+        self.__short = 0.0
+
+    def __contribution(self, symbol, sign):
+        value = self.__quantity.get(symbol, 0) * self.__price.get(symbol, 0.0)
+        self.__gross += sign * abs(value)
+        self.__net += sign * value
+        self.__short += sign * max(-value, 0.0)
+
+    def __update(self, symbol, quantity, price):
+        self.__contribution(symbol, -1)
+        if quantity == 0:
+            self.__quantity.pop(symbol, None)
+            self.__price.pop(symbol, None)
+        else:
+            self.__quantity[symbol] = quantity
+            self.__price[symbol] = price
+        self.__contribution(symbol, 1)
+        if len(self.__quantity) == 0:  # Don't let floating point drift accumulate
+            (self.__gross, self.__net, self.__short) = (0.0, 0.0, 0.0)
+
+    def record_fill(self, symbol, size, price):
+        self.__update(symbol, self.__quantity.get(symbol, 0) + size, float(price))
+
+    def mark(self, symbol, price):
+        if symbol in self.__quantity:
+            self.__update(symbol, self.__quantity[symbol], float(price))
+
+    def split(self, symbol, splitFactor):
+        if symbol in self.__quantity:
+            self.__update(symbol, self.__quantity[symbol] * splitFactor, self.__price[symbol] / splitFactor)
+
+    def quantity(self, symbol):
+        return self.__quantity.get(symbol, 0)
+
+    def gross(self):
+        return self.__gross
+
+    def net(self):
+        return self.__net
+
+    def short(self):
+        return self.__short
+
+    def __within_limits(self, after, before, equity):
+        """
+        Whether each of the measures (gross, net, short, position value) :param after: an order is within its
+        limit, or at least no worse than :param before: it, so that orders reducing a breach are allowed.
+        """
+        limits = self.limits
+        ok = True
+        for (limit, a, b) in [(limits.max_gross_leverage, after[0], before[0]), (limits.max_net_leverage, abs(after[1]), abs(before[1])),
+                              (limits.max_short_leverage, after[2], before[2]), (limits.max_concentration, abs(after[3]), abs(before[3]))]:
+            if limit is not None:
+                ok = ok & ((a <= limit * equity) | (a <= b))
+        return ok
+
+    def __measures(self, totals, quantity, last_price, size, price):
+        """
+        The measures (gross, net, short, position value) before and after an order for :param size: shares at
+        :param price:, given the portfolio's :param totals: (gross, net, short) and the position's :param quantity:
+        and :param last_price:. Both are valued at the order's price, so only the order itself is judged.
+        """
+        (gross, net, short) = totals
+        old_value = quantity * last_price
+        before_value = quantity * price
+        new_value = (quantity + size) * price
+        before = (gross - abs(old_value) + abs(before_value), net - old_value + before_value,
+                  short - max(-old_value, 0.0) + max(-before_value, 0.0), before_value)
+        after = (gross - abs(old_value) + abs(new_value), net - old_value + new_value,
+                 short - max(-old_value, 0.0) + max(-new_value, 0.0), new_value)
+        return (before, after)
+
+    def allow_order(self, symbol, size, price, equity):
+        """
+        Whether an order for :param size: (signed) shares at :param price: keeps the portfolio within limits, or
+        doesn't increase any measure which is already over its limit.
+        """
+        (before, after) = self.__measures((self.__gross, self.__net, self.__short), self.__quantity.get(symbol, 0),
+                                          self.__price.get(symbol, 0.0), size, price)
+        return bool(self.__within_limits(after, before, equity))
+
+    def allow_orders(self, symbols, sizes, prices, equity):
+        """
+        allow_order for a batch of orders (signed sizes), returning a boolean array. Each order is checked against
+        the portfolio as it would be if the orders before it which are allowed had filled; rejected orders don't
+        count against the ones after them. One pass over the orders, in O(1) each.
+        """
+        result = np.zeros(len(symbols), dtype=bool)
+        totals = (self.__gross, self.__net, self.__short)
+        positions = {}  # Symbol -> (quantity, price) after the allowed orders so far
+        for (i, (symbol, size, price)) in enumerate(zip(symbols, np.asarray(sizes, dtype=float), np.asarray(prices, dtype=float))):
+            (quantity, last_price) = positions.get(symbol, (self.__quantity.get(symbol, 0), self.__price.get(symbol, 0.0)))
+            (before, after) = self.__measures(totals, quantity, last_price, size, price)
+            if self.__within_limits(after, before, equity):
+                result[i] = True
+                totals = after[:3]
+                positions[symbol] = (quantity + size, price)
+        return result
@@ -0,0 +1,71 @@
+import pandas as pd
+import numpy as np
+if __package__ is None or __package__ == '':
+    from _utils import wall_clock_ns
+else:
+    from ._utils import wall_clock_ns
+
+
+__all__ = ['Schedule', 'CALENDAR_RULES']
+
+
+def _period_boundaries(days, freq, first):
+    periods = pd.DatetimeIndex(days).tz_localize(None).to_period(freq).asi8
+    if first:
+        return np.concatenate([[True], periods[1:] != periods[:-1]])
+    return np.concatenate([periods[:-1] != periods[1:], [True]])
+
+
+# Name -> function(trading days) returning a boolean array of the days to wake up on.
+CALENDAR_RULES = {
+    'daily': lambda days: np.ones(len(days), dtype=bool),
+    'week_start': lambda days: _period_boundaries(days, 'W', first=True),
+    'week_end': lambda days: _period_boundaries(days, 'W', first=False),
+    'month_start': lambda days: _period_boundaries(days, 'M', first=True),
+    'month_end': lambda days: _period_boundaries(days, 'M', first=False),
+    'quarter_start': lambda days: _period_boundaries(days, 'Q', first=True),
+    'quarter_end': lambda days: _period_boundaries(days, 'Q', first=False),
+}
+
+
+class Schedule:
+    """
+    The trading days on which a strategy wants its pre_open and pre_close hooks to be called. A strategy
+    declares one by returning it from `Strategy.schedule()`; on the other days the market only applies
+    corporate actions and values the portfolio, for a whole idle stretch at once.
+
+    The strategy wakes up on a day if any of these hold:
+
+    - :param calendar: is a CALENDAR_RULES name (e.g. 'month_start' is the first trading day of each month)
+      or a function of the trading days (a DatetimeIndex) returning a boolean array,
+    - the day is one of :param dates:,
+    - one of the CensoredData sets named in :param events: reveals new rows that day,
+    - :param on_fill: is set and a trade was filled on the previous trading day.
+
+    >>> days = pd.DatetimeIndex(['2004-08-30', '2004-08-31', '2004-09-01', '2004-09-02', '2004-10-01'])
+    >>> Schedule(calendar='month_start').wake_days(days)
+    array([ True, False,  True, False,  True])
+    >>> Schedule(calendar='month_end', dates=['2004-09-02']).wake_days(days)
+    array([False,  True, False,  True,  True])
+    """
+    def __init__(self, calendar=None, dates=(), events=(), on_fill=False):
+        if isinstance(calendar, str) and (calendar not in CALENDAR_RULES):
+            raise ValueError("Unknown calendar rule " + calendar + ", expected one of " + ", ".join(CALENDAR_RULES))
+        self.calendar = calendar
+        self.dates = set(wall_clock_ns(d) for d in dates)
+        self.events = list(events)
+        self.on_fill = on_fill
+
+    def wake_days(self, days, other_data=None):
+        """Whether to wake up on each of the trading :param days: (before considering fills)."""
+        wake = np.zeros(len(days), dtype=bool)
+        if len(days) == 0:
+            return wake
+        if self.calendar is not None:
+            rule = CALENDAR_RULES[self.calendar] if isinstance(self.calendar, str) else self.calendar
+            wake |= np.asarray(rule(pd.DatetimeIndex(days)), dtype=bool)
+        if len(self.dates) > 0:
+            wake |= np.array([wall_clock_ns(d) in self.dates for d in days], dtype=bool)
+        for name in self.events:
+            wake |= other_data.new_data_on(name, days)
+        return wake
@@ -6,6 +6,14 @@ __all__ = ['Strategy']
 
 
 class Strategy(metaclass=abc.ABCMeta):
+    """
+    A trading strategy. The market calls pre_open and pre_close on each trading day with the BrokerInterface, the
+    trades filled since the last call and the CensoredData.
+
+    `trades` is a daywalker._utils.LazyFrame, which only builds the dataframe when it is used and otherwise behaves
+    like one (indexing, item assignment, attributes, comparisons, arithmetic). It is not a pd.DataFrame instance,
+    though, so use `trades.frame()` where an actual dataframe is needed (e.g. isinstance checks or pd.concat).
+    """
     @abc.abstractmethod
     def pre_open(self, dt, broker, trades, other_data):
         pass
@@ -14,6 +22,13 @@ class Strategy(metaclass=abc.ABCMeta):
     def pre_close(self, dt, broker, trades, other_data):
         pass
 
+    def schedule(self):
+        """
+        A daywalker.schedule.Schedule of the days this strategy needs to run on, or None to run every trading day.
+        Strategies which only act occasionally (e.g. monthly rebalances) can declare one to make backtests faster.
+        """
+        return None
+
     def __logs(self):
         if not hasattr(self, '_logs'):
             self._logs = defaultdict(DictableToDataframe)
@@ -25,3 +40,7 @@ class Strategy(metaclass=abc.ABCMeta):
 
     def get_log(self, name):
         return self.__logs()[name].get()
+
+    def log_bytes(self):
+        """Approximate bytes used by the logs."""
+        return sum(log.nbytes() for log in self.__logs().values())
@@ -0,0 +1,216 @@
+import pandas as pd
+import numpy as np
+if __package__ is None or __package__ == '':
+    from accounting import LONG_TERM_HOLDING_PERIOD
+else:
+    from .accounting import LONG_TERM_HOLDING_PERIOD
+
+
+__all__ = ['classify_gains', 'wash_sales', 'after_tax_gains', 'after_tax_equity', 'WASH_SALE_WINDOW']
+
+# A loss is a wash sale if replacement shares are bought within this long before or after the sale.
+WASH_SALE_WINDOW = pd.Timedelta(days=30)
+
+
+def _gain(capital_gains):
+    if 'gain' in capital_gains.columns:
+        return capital_gains['gain'].values
+    return ((capital_gains['close_price'] - capital_gains['open_price'] - capital_gains['close_commission_per_share'] - capital_gains['open_commission_per_share'])*capital_gains['size']).values
+
+
+def _epoch(dates):
+    return pd.to_datetime(pd.Series(dates), utc=True).values.astype('datetime64[ns]').view('i8')
+
+
+def _calendar_date(dates):
+    dates = pd.to_datetime(dates)
+    if dates.dt.tz is not None:  # Holding periods are in calendar days, so compare local dates
+        dates = dates.dt.tz_localize(None)
+    return dates.dt.normalize()
+
+
+def classify_gains(capital_gains):
+    """
+    Adds a `term` column to a capital gains table (as returned by `Broker.capital_gains()`), which is
+    'long' for lots held longer than LONG_TERM_HOLDING_PERIOD and 'short' otherwise.
+
+    >>> cg = pd.DataFrame({'symbol': ['x', 'x'], 'size': [100, 50], 'open_price': [25.0, 30.0], 'close_price': [35.0, 35.0],
+    ...                    'open_commission_per_share': [0.0, 0.0], 'close_commission_per_share': [0.0, 0.0],
+    ...                    'open_date': pd.to_datetime(['1990-01-01', '1990-06-01']), 'close_date': pd.to_datetime(['1991-01-10', '1991-01-10'])})
+    >>> classify_gains(cg)[['size', 'term']]
+       size   term
+    0   100   long
+    1    50  short
+
+    The holding period starts the day after the purchase, so a lot sold on its anniversary is short term,
+    whatever the times of day:
+
+    >>> anniversary = cg.assign(open_date=pd.to_datetime(['2020-03-02 09:30', '2020-03-02 09:30']),
+    ...                         close_date=pd.to_datetime(['2021-03-02 16:00', '2021-03-03 09:30']))
+    >>> list(classify_gains(anniversary)['term'])
+    ['short', 'long']
+    """
+    result = capital_gains.copy()
+    long_term = _calendar_date(result['close_date']) > (_calendar_date(result['open_date']) + LONG_TERM_HOLDING_PERIOD)
+    result['term'] = np.where(long_term.values, 'long', 'short')
+    return result
+
+
+def wash_sales(capital_gains, trades, window=WASH_SALE_WINDOW):
+    """
+    Detects wash sales: losses on long lots where replacement shares of the same symbol were bought within
+    :param window: before or after the sale. Returns a copy of :param capital_gains: (with a fresh index) with columns
+
+    - `wash_sale_shares`: shares of the lot whose loss is disallowed,
+    - `wash_sale_disallowed`: the disallowed loss (a positive amount),
+    - `basis_adjustment`: disallowed losses added to the cost basis of this lot, because it was bought as a replacement.
+
+    Purchases are indexed per symbol by date, so each loss finds its window with `searchsorted`. Each replacement
+    share is used by at most one loss, earliest purchase first. The basis adjustment of a purchase is spread
+    evenly over all the shares bought in that auction. Only long positions are considered, and losses which are
+    themselves increased by a basis adjustment do not cascade into further wash sales.
+
+    >>> day = lambda d: pd.Timestamp(d, tz='America/New_York')
+    >>> trades = pd.DataFrame({'symbol': ['x', 'x', 'x', 'x'], 'size': [10, -10, 10, -10],
+    ...                        'date': [day('2020-01-02'), day('2020-03-02'), day('2020-03-20'), day('2020-06-01')]})
+    >>> cg = pd.DataFrame({'symbol': ['x', 'x'], 'size': [10, 10], 'open_price': [20.0, 16.0], 'close_price': [15.0, 18.0],
+    ...                    'open_commission_per_share': [0.0, 0.0], 'close_commission_per_share': [0.0, 0.0],
+    ...                    'open_date': [day('2020-01-02'), day('2020-03-20')], 'close_date': [day('2020-03-02'), day('2020-06-01')]})
+    >>> ws = wash_sales(cg, trades)
+    >>> ws[['close_price', 'wash_sale_shares', 'wash_sale_disallowed', 'basis_adjustment']]
+       close_price  wash_sale_shares  wash_sale_disallowed  basis_adjustment
+    0         15.0              10.0                  50.0               0.0
+    1         18.0               0.0                   0.0              50.0
+
+    The $50 loss on the first lot is disallowed, and instead raises the cost basis of the replacement
+    shares bought on 2020-03-20, turning the second lot's $20 gain into a $30 loss:
+
+    >>> after_tax_gains(cg, trades)[['term', 'taxable_gain', 'tax']]
+        term  taxable_gain   tax
+    0  short           0.0   0.0
+    1  short         -30.0 -11.1
+    """
+    result = capital_gains.reset_index(drop=True).copy()
+    n = len(result)
+    gain = _gain(result)
+    size = result['size'].values.astype(float)
+    wash_shares = np.zeros(n)
+    disallowed = np.zeros(n)
+    adjustment = np.zeros(n)
+
+    buys = trades[trades['size'] > 0]
+    buys = buys.groupby(['symbol', 'date'], sort=True)['size'].sum().reset_index()
+    buy_dates = _epoch(buys['date'])
+    buy_symbols = buys['symbol'].values
+    buy_sizes = buys['size'].values.astype(float)
+    buy_adjustment = np.zeros(len(buys))
+    window = pd.Timedelta(window).value
+
+    is_loss = (gain < 0) & (size > 0)
+    close_dates = _epoch(result['close_date'])
+    open_dates = _epoch(result['open_date'])
+    symbols = result['symbol'].values
+    (size_list, gain_list, open_date_list) = (size.tolist(), gain.tolist(), open_dates.tolist())
+    symbol_starts = np.searchsorted(buy_symbols, np.unique(buy_symbols))
+    symbol_bounds = dict(zip(np.unique(buy_symbols), zip(symbol_starts, np.append(symbol_starts[1:], len(buys)))))
+
+    loss_rows = np.flatnonzero(is_loss)
+    loss_rows = loss_rows[np.lexsort((close_dates[loss_rows], symbols[loss_rows]))]  # By symbol, then close date
+    (loss_symbols, loss_starts) = np.unique(symbols[loss_rows], return_index=True)
+    loss_ends = np.append(loss_starts[1:], len(loss_rows))
+
+    for (symbol, s0, s1) in zip(loss_symbols, loss_starts, loss_ends):
+        if symbol not in symbol_bounds:
+            continue
+        (b0, b1) = symbol_bounds[symbol]
+        dates = buy_dates[b0:b1]
+        losses = loss_rows[s0:s1]
+        lo = np.searchsorted(dates, close_dates[losses] - window, side='left')
+        hi = np.searchsorted(dates, close_dates[losses] + window, side='right')
+        cumulative_capacity = np.append(0, np.cumsum(buy_sizes[b0:b1]))
+        candidates = (cumulative_capacity[hi] - cumulative_capacity[lo]) > 0  # Losses with no purchases in their window are skipped
+
+        # Matching is sequential, since each replacement share is used once. It runs on plain floats
+        # and only visits losses which have a purchase in their window.
+        dates = dates.tolist()
+        capacity = buy_sizes[b0:b1].tolist()
+        adjustment_by_buy = [0.0]*len(capacity)
+        first_available = 0
+        for (row, l, h) in zip(losses[candidates].tolist(), lo[candidates].tolist(), hi[candidates].tolist()):
+            remaining = size_list[row]
+            loss_per_share = -gain_list[row] / remaining
+            own_purchase = open_date_list[row]
+            j = max(l, first_available)
+            while (j < h) and (remaining > 0):
+                if (capacity[j] > 0) and (dates[j] != own_purchase):  # The lot's own purchase is not a replacement
+                    matched = min(capacity[j], remaining)
+                    capacity[j] -= matched
+                    remaining -= matched
+                    adjustment_by_buy[j] += matched * loss_per_share
+                j += 1
+            while (first_available < len(capacity)) and (capacity[first_available] == 0):
+                first_available += 1
+            wash_shares[row] = size_list[row] - remaining
+            disallowed[row] = wash_shares[row] * loss_per_share
+        buy_adjustment[b0:b1] = adjustment_by_buy
+
+    if (buy_adjustment != 0).any():
+        adjustments = buys.assign(basis_adjustment_per_share=buy_adjustment / buy_sizes)
+        adjustments = adjustments[adjustments['basis_adjustment_per_share'] != 0]
+        keys = pd.MultiIndex.from_arrays([result['symbol'], result['open_date']])
+        per_share = adjustments.set_index(['symbol', 'date'])['basis_adjustment_per_share'].reindex(keys).fillna(0).values
+        adjustment = per_share * size
+
+    result['wash_sale_shares'] = wash_shares
+    result['wash_sale_disallowed'] = disallowed
+    result['basis_adjustment'] = adjustment
+    return result
+
+
+def after_tax_gains(capital_gains, trades, short_term_rate=0.37, long_term_rate=0.20, window=WASH_SALE_WINDOW):
+    """
+    Classifies gains by term, applies wash sale rules and computes the tax on each realized gain.
+
+    The result has the columns of :func:`wash_sales` and :func:`classify_gains`, plus `taxable_gain`
+    (the gain, less disallowed losses and basis adjustments) and `tax`. Losses produce a negative tax,
+    i.e. they are assumed to offset other gains at the same rate.
+    """
+    result = classify_gains(wash_sales(capital_gains, trades, window=window))
+    result['taxable_gain'] = _gain(result) + result['wash_sale_disallowed'] - result['basis_adjustment']
+    rate = np.where(result['term'].values == 'long', long_term_rate, short_term_rate)
+    result['tax'] = result['taxable_gain'] * rate
+    return result
+
+
+def after_tax_equity(strategy_values, gains, dividends=None, dividend_rate=0.37):
+    """
+    Builds an after-tax equity curve from `Broker.strategy_values()` and the output of :func:`after_tax_gains`.
+
+    Taxes are accrued when gains are realized (and dividends paid), and the cumulative tax up to each date
+    is subtracted from the equity (cash + long + short equities). Tax is matched to dates with a single
+    `searchsorted`, so this is linear in the size of the inputs.
+
+    >>> values = pd.DataFrame({'date': pd.to_datetime(['2020-03-02', '2020-06-01', '2020-06-02']),
+    ...                        'cash': [850.0, 1030.0, 1030.0], 'long_equities': [150.0, 0.0, 0.0], 'short_equities': [0.0, 0.0, 0.0]})
+    >>> gains = pd.DataFrame({'close_date': pd.to_datetime(['2020-06-01']), 'tax': [7.4]})
+    >>> after_tax_equity(values, gains)
+            date  equity  tax  after_tax_equity
+    0 2020-03-02  1000.0  0.0            1000.0
+    1 2020-06-01  1030.0  7.4            1022.6
+    2 2020-06-02  1030.0  7.4            1022.6
+    """
+    result = strategy_values[['date']].copy()
+    result['equity'] = (strategy_values['cash'] + strategy_values['long_equities'] + strategy_values['short_equities']).values
+    valuation_dates = _epoch(result['date'])
+
+    tax = np.zeros(len(result) + 1)
+    events = [(_epoch(gains['close_date']), gains['tax'].values)]
+    if (dividends is not None) and (len(dividends) > 0):
+        events.append((_epoch(dividends['ex_date']), dividends['amount'].values * dividend_rate))
+    for (dates, amounts) in events:
+        # A tax event on a valuation date belongs to that date
+        positions = np.searchsorted(valuation_dates, dates, side='left')
+        np.add.at(tax, positions, amounts)
+    result['tax'] = np.cumsum(tax)[:-1]
+    result['after_tax_equity'] = result['equity'] - result['tax']
+    return result
@@ -0,0 +1,125 @@
+import pandas as pd
+import numpy as np
+if __package__ is None or __package__ == '':
+    from _utils import wall_clock_ns
+    from market_data import TradeableAsset
+else:
+    from ._utils import wall_clock_ns
+    from .market_data import TradeableAsset
+
+
+__all__ = ['UniverseMetrics']
+
+
+class UniverseMetrics:
+    """
+    Date x symbol matrices of the metrics strategies use to pick a tradable universe: the close, the mean dollar
+    volume over the last :param window: market days, the number of bars of history, and the cross-sectional rank
+    of the dollar volume (1 is the most liquid symbol that day). They are computed for all the :param assets:
+    (a dict of symbol -> TradeableAsset) in one vectorized pass, so picking a day's universe reads one row, in
+    O(symbols), rather than the price history of every symbol.
+
+    Days are looked up causally: before or after the open of :param dt:, the row used is the last market day
+    before it, i.e. the same bars get_censored(dt) reveals. A symbol is only a candidate if it traded that day.
+
+    The matrices are built a symbol at a time, so the only full-size arrays are the four kept. With
+    :param compact: (as for the broker's compact mode), the close, dollar volume and rank are stored as float32
+    and the history in the smallest unsigned integer type which holds the number of days, roughly halving them.
+
+    >>> from daywalker.market_data import TradeableAsset
+    >>> def asset(symbol, start, closes, volume):
+    ...     return TradeableAsset(symbol, pd.DataFrame({'date': pd.bdate_range(start, periods=len(closes)), 'open': closes,
+    ...         'high': closes, 'low': closes, 'close': closes, 'volume': volume, 'divCash': 0.0, 'splitFactor': 1.0}))
+    >>> um = UniverseMetrics({'acc': asset('acc', '2004-08-12', [17.5, 17.5, 17.6], 1000),
+    ...                       'xyz': asset('xyz', '2004-08-12', [2.0, 2.1], 20000),
+    ...                       'new': asset('new', '2004-08-16', [50.0], 10)}, window=2)
+    >>> um.metrics('2004-08-16')  # As of the close on the 13th
+         close  dollar_volume  history  dollar_volume_rank
+    acc   17.5        17500.0        2                 2.0
+    xyz    2.1        41000.0        2                 1.0
+    >>> um.select('2004-08-16', top=1, min_price=5.0)
+    ['acc']
+    >>> um.select('2004-08-17', min_history=2)  # Most liquid first; xyz has been delisted
+    ['acc']
+    >>> small = UniverseMetrics({'acc': asset('acc', '2004-08-12', [17.5, 17.5, 17.6], 1000).compacted()}, compact=True)
+    >>> small.close.dtype, small.history.dtype, small.metrics('2004-08-18')['close'].tolist()
+    (dtype('float32'), dtype('uint8'), [17.6])
+    """
+    RANK_CHUNK = 256  # Days ranked at a time, which bounds the temporaries of the ranking
+
+    def __init__(self, assets, window=20, compact=False):
+        self.window = window
+        self.compact = compact
+        self.symbols = np.array(sorted(assets), dtype=object)
+        self.days = np.unique(np.concatenate([assets[s].days for s in self.symbols])) if len(assets) > 0 else np.array([], dtype=np.int64)
+        shape = (len(self.days), len(self.symbols))
+        dtype = np.float32 if compact else np.float64
+        self.close = np.full(shape, np.nan, dtype=dtype)
+        self.dollar_volume = np.full(shape, np.nan, dtype=dtype)
+        self.history = np.zeros(shape, dtype=(np.min_scalar_type(len(self.days)) if compact else np.int32))
+        for (j, symbol) in enumerate(self.symbols):
+            asset = assets[symbol]
+            rows = np.searchsorted(self.days, asset.days)
+            close = asset.exact_price(asset.df['close'].values)
+            self.close[rows, j] = close
+            # The mean over the last window market days, of those on which the symbol traded
+            traded_value = np.full(len(self.days), np.nan)
+            traded_value[rows] = close * (asset.df['volume'].values * asset.volume_scale)
+            self.dollar_volume[rows, j] = pd.Series(traded_value).rolling(window, min_periods=1).mean().values[rows]
+            traded = np.zeros(len(self.days), dtype=self.history.dtype)
+            traded[rows] = 1
+            self.history[:, j] = np.cumsum(traded, dtype=self.history.dtype)
+
+        self.dollar_volume_rank = np.empty(shape, dtype=dtype)
+        for start in range(0, len(self.days), self.RANK_CHUNK):
+            chunk = pd.DataFrame(self.dollar_volume[start:start + self.RANK_CHUNK])
+            self.dollar_volume_rank[start:start + self.RANK_CHUNK] = chunk.rank(axis=1, ascending=False, method='first').values
+
+    def nbytes(self):
+        return self.close.nbytes + self.dollar_volume.nbytes + self.history.nbytes + self.dollar_volume_rank.nbytes
+
+    def row(self, dt):
+        """The row of the last market day before :param dt:, or -1 if there is none."""
+        return int(np.searchsorted(self.days, wall_clock_ns(dt), side='left')) - 1
+
+    def metrics(self, dt):
+        """The metrics of the symbols which traded on the last market day before :param dt:, indexed by symbol."""
+        row = self.row(dt)
+        if row < 0:
+            return pd.DataFrame(columns=['close', 'dollar_volume', 'history', 'dollar_volume_rank'])
+        columns = np.flatnonzero(~np.isnan(self.close[row]))
+        close = self.close[row, columns]
+        if self.compact:  # Undoes the float32 rounding, like TradeableAsset.exact_price
+            close = np.round(close.astype(np.float64), TradeableAsset.PRICE_DECIMALS)
+        return pd.DataFrame({'close': close, 'dollar_volume': self.dollar_volume[row, columns].astype(np.float64),
+                             'history': self.history[row, columns].astype(np.int64),
+                             'dollar_volume_rank': self.dollar_volume_rank[row, columns].astype(np.float64)},
+                            index=self.symbols[columns])
+
+    def select(self, dt, top=None, min_price=None, min_history=None):
+        """
+        The symbols eligible on :param dt:, most liquid first: those which traded on the last market day before it,
+        with a close of at least :param min_price: and at least :param min_history: bars, and of these the
+        :param top: with the highest dollar volume.
+        """
+        row = self.row(dt)
+        if row < 0:
+            return []
+        rank = self.dollar_volume_rank[row]
+        eligible = ~np.isnan(rank)
+        if min_price is not None:  # Rounded like the closes, so a close equal to it stays eligible
+            eligible &= self.close[row] >= self.close.dtype.type(min_price)
+        if min_history is not None:
+            eligible &= self.history[row] >= min_history
+        columns = np.flatnonzero(eligible)
+        if (top is not None) and (top < len(columns)):
+            columns = columns[np.argpartition(rank[columns], top)[:top]]
+        columns = columns[np.argsort(rank[columns])]
+        return list(self.symbols[columns])
+
+
+if __name__ == '__main__':
+    import sys
+    sys.path.append('.')
+    import doctest
+    doctest.testmod()
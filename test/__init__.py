@@ -6,10 +6,24 @@ import doctest
 import daywalker.market as dw_market
 import daywalker.broker as dw_broker
 import daywalker.accounting as dw_accounting
+import daywalker.censorship as dw_censorship
+import daywalker._utils as dw_utils
+import daywalker.tax as dw_tax
+import daywalker.analytics as dw_analytics
+import daywalker.risk as dw_risk
+import daywalker.market_data as dw_market_data
+import daywalker.loader as dw_loader
+import daywalker.fills as dw_fills
+import daywalker.resampling as dw_resampling
+import daywalker.memoize as dw_memoize
+import daywalker.indicators as dw_indicators
+import daywalker.schedule as dw_schedule
+import daywalker.orders as dw_orders
+import daywalker.universe as dw_universe
 import test.test_market as test_market
 
 def load_tests(loader, tests, ignore):
-    for module in [dw_market, dw_broker, dw_accounting]:
+    for module in [dw_market, dw_broker, dw_accounting, dw_censorship, dw_utils, dw_tax, dw_analytics, dw_risk, dw_market_data, dw_loader, dw_fills, dw_resampling, dw_memoize, dw_indicators, dw_schedule, dw_orders, dw_universe]:
         tests.addTests(doctest.DocTestSuite(module))
     tests.addTests(doctest.DocFileSuite("../readme.md"))
 
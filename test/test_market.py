@@ -2,6 +2,17 @@ import unittest
 import pandas as pd
 from daywalker import TradeableAsset, Market, Strategy
 from daywalker.broker import InteractiveBrokers
+from daywalker.market import _TestStrategy
+from daywalker.memoize import FeatureCache, memoize, function_key
+from daywalker.schedule import Schedule
+from daywalker.censorship import BitemporalCensoredView, CensoredData, CensoredView, PartitionedCensoredView
+from daywalker._utils import frame_bytes
+from daywalker.risk import RiskLimits
+from daywalker.orders import OrderBook
+import numpy as np
+import tempfile
+import subprocess
+import os
 import sys
 
 class TestStrategy(Strategy):
@@ -19,6 +30,130 @@ class TestStrategy(Strategy):
         return None
 
 
+class SellAfterSplitStrategy(TestStrategy):
+    def pre_close(self, dt, broker, trades, other_data):
+        if dt == pd.Timestamp('2004-08-18'):
+            broker.limit_on_close('acc', price=1, size=20, is_buy=False, meta={})
+
+
+
+@memoize
+def last_close(prices, offset=1):
+    return prices['close'].values[-offset] if len(prices) >= offset else None
+
+
+def mean_of_closes(prices, windows=(2, 3)):
+    return [prices['close'].values[-w:].mean() for w in windows]
+
+
+def make_offset_feature(offset):
+    def feature(prices):
+        return prices['close'].values[-1] + offset
+    return feature
+
+
+class FeatureStrategy(Strategy):
+    def __init__(self):
+        self.features = []
+
+    def pre_open(self, dt, broker, trades, other_data):
+        self.features.append(last_close(broker, 'acc', offset=1))
+
+    def pre_close(self, dt, broker, trades, other_data):
+        return None
+
+
+def monthly_prices(days):
+    """Prices of acc, with a split and a dividend, and of xyz, which has both too and is delisted half way through."""
+    rng = np.random.default_rng(0)
+    def prices(days, split_day, div_day):
+        close = np.round(20 * np.cumprod(1 + rng.normal(0, 0.02, len(days))), 2)
+        return pd.DataFrame({'date': days, 'open': close, 'high': close, 'low': close, 'close': close, 'volume': 10**6,
+                             'divCash': np.where(np.arange(len(days)) == div_day, 0.25, 0.0),
+                             'splitFactor': np.where(np.arange(len(days)) == split_day, 2.0, 1.0)})
+    return (prices(days, split_day=30, div_day=50), prices(days[:45], split_day=10, div_day=20))
+
+
+class MonthlyStrategy(Strategy):
+    """Buys at the start of each month and sells half of it again at the close."""
+    def __init__(self, scheduled):
+        self.scheduled = scheduled
+        self.month = None
+
+    def schedule(self):
+        return Schedule(calendar='month_start', on_fill=(self.scheduled == 'on_fill')) if self.scheduled else None
+
+    def pre_open(self, dt, broker, trades, other_data):
+        self.acting = (dt.month != self.month)
+        self.month = dt.month
+        if self.acting:
+            for symbol in ['acc', 'xyz']:
+                broker.limit_on_open(symbol, price=1000, size=10, is_buy=True, meta={})
+
+    def pre_close(self, dt, broker, trades, other_data):
+        if self.acting:
+            broker.limit_on_close('acc', price=1, size=5, is_buy=False, meta={})
+
+
+class CountingBroker(InteractiveBrokers):
+    """Counts the calls to performance(), which values the dates deferred so far."""
+    performance_calls = 0
+
+    def performance(self):
+        self.performance_calls += 1
+        return InteractiveBrokers.performance(self)
+
+
+class DipBuyingStrategy(Strategy):
+    """Buys acc once its open dips to a limit, either by resubmitting a day order or with one resting order."""
+    def __init__(self, limit, resting, scheduled=False):
+        self.limit = limit
+        self.resting = resting
+        self.scheduled = scheduled
+        self.started = False
+        self.filled = False
+
+    def schedule(self):
+        return Schedule(calendar='quarter_start') if self.scheduled else None
+
+    def pre_open(self, dt, broker, trades, other_data):
+        if self.resting and not self.started:
+            broker.place_order('acc', price=self.limit, size=10, is_buy=True, meta={'trade_id': 'dip'})
+            cancelled = broker.place_order('acc', price=1000, size=10, is_buy=True)
+            broker.place_order('xyz', price=1, size=10, is_buy=True, expires=dt)
+            self.cancelled = broker.cancel_order(cancelled)
+        elif not (self.resting or self.filled):
+            broker.limit_on_open('acc', price=self.limit, size=10, is_buy=True, meta={'trade_id': 'dip'})
+        self.started = True
+
+    def pre_close(self, dt, broker, trades, other_data):
+        self.filled = self.filled or (len(trades) > 0)
+
+
+class UniverseStrategy(Strategy):
+    """Records the universe it is given each day, alongside one picked from each symbol's prices before that day."""
+    def __init__(self, days, window, prices):
+        self.days = days
+        self.prices = prices
+        self.window = window
+        self.picked = []
+
+    def pre_open(self, dt, broker, trades, other_data):
+        filters = dict(top=2, min_price=19.0, min_history=15)
+        market_days = self.days[self.days < dt][-self.window:]
+        dollar_volume = {}
+        for (symbol, prices) in self.prices.items():
+            prices = prices[prices['date'] < dt].set_index('date')
+            if (len(market_days) > 0) and (len(prices) >= filters['min_history']) and (prices.index[-1] == market_days[-1]) \
+                    and (prices['close'].iloc[-1] >= filters['min_price']):
+                recent = prices[prices.index >= market_days[0]]
+                dollar_volume[symbol] = (recent['close'] * recent['volume']).mean()
+        by_liquidity = sorted(dollar_volume, key=lambda s: -dollar_volume[s])[:filters['top']]
+        self.picked.append((broker.universe(window=self.window, **filters), by_liquidity))
+
+    def pre_close(self, dt, broker, trades, other_data):
+        return None
+
 
 class TestMarket(unittest.TestCase):
     def test_split1(self):
@@ -46,3 +181,500 @@ class TestMarket(unittest.TestCase):
         values = m.broker.strategy_values()
         self.assertTrue((values['cash'] == 9899).all())  # Cash should be 100 to purchase securities - commission of $1
         self.assertTrue((values['long_equities'] == 100).all())
+
+    def test_sell_after_split(self):
+        prices = pd.DataFrame({'date': [pd.Timestamp('2004-08-12 00:00:00-0400', tz='America/New_York'), pd.Timestamp('2004-08-13 00:00:00-0400', tz='America/New_York'),
+                                        pd.Timestamp('2004-08-16 00:00:00-0400', tz='America/New_York'), pd.Timestamp('2004-08-17 00:00:00-0400', tz='America/New_York'),
+                                        pd.Timestamp('2004-08-18 00:00:00-0400', tz='America/New_York')],
+                                'open': [10, 10, 10, 5, 5],
+                                'high': [10, 10, 10, 5, 5],
+                                'low': [10, 10, 10, 5, 5],
+                                'close': [10, 10, 10, 5, 6],
+                                'volume': [2545100, 593000, 684700, 295900, 121300],
+                                'divCash': [0.0, 0.0, 0.0, 0.00, 0.0],
+                                'splitFactor': [1.0, 1.0, 1.0, 2.0, 1.0]})
+        ta = TradeableAsset('acc', prices)
+        b = InteractiveBrokers(10*1000, {'acc': ta})
+        m = Market(prices['date'].min(), prices['date'].max(), SellAfterSplitStrategy(), b)
+
+        m.run()
+        # All 20 post-split shares can be sold, closing the position
+        self.assertEqual(len(m.broker.positions()), 0)
+        cg = m.broker.capital_gains()
+        self.assertEqual(cg['size'].sum(), 20)
+        self.assertEqual(cg['open_date'].iloc[0], pd.Timestamp('2004-08-12 09:30:00-0400', tz='America/New_York'))
+
+    def test_performance_matches_history(self):
+        prices = pd.DataFrame({'date': [pd.Timestamp('2004-08-12 00:00:00-0400', tz='America/New_York'), pd.Timestamp('2004-08-13 00:00:00-0400', tz='America/New_York'),
+                                        pd.Timestamp('2004-08-16 00:00:00-0400', tz='America/New_York'), pd.Timestamp('2004-08-17 00:00:00-0400', tz='America/New_York'),
+                                        pd.Timestamp('2004-08-18 00:00:00-0400', tz='America/New_York')],
+                                'open': [17.5, 17.5, 17.54, 17.35, 8.62],
+                                'high': [17.58, 17.51, 17.54, 17.4, 8.65],
+                                'low': [17.5, 17.5, 17.5, 17.15, 8.5],
+                                'close': [17.5, 17.51, 17.5, 17.34, 8.56],
+                                'volume': [2545100, 593000, 684700, 295900, 121300],
+                                'divCash': [0.0, 0.0, 0.0, 0.10, 0.0],
+                                'splitFactor': [1.0, 1.0, 1.0, 1.0, 2.0]})
+        ta = TradeableAsset('acc', prices)
+        b = InteractiveBrokers(10*1000, {'acc': ta}, group_gains_by=['open_trade_id'])
+        m = Market(prices['date'].min(), prices['date'].max(), _TestStrategy('acc'), b)
+        m.run()
+
+        summary = b.performance().summary()
+        trades = b.trades()
+        self.assertAlmostEqual(summary['turnover'], (trades['price']*trades['size']).abs().sum())
+        self.assertAlmostEqual(summary['commissions'], trades['commission'].sum())
+
+        values = b.strategy_values()
+        equity = values['cash'] + values['long_equities'] + values['short_equities']
+        self.assertAlmostEqual(summary['return_std'], equity.pct_change().std())
+        self.assertAlmostEqual(summary['max_drawdown'], (equity / equity.cummax() - 1).min())
+
+        expected = b.capital_gains().groupby('open_trade_id')['gain'].sum()
+        grouped = b.performance().grouped_gains('open_trade_id')['total']
+        for (k, v) in expected.items():
+            self.assertAlmostEqual(grouped[k], v)
+
+    def test_delisted_holding(self):
+        days = [pd.Timestamp('2004-08-12'), pd.Timestamp('2004-08-13'), pd.Timestamp('2004-08-16'), pd.Timestamp('2004-08-17'), pd.Timestamp('2004-08-18')]
+        def prices(days, close):
+            return pd.DataFrame({'date': days, 'open': 10.0, 'high': 10.0, 'low': 10.0, 'close': close, 'volume': 1000,
+                                 'divCash': 0.0, 'splitFactor': 1.0})
+        # acc stops trading after 2004-08-13, while xyz keeps the market open
+        b = InteractiveBrokers(10*1000, {'acc': TradeableAsset('acc', prices(days[:2], [10.0, 12.0])),
+                                         'xyz': TradeableAsset('xyz', prices(days, 10.0))})
+        m = Market(days[0], days[-1], TestStrategy(), b)
+        m.run()
+
+        # The delisted holding is valued at its final close from then on
+        values = m.broker.strategy_values()
+        self.assertTrue((values['long_equities'].iloc[1:] == 120).all())
+        self.assertEqual(list(b.symbol_index().names(b.symbol_index().live(days[-1]))), ['xyz'])
+        delisted = b.delisted_positions(days[-1])
+        self.assertEqual(list(delisted['symbol']), ['acc'])
+        self.assertEqual(delisted['final_close'].iloc[0], 12.0)
+        self.assertEqual(delisted['delisting_date'].iloc[0], pd.Timestamp('2004-08-13'))
+
+    def test_participation_rate(self):
+        days = [pd.Timestamp('2004-08-12'), pd.Timestamp('2004-08-13')]
+        prices = pd.DataFrame({'date': days, 'open': 10.0, 'high': 10.0, 'low': 10.0, 'close': 10.0, 'volume': [1000, 1000],
+                               'divCash': 0.0, 'splitFactor': 1.0})
+        b = InteractiveBrokers(10*1000, {'acc': TradeableAsset('acc', prices)}, participation_rate=0.1)
+
+        class TwoOrders(TestStrategy):
+            def pre_open(self, dt, broker, trades, other_data):
+                if not self.bought:
+                    broker.limit_on_open('acc', price=10, size=150, is_buy=True, meta={'trade_id': 'a'})
+                    broker.limit_on_open('acc', price=10, size=50, is_buy=True, meta={'trade_id': 'b'})
+                    self.bought = True
+
+        m = Market(days[0], days[-1], TwoOrders(), b)
+        m.run()
+        # 10% of the 1000 shares traded in the auction is shared 3:1 between the two orders
+        trades = b.trades()
+        self.assertEqual(list(trades['size']), [75, 25])
+        self.assertEqual(list(trades['trade_id']), ['a', 'b'])  # The strategy's meta is left as it was
+        self.assertNotIn('requested_size', trades.columns)
+        self.assertEqual(list(b.unfilled_orders()['requested_size']), [150, 50])
+        self.assertEqual(list(b.unfilled_orders()['unfilled_size']), [75, 25])
+
+    def test_compact_storage(self):
+        prices = pd.DataFrame({'date': pd.date_range('2004-08-12', periods=5, freq='B'),
+                               'open': [17.5, 17.5, 17.54, 17.35, 8.62], 'high': [17.58, 17.51, 17.54, 17.4, 8.65],
+                               'low': [17.5, 17.5, 17.5, 17.15, 8.5], 'close': [17.5, 17.51, 17.5, 17.34, 8.56],
+                               'volume': [2545100, 593000, 684700, 295900, 121300], 'divCash': [0.0, 0.0, 0.0, 0.10, 0.0],
+                               'splitFactor': [1.0, 1.0, 1.0, 1.0, 2.0]})
+        results = []
+        for compact in [False, True]:
+            b = InteractiveBrokers(10*1000, {'acc': TradeableAsset('acc', prices.copy())}, compact=compact)
+            Market(prices['date'].min(), prices['date'].max(), _TestStrategy('acc'), b).run()
+            results.append(b)
+        (full, compact) = results
+        # Compact storage doesn't change any of the accounting
+        self.assertEqual(full.cash(), compact.cash())
+        pd.testing.assert_frame_equal(full.strategy_values(), compact.strategy_values())
+        self.assertEqual(str(compact.trades()['symbol'].dtype), 'category')
+        self.assertEqual(str(compact.capital_gains()['open_trade_id'].dtype), 'category')
+        self.assertLess(compact.storage_bytes()['prices'], full.storage_bytes()['prices'])
+
+    def test_feature_cache(self):
+        days = pd.date_range('2004-08-12', periods=5, freq='B')
+        prices = pd.DataFrame({'date': days, 'open': 10.0, 'high': 10.0, 'low': 10.0, 'close': [1.0, 2.0, 3.0, 4.0, 5.0],
+                               'volume': 1000, 'divCash': 0.0, 'splitFactor': 1.0})
+        directory = tempfile.mkdtemp()
+        runs = []
+        for close in [[1.0, 2.0, 3.0, 4.0, 5.0], [1.0, 2.0, 3.0, 4.0, 5.0], [1.0, 2.0, 3.0, 9.0, 5.0]]:
+            cache = FeatureCache(directory)
+            strategy = FeatureStrategy()
+            b = InteractiveBrokers(10*1000, {'acc': TradeableAsset('acc', prices.assign(close=close))})
+            Market(days[0], days[-1], strategy, b, feature_cache=cache).run()
+            runs.append((strategy.features, cache.hits, cache.misses))
+        # Features only ever see the history before the open
+        self.assertEqual(runs[0], ([None, 1.0, 2.0, 3.0, 4.0], 0, 5))
+        # The second run is served from the disk cache
+        self.assertEqual(runs[1], ([None, 1.0, 2.0, 3.0, 4.0], 5, 0))
+        # Changing a close only invalidates the dates whose history includes it
+        self.assertEqual(runs[2], ([None, 1.0, 2.0, 3.0, 9.0], 4, 1))
+
+    def test_function_key(self):
+        # The same in every process, even for functions containing nested code objects
+        script = ('from %s import mean_of_closes; from daywalker.memoize import function_key; print(function_key(mean_of_closes))'
+                  % mean_of_closes.__module__)
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        keys = {subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True, env=env).stdout.strip()
+                for _ in range(2)}
+        self.assertEqual(keys, {function_key(mean_of_closes)})
+        # Closures over different values, and different defaults, are different functions
+        self.assertNotEqual(function_key(make_offset_feature(1)), function_key(make_offset_feature(2)))
+        self.assertEqual(function_key(make_offset_feature(1)), function_key(make_offset_feature(1)))
+        original = function_key(mean_of_closes)
+        mean_of_closes.__defaults__ = ((5, 10),)
+        try:
+            self.assertNotEqual(function_key(mean_of_closes), original)
+        finally:
+            mean_of_closes.__defaults__ = ((2, 3),)
+
+    def test_data_features_are_keyed_on_censored_rows(self):
+        days = pd.date_range('2004-08-12', periods=6, freq='B', tz='America/New_York')
+        ratings = pd.DataFrame({'date': days, 'rating': [1.0, 2.0, 3.0, 4.0, 5.0, 6.0]})
+        views = {'sorted': CensoredView(ratings, censor_on_index=False, censor_column='date'),
+                 'unsorted': CensoredView(ratings.iloc[::-1], censor_on_index=False, censor_column='date'),
+                 'partitioned': PartitionedCensoredView({days[0]: ratings[:3], days[3]: ratings[3:]}, censor_on_index=False,
+                                                        censor_column='date', prefetch=0, reader=lambda df: df)}
+        edited = CensoredView(ratings.assign(rating=[1.0, 2.0, 3.0, 4.0, 9.0, 6.0]), censor_on_index=False, censor_column='date')
+        for (name, view) in views.items():
+            same = CensoredView(view.get_censored(days[-1]).copy(), censor_on_index=False, censor_column='date')
+            for (i, dt) in enumerate(days):
+                self.assertEqual(view.fingerprint(dt), view.fingerprint(dt), name)
+                self.assertNotEqual(view.fingerprint(dt), view.fingerprint(days[i - 1]) if i > 0 else None, name)
+            if name == 'sorted':
+                self.assertEqual([same.fingerprint(dt) for dt in days], [view.fingerprint(dt) for dt in days])
+                self.assertEqual([edited.fingerprint(dt) == view.fingerprint(dt) for dt in days], [True] * 4 + [False] * 2)
+
+        @memoize
+        def total(data):
+            return data['rating'].sum()
+        cache = FeatureCache()
+        other_data = CensoredData(feature_cache=cache)
+        for (name, view) in views.items():
+            other_data.add_data(name, view)
+        for _ in range(2):
+            for dt in days:
+                other_data.set_date(dt)
+                self.assertEqual({total(other_data, name) for name in views}, {other_data.get_data('sorted')['rating'].sum()})
+        self.assertEqual((cache.misses, cache.hits), (3 * len(days), 3 * len(days)))  # The second pass is served from the cache
+
+    def test_indicators_match_censored_history(self):
+        days = pd.date_range('2004-08-12', periods=30, freq='B')
+        close = 10 + (pd.Series(range(30)) % 7).values
+        prices = pd.DataFrame({'date': days, 'open': close, 'high': close + 1.0, 'low': close - 1.0, 'close': close,
+                               'volume': 1000, 'divCash': 0.0, 'splitFactor': 1.0})
+        ta = TradeableAsset('acc', prices)
+        for dt in days[1:]:
+            history, _ = ta.get_censored(dt)
+            self.assertEqual(ta.indicator(dt, 'max'), history['close'].max())
+            if len(history) > 1:
+                self.assertAlmostEqual(ta.indicator(dt, 'std'), history['close'].std())
+            if len(history) >= 5:
+                self.assertAlmostEqual(ta.indicator(dt, 'mean', window=5), history['close'].iloc[-5:].mean())
+            else:
+                self.assertTrue(pd.isnull(ta.indicator(dt, 'mean', window=5)))
+
+    def test_schedule_matches_daily_run(self):
+        days = pd.date_range('2004-08-12', periods=80, freq='B')
+        (acc, xyz) = monthly_prices(days)
+        brokers = []
+        for scheduled in [False, True]:
+            b = InteractiveBrokers(10*1000, {'acc': TradeableAsset('acc', acc), 'xyz': TradeableAsset('xyz', xyz)})
+            Market(days[0], days[-1], MonthlyStrategy(scheduled), b).run()
+            brokers.append(b)
+        (daily, scheduled) = brokers
+        # Sleeping through the idle days gives the same results as running the strategy on every day
+        pd.testing.assert_frame_equal(daily.strategy_values(), scheduled.strategy_values())
+        pd.testing.assert_frame_equal(daily.dividends(), scheduled.dividends())
+        pd.testing.assert_frame_equal(daily.positions(), scheduled.positions())
+        self.assertEqual(daily.cash(), scheduled.cash())
+        self.assertEqual(daily.performance().summary(), scheduled.performance().summary())
+        self.assertEqual(daily.exposure().net(), scheduled.exposure().net())
+
+    def test_deferred_valuation(self):
+        days = pd.date_range('2004-08-12', periods=80, freq='B')
+        (acc, xyz) = monthly_prices(days)
+        for scheduled in [False, True, 'on_fill']:
+            brokers = []
+            for deferred_valuation in [False, True]:
+                b = CountingBroker(10*1000, {'acc': TradeableAsset('acc', acc), 'xyz': TradeableAsset('xyz', xyz)},
+                                   deferred_valuation=deferred_valuation)
+                Market(days[0], days[-1], MonthlyStrategy(scheduled), b).run()
+                self.assertEqual(b.performance_calls, 0)  # Nothing is valued before the end of the run
+                brokers.append(b)
+            (daily, deferred) = brokers
+            # Valuing every day at the end gives exactly the values recorded during the run
+            pd.testing.assert_frame_equal(daily.strategy_values(), deferred.strategy_values())
+            self.assertEqual(daily.performance().summary(), deferred.performance().summary())
+            self.assertEqual(daily.exposure().net(), deferred.exposure().net())
+
+    def test_partitioned_view_drops_stale_prefetches(self):
+        days = pd.date_range('2004-08-02', periods=20, freq='B', tz='America/New_York')
+        partitions = {dt: dt for dt in days[::2]}  # Each partition is "read" from its start date
+        reader = lambda start: pd.DataFrame({'date': days[days.get_loc(start):days.get_loc(start) + 2], 'rating': 1.0})
+        view = PartitionedCensoredView(partitions, censor_on_index=False, censor_column='date', lookback=pd.Timedelta(days=3),
+                                       prefetch=3, reader=reader)
+        self.assertEqual(list(view.get_censored(days[0] - pd.Timedelta(days=1)).columns), ['date', 'rating'])
+        view.get_censored(days[0])
+        self.assertEqual(view.prefetching_partitions(), list(days[2:8:2]))
+        result = view.get_censored(days[16])  # Jumps past the lookback of everything prefetched so far
+        self.assertTrue(all(start >= days[14] for start in view.prefetching_partitions()))
+        self.assertEqual(list(result['date']), [d for d in days if days[16] - pd.Timedelta(days=3) <= d <= days[16]])
+        view.close()
+
+    def test_partitioned_view_appends_new_partitions(self):
+        days = pd.date_range('2004-08-02', periods=40, freq='B', tz='America/New_York')
+        ratings = pd.DataFrame({'date': days, 'rating': np.arange(40.0)})
+        partitions = {days[i]: ratings[i:i + 4] for i in range(0, 40, 4)}
+        full = CensoredView(ratings, censor_on_index=False, censor_column='date')
+        for lookback in [None, pd.Timedelta(days=10)]:
+            reads = []
+            view = PartitionedCensoredView(partitions, censor_on_index=False, censor_column='date', lookback=lookback, prefetch=0,
+                                           reader=lambda df: reads.append(df['date'].iloc[0]) or df)
+            for dt in days:
+                (result, expected) = (view.get_censored(dt), full.get_censored(dt))
+                if lookback is not None:  # Numbered from the first partition in the lookback
+                    (result, expected) = (result.reset_index(drop=True), expected[expected['date'] >= dt - lookback].reset_index(drop=True))
+                pd.testing.assert_frame_equal(result, expected)
+                # The visible partitions are only held once, in their concatenation
+                self.assertEqual(view.nbytes(), frame_bytes(view.df))
+            self.assertEqual(reads, list(days[::4]))  # Each partition is read once
+
+    def test_partitioned_new_data_matches_full_scan(self):
+        days = pd.date_range('2004-08-02', periods=30, freq='B', tz='America/New_York')
+        dates = pd.date_range('2004-07-28', periods=50, freq='D', tz='America/New_York')
+        ratings = pd.DataFrame({'date': days[[0, 1, 1, 5, 9, 10, 17, 25, 26]], 'rating': 1.0})
+        partitions = {days[0]: ratings[:4], days[8]: ratings[4:6], days[16]: ratings[6:]}
+        for censor_on_index in [False, True]:
+            (full, parts) = (ratings, partitions)
+            if censor_on_index:
+                (full, parts) = (ratings.set_index('date'), {k: v.set_index('date') for (k, v) in partitions.items()})
+            reads = []
+            view = PartitionedCensoredView(parts, censor_on_index=censor_on_index, censor_column='date', prefetch=0,
+                                           reader=lambda df: reads.append(len(df)) or df)
+            expected = CensoredView(full, censor_on_index=censor_on_index, censor_column='date').new_data_on(dates)
+            np.testing.assert_array_equal(view.new_data_on(dates), expected)
+            self.assertEqual((len(reads), view.loaded_partitions()), (3, []))  # Each partition read once, none kept
+
+    def test_bitemporal_view_matches_full_scan(self):
+        rng = np.random.default_rng(0)
+        observations = pd.date_range('2020-01-01', periods=30, freq='D', tz='America/New_York')
+        vintages = pd.DataFrame({'observed': np.repeat(observations, 3),
+                                 'known': np.repeat(observations, 3) + pd.to_timedelta(rng.integers(-2, 20, 90), unit='D'),
+                                 'value': np.arange(90)}).sample(frac=1, random_state=0)
+        view = BitemporalCensoredView(vintages, observation_column='observed', knowledge_column='known')
+        for dt in pd.date_range('2019-12-28', periods=60, freq='D', tz='America/New_York'):
+            known = vintages[vintages['known'] <= dt].sort_values(['observed', 'known'], kind='stable')
+            expected = known.groupby('observed').tail(1)
+            pd.testing.assert_frame_equal(view.get_censored(dt), expected)
+
+    def test_adjusted_prices_have_no_lookahead(self):
+        days = pd.date_range('2004-08-12', periods=40, freq='B')
+        rng = np.random.default_rng(1)
+        close = np.round(20 * np.cumprod(1 + rng.normal(0, 0.02, 40)), 2)
+        split = np.where(np.isin(np.arange(40), [12, 30]), [2.0], 1.0)
+        div = np.where(np.isin(np.arange(40), [20, 25]), 0.3, 0.0)
+        prices = pd.DataFrame({'date': days, 'open': close, 'high': close, 'low': close, 'close': close, 'volume': 1000,
+                               'divCash': div, 'splitFactor': split})
+        ta = TradeableAsset('acc', prices)
+        for (r, dt) in enumerate(days):
+            # Adjusting the raw history known on dt from scratch
+            history, _ = ta.get_censored(dt)
+            factor = np.ones(len(history))
+            for j in range(1, r + 1):
+                previous_close = prices['close'].iloc[j - 1] / split[j]
+                factor[:j] *= (1 - div[j] / previous_close) / split[j]
+            adjusted, _ = ta.get_adjusted(dt, window=10)
+            np.testing.assert_allclose(adjusted['close'].values, (history['close'].values * factor)[-10:], rtol=1e-12)
+            self.assertEqual(len(adjusted), min(r, 10))
+
+    def test_censored_history_is_a_copy(self):
+        days = pd.date_range('2004-08-12', periods=5, freq='B')
+        (acc, _) = monthly_prices(days)
+        ta = TradeableAsset('acc', acc)
+        before = ta.df.copy()
+        (history, _) = ta.get_censored(days[3])
+        history.loc[history.index[0], 'close'] = -1
+        pd.testing.assert_frame_equal(ta.df, before)
+        self.assertEqual(ta.get_censored(days[3])[0]['close'].iloc[0], before['close'].iloc[0])
+        ratings = pd.DataFrame({'date': days.tz_localize('America/New_York'), 'rating': 1.0})
+        partitions = {days[0].tz_localize('America/New_York'): ratings}
+        for view in [CensoredView(ratings, censor_on_index=False, censor_column='date'),
+                     PartitionedCensoredView(partitions, censor_on_index=False, censor_column='date', prefetch=0, reader=lambda df: df)]:
+            view.get_censored(days[2]).iloc[0, 1] = 99
+            self.assertEqual(view.get_censored(days[4])['rating'].iloc[0], 1.0)
+        self.assertEqual(ratings['rating'].iloc[0], 1.0)
+
+    def test_unowned_lots_leave_the_broker_unchanged(self):
+        days = pd.date_range('2004-08-12', periods=5, freq='B')
+        (acc, _) = monthly_prices(days)
+        b = InteractiveBrokers(10*1000, {'acc': TradeableAsset('acc', acc)}, risk_limits=RiskLimits())
+        b.limit_on_open('acc', days[0], price=1000, size=10, is_buy=True)
+        (cash, net) = (b.cash(), b.exposure().net())
+        with self.assertRaises(ValueError):
+            b.limit_on_close('acc', days[0], price=1, size=5, is_buy=False, lots=[99])
+        self.assertEqual((b.cash(), b.exposure().net(), len(b.trades())), (cash, net, 1))
+        self.assertEqual(b.positions()['size'].sum(), 10)
+
+    def test_trade_meta_is_interned_read_only(self):
+        days = pd.date_range('2004-08-12', periods=5, freq='B')
+        (acc, _) = monthly_prices(days)
+        b = InteractiveBrokers(10*1000, {'acc': TradeableAsset('acc', acc)})
+        trade = b.limit_on_open('acc', days[0], price=1000, size=1, is_buy=True, meta={'x': 1})
+        b.limit_on_open('acc', days[1], price=1000, size=1, is_buy=True, meta={'x': True})
+        with self.assertRaises(TypeError):
+            trade.meta['x'] = 2
+        # Equal values of different types aren't merged
+        self.assertEqual([type(v) for v in b.trades()['x']], [int, bool])
+        self.assertEqual([type(v) for v in b.positions()['x']], [int, bool])
+
+    def test_position_history(self):
+        days = pd.date_range('2004-08-12', periods=80, freq='B')
+        (acc, xyz) = monthly_prices(days)
+        b = InteractiveBrokers(10*1000, {'acc': TradeableAsset('acc', acc), 'xyz': TradeableAsset('xyz', xyz)})
+        b.position_history().CHECKPOINT_INTERVAL = 4  # Exercise lookups which start from a checkpoint
+        snapshots = {}
+
+        class Snapshots(MonthlyStrategy):
+            def pre_close(self, dt, broker, trades, other_data):
+                snapshots[dt + pd.Timedelta(hours=12)] = b.positions()  # Between the open and close auctions
+                MonthlyStrategy.pre_close(self, dt, broker, trades, other_data)
+
+        Market(days[0], days[-1], Snapshots(scheduled=False), b).run()
+        for (dt, positions) in snapshots.items():
+            pd.testing.assert_frame_equal(b.positions_at(dt).reset_index(drop=True), positions.reset_index(drop=True))
+        pd.testing.assert_frame_equal(b.positions_at(days[-1] + pd.Timedelta(days=1)).reset_index(drop=True), b.positions().reset_index(drop=True))
+
+        quantities = b.position_history().quantities(list(snapshots.keys()))
+        for (dt, positions) in snapshots.items():
+            if len(positions) == 0:
+                self.assertTrue((quantities.loc[dt] == 0).all())
+                continue
+            for (symbol, size) in positions.groupby('symbol')['size'].sum().items():
+                self.assertAlmostEqual(quantities.loc[dt, symbol], size)
+
+    def test_lazy_strategy_payloads(self):
+        days = pd.date_range('2004-08-12', periods=5, freq='B')
+        prices = pd.DataFrame({'date': days, 'open': [10, 10, 10, 5, 5], 'high': [10, 10, 10, 5, 5], 'low': [10, 10, 10, 5, 5],
+                               'close': [10, 10, 10, 5, 5], 'volume': 1000, 'divCash': 0.0, 'splitFactor': [1.0, 1.0, 1.0, 2.0, 1.0]})
+        seen = []
+
+        class Recorder(TestStrategy):
+            def pre_open(self, dt, broker, trades, other_data):
+                TestStrategy.pre_open(self, dt, broker, trades, other_data)
+                # Read after ordering, but still the positions as of the start of the session
+                seen.append((len(trades), list(trades.columns), list(broker.positions().get('size', []))))
+                trades['note'] = []  # Doesn't carry over to later payloads
+
+            def pre_close(self, dt, broker, trades, other_data):
+                if len(trades) > 0:  # The fill at the open, which len() counts without building a dataframe
+                    self.fill = (trades.is_built(), list(trades['size']), trades.is_built())
+                    trades['note'] = 'filled'
+                    self.fill += (list(trades.frame()['note']),)
+
+        b = InteractiveBrokers(10*1000, {'acc': TradeableAsset('acc', prices)})
+        strategy = Recorder()
+        Market(days[0], days[-1], strategy, b).run()
+        self.assertEqual(strategy.fill, (False, [10], True, ['filled']))
+        # The split on the 17th shows up from the next session, as when positions were built eagerly
+        self.assertEqual(seen, [(0, [], []), (0, [], [10]), (0, [], [10]), (0, [], [10]), (0, [], [20.0])])
+
+    def test_memory_report(self):
+        days = pd.date_range('2004-08-12', periods=80, freq='B')
+        (acc, xyz) = monthly_prices(days)
+        b = InteractiveBrokers(10*1000, {'acc': TradeableAsset('acc', acc), 'xyz': TradeableAsset('xyz', xyz)})
+        m = Market(days[0], days[-1], MonthlyStrategy(scheduled=False), b, memory_sample_every=10)
+        m.add_data('wsb', pd.DataFrame({'rating': 1.0}, index=days.tz_localize('America/New_York')))
+        m.run()
+
+        report = m.memory_report()
+        self.assertEqual(list(report.index), ['prices', 'trades', 'accounting', 'capital_gains', 'dividends', 'strategy_values',
+                                              'strategy_logs', 'other_data', 'feature_cache'])
+        self.assertTrue((report[['prices', 'trades', 'accounting', 'strategy_values', 'other_data']] > 0).all())
+        self.assertEqual(dict(b.lot_counts()), {'acc': len(b.lots('acc')), 'xyz': len(b.lots('xyz'))})
+
+        history = m.memory_history()
+        self.assertEqual(list(history['date']), list(days[::10]))
+        self.assertTrue(history['trades'].is_monotonic_increasing)
+        self.assertTrue(history['strategy_values'].is_monotonic_increasing)
+
+    def test_resting_orders(self):
+        days = pd.date_range('2004-08-12', periods=80, freq='B')
+        (acc, xyz) = monthly_prices(days)
+        limit = acc['open'].iloc[40:60].min()
+        brokers = []
+        for (resting, scheduled) in [(False, False), (True, False), (True, True)]:
+            b = InteractiveBrokers(10*1000, {'acc': TradeableAsset('acc', acc), 'xyz': TradeableAsset('xyz', xyz)})
+            strategy = DipBuyingStrategy(limit, resting=resting, scheduled=scheduled)
+            Market(days[0], days[-1], strategy, b).run()
+            brokers.append(b)
+        (daily, resting, scheduled) = brokers
+
+        # The resting order fills on the first open at or below its limit, just like resubmitting it every day
+        trades = daily.trades()
+        self.assertEqual(len(trades), 1)
+        self.assertEqual(trades['date'].iloc[0].normalize().tz_localize(None), days[np.argmax(acc['open'].values <= limit)])
+        for b in [resting, scheduled]:  # Also while the strategy sleeps through every day
+            pd.testing.assert_frame_equal(daily.trades(), b.trades())
+            pd.testing.assert_frame_equal(daily.strategy_values(), b.strategy_values())
+            self.assertEqual(len(b.resting_orders()), 0)  # Filled, cancelled or expired
+
+        b = InteractiveBrokers(10*1000, {'acc': TradeableAsset('acc', acc)})
+        order_id = b.place_order('acc', price=limit, size=10, is_buy=True, expires=days[50])
+        self.assertEqual(b.match_resting_orders(days[0], 'open'), [])
+        self.assertTrue(b.replace_order(order_id, size=4))
+        self.assertEqual(list(b.resting_orders()[['order_id', 'size', 'expires']].iloc[0]), [order_id, 4, days[50]])
+        self.assertEqual([t.size for t in b.match_resting_orders(days[np.argmax(acc['open'].values <= limit)], 'open')], [4])
+        self.assertFalse(b.cancel_order(order_id))
+
+        # Resting orders share the auction's volume with the strategy's own orders
+        b = InteractiveBrokers(10*1000, {'acc': TradeableAsset('acc', acc.assign(volume=1000))}, participation_rate=0.1)
+        b.place_order('acc', price=30, size=100, is_buy=True)
+        b.limit_on_open('acc', days[0], price=30, size=100, is_buy=True)
+        b.match_resting_orders(days[0], 'open')
+        self.assertEqual(b.trades()['size'].sum(), 100)
+        self.assertEqual(list(b.resting_orders()['size']), [100])
+
+    def test_order_book_drops_dead_entries(self):
+        book = OrderBook()
+        order_id = book.add('acc', 'open', price=10.0, size=5, is_buy=True, expires='2030-01-03')
+        book.add('acc', 'open', price=11.0, size=5, is_buy=False)
+        for n in range(10000):  # Cancel/replace loops away from the auction price
+            book.replace(order_id, price=10.0 + (n % 3) / 100)
+            if n % 100 == 0:
+                self.assertEqual(book.crossing('acc', 'open', 10.5), [])
+        self.assertEqual(len(book), 2)
+        (book_entries, expiry_entries) = book.heap_sizes()
+        self.assertLessEqual(book_entries, 4)
+        self.assertLessEqual(expiry_entries, 2)
+        self.assertEqual([o.order_id for o in book.expire('2030-01-04')], [order_id])
+
+    def test_universe_matches_price_histories(self):
+        days = pd.date_range('2004-08-12', periods=80, freq='B')
+        (acc, xyz) = monthly_prices(days)
+        new = xyz.assign(date=days[30:75], volume=np.arange(45) * 10**5)
+        b = InteractiveBrokers(10*1000, {'acc': TradeableAsset('acc', acc), 'xyz': TradeableAsset('xyz', xyz),
+                                         'new': TradeableAsset('new', new)})
+        strategy = UniverseStrategy(days, window=10, prices={'acc': acc, 'xyz': xyz, 'new': new})
+        Market(days[0], days[-1], strategy, b).run()
+        for (universe, by_liquidity) in strategy.picked:
+            self.assertEqual(universe, by_liquidity)
+        self.assertEqual({len(u) for (u, _) in strategy.picked}, {0, 1, 2})
+
+        metrics = b.universe_metrics(window=10).metrics(days[50])
+        self.assertEqual(list(metrics.index), ['acc', 'new'])
+        self.assertEqual(list(metrics['history']), [50, 20])
+
+        # In compact mode the matrices take about half the memory, and pick the same universes
+        assets = {'acc': TradeableAsset('acc', acc), 'xyz': TradeableAsset('xyz', xyz), 'new': TradeableAsset('new', new)}
+        compact = InteractiveBrokers(10*1000, assets, compact=True)
+        for dt in days:
+            self.assertEqual(compact.universe(dt, top=2, min_price=19.0, window=10), b.universe(dt, top=2, min_price=19.0, window=10))
+        pd.testing.assert_frame_equal(compact.universe_metrics(window=10).metrics(days[50]), metrics, rtol=1e-6)
+        self.assertLess(compact.universe_metrics(window=10).nbytes(), 0.6 * b.universe_metrics(window=10).nbytes())